@@ -0,0 +1,694 @@
+# Offline benchmark for tradebot
+#
+# Starts stand-ins for the Alpaca REST API, the Alpaca trading stream and the
+# Slack Web API in a child process, points tradebot at them, and then drives
+# its slash commands through the ASGI entry point with a concurrent load
+# while the stream sends a firehose of trade_updates fills.  Reports
+# throughput, latency percentiles and how long replies and fill messages
+# took to reach Slack.
+#
+#     python benchmark.py --requests 2000 --concurrency 50 --fills 5000
+#
+# Any tradebot setting not about where Alpaca and Slack live (JOB_WORKERS,
+# ALPACA_RATE_LIMIT, STATE_MIRROR, ...) can be set in the environment as
+# usual.  The rate limit defaults to one the stand-ins never trip.
+#
+# With --startup, it instead measures cold starts: how soon a fresh process
+# has imported tradebot, finished ASGI startup, answered its first command
+# and its first command that needs the broker.
+#
+#     python benchmark.py --startup 10
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.parse
+from aiohttp import web
+
+# Symbols the stand-ins know about
+SYMBOLS = ("AAPL", "MSFT", "AMZN", "GOOG", "TSLA", "NVDA", "META", "NFLX",
+           "AMD", "INTC", "ORCL", "IBM", "CSCO", "ADBE", "CRM", "QCOM",
+           "PYPL", "UBER", "SHOP", "SQ")
+
+# Slash commands sent by default, with their weight in the mix
+DEFAULT_MIX = "order=40,list=30,get_price=25,clear=5"
+
+# Fill messages posted to this channel carry the order's sequence number as
+# the order quantity, so the stand-in for Slack can tell how late the message
+# showing each order filled is.
+FILLS_CHANNEL = "benchmark-fills"
+FILL_QTY = re.compile(r'\| \w+ (\d+) ')
+
+# Stand-ins
+
+# One aiohttp app plays Alpaca (REST and the trading stream) and Slack.
+# Broker and Slack latency can be added to every request.  The stream sends
+# either a firehose of synthetic fills or, given a script of (wall clock
+# time, trade_updates data) pairs, those events at those times.  Whatever
+# reached Slack is kept, with arrival times, and served at /_stats for the
+# benchmark to read back at the end.
+
+
+class FakeServices:
+    def __init__(self, broker_latency=0, slack_latency=0, fills=0,
+                 fill_rate=100, fill_pieces=1, max_open_orders=50,
+                 script=None):
+        self.broker_latency = broker_latency
+        self.slack_latency = slack_latency
+        self.fills = fills
+        self.fill_rate = fill_rate
+        self.fill_pieces = fill_pieces
+        self.fill_events = 0
+        self.max_open_orders = max_open_orders
+        self.script = script
+        self.replayed = 0
+        self.orders = {}
+        self.order_ids = itertools.count(1)
+        self.replies = {}
+        self.fill_sent = {}
+        self.fill_posted = {}
+        self.slack_messages = 0
+        self.firehose = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/v2/account", self.account)
+        app.router.add_get("/v2/clock", self.clock)
+        app.router.add_get("/v2/positions", self.positions)
+        app.router.add_get("/v2/assets", self.assets)
+        app.router.add_delete("/v2/positions", self.close_positions)
+        app.router.add_get("/v2/orders", self.list_orders)
+        app.router.add_post("/v2/orders", self.submit_order)
+        app.router.add_delete("/v2/orders", self.cancel_orders)
+        app.router.add_get("/v2/orders:by_client_order_id", self.get_order)
+        app.router.add_delete("/v2/orders/{id}", self.cancel_order)
+        app.router.add_get("/v1/bars/{timeframe}", self.bars)
+        app.router.add_get("/v1/last_quote/stocks/{symbol}", self.last_quote)
+        app.router.add_get("/stream", self.stream)
+        app.router.add_post("/api/{method}", self.slack_api)
+        app.router.add_post("/respond/{request}", self.slack_respond)
+        app.router.add_get("/_stats", self.stats)
+        return app
+
+    async def broker(self):
+        if self.broker_latency > 0:
+            await asyncio.sleep(self.broker_latency)
+
+    async def account(self, request):
+        await self.broker()
+        return web.json_response({
+            "id": "benchmark", "status": "ACTIVE", "currency": "USD",
+            "buying_power": "400000", "cash": "100000",
+            "portfolio_value": "100000", "equity": "100000",
+            "shorting_enabled": True,
+        })
+
+    async def clock(self, request):
+        await self.broker()
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return web.json_response({"timestamp": now, "is_open": True,
+                                  "next_open": now, "next_close": now})
+
+    async def positions(self, request):
+        await self.broker()
+        return web.json_response([position(symbol) for symbol in SYMBOLS])
+
+    async def assets(self, request):
+        await self.broker()
+        return web.json_response([
+            {"id": symbol, "class": "us_equity", "exchange": "NASDAQ",
+             "symbol": symbol, "status": "active", "tradable": True,
+             "marginable": True, "shortable": True, "easy_to_borrow": True}
+            for symbol in SYMBOLS])
+
+    async def close_positions(self, request):
+        await self.broker()
+        return web.json_response([
+            {"symbol": symbol, "status": 200, "body": {}}
+            for symbol in SYMBOLS], status=207)
+
+    async def list_orders(self, request):
+        await self.broker()
+        return web.json_response(list(reversed(self.orders.values())))
+
+    async def submit_order(self, request):
+        body = await request.json()
+        await self.broker()
+        client_order_id = body.get("client_order_id")
+        if client_order_id is not None:
+            for o in self.orders.values():
+                if o["client_order_id"] == client_order_id:
+                    return web.json_response({
+                        "code": 40010001,
+                        "message": "client_order_id must be unique",
+                    }, status=422)
+        o = order(next(self.order_ids), body)
+        self.orders[o["id"]] = o
+        while len(self.orders) > self.max_open_orders:
+            del self.orders[next(iter(self.orders))]
+        return web.json_response(o)
+
+    async def get_order(self, request):
+        await self.broker()
+        for o in self.orders.values():
+            if o["client_order_id"] == request.query["client_order_id"]:
+                return web.json_response(o)
+        return web.json_response(
+            {"code": 40410000, "message": "order not found"}, status=404)
+
+    async def cancel_orders(self, request):
+        await self.broker()
+        canceled = [{"id": order_id, "status": 200, "body": None}
+                    for order_id in self.orders]
+        self.orders.clear()
+        return web.json_response(canceled, status=207)
+
+    async def cancel_order(self, request):
+        await self.broker()
+        self.orders.pop(request.match_info["id"], None)
+        return web.Response(status=204)
+
+    async def bars(self, request):
+        await self.broker()
+        t = int(time.time()) // 60 * 60
+        return web.json_response({
+            symbol: [{"t": t, "o": 100, "h": 101, "l": 99,
+                      "c": price(symbol), "v": 1000}]
+            for symbol in request.query["symbols"].split(",")})
+
+    async def last_quote(self, request):
+        await self.broker()
+        p = price(request.match_info["symbol"])
+        return web.json_response({"status": "success", "last": {
+            "bidprice": p - 0.01, "bidsize": 1, "bidexchange": 1,
+            "askprice": p + 0.01, "asksize": 1, "askexchange": 1,
+            "timestamp": int(time.time() * 1000)}})
+
+    # The trading stream: authorizes anyone, and once trade_updates is
+    # listened to, sends the fill firehose or the script.
+    async def stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        async for message in ws:
+            message = json.loads(message.data)
+            if message.get("action") == "authenticate":
+                await ws.send_json({"stream": "authorization", "data": {
+                    "action": "authenticate", "status": "authorized"}})
+            elif message.get("action") == "listen":
+                streams = message["data"]["streams"]
+                await ws.send_json(
+                    {"stream": "listening", "data": {"streams": streams}})
+                if "trade_updates" in streams and self.firehose is None:
+                    if self.script is not None:
+                        send = self.send_script(ws)
+                    else:
+                        send = self.send_fills(ws)
+                    self.firehose = asyncio.ensure_future(send)
+        return ws
+
+    # Sends self.fills fills at fill_rate per second, in 10ms batches.  Each
+    # order is filled in fill_pieces of them: partial fills, then a fill.
+    async def send_fills(self, ws):
+        sent = 0
+        start = time.monotonic()
+        while sent < self.fills and not ws.closed:
+            due = min(self.fills, int((time.monotonic() - start) * self.fill_rate) + 1)
+            while sent < due:
+                number, piece = divmod(sent, self.fill_pieces)
+                sent += 1
+                self.fill_events = sent
+                now = time.time()
+                if piece == self.fill_pieces - 1:
+                    self.fill_sent[number + 1] = now
+                await ws.send_json(
+                    fill(number + 1, now, piece + 1, self.fill_pieces))
+            await asyncio.sleep(0.01)
+
+    # Sends the scripted events, each stamped with the time it is sent
+    async def send_script(self, ws):
+        for due, data in self.script:
+            wait = due - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if ws.closed:
+                return
+            timestamp = datetime.datetime.now(datetime.timezone.utc)
+            await ws.send_json({"stream": "trade_updates", "data": dict(
+                data, timestamp=timestamp.isoformat())})
+            self.replayed += 1
+
+    async def slack_api(self, request):
+        body = await request.json()
+        if self.slack_latency > 0:
+            await asyncio.sleep(self.slack_latency)
+        if request.match_info["method"] == "auth.test":
+            return web.json_response({"ok": True})
+        now = time.time()
+        self.slack_messages += 1
+        channel = body.get("channel", "")
+        if channel == FILLS_CHANNEL:
+            match = FILL_QTY.search(body.get("text", ""))
+            if match is not None and body["text"].startswith("*Event*: fill,"):
+                self.fill_posted.setdefault(int(match.group(1)), now)
+        elif channel.startswith("benchmark-"):
+            self.replies.setdefault(channel[len("benchmark-"):], now)
+        return web.json_response({"ok": True, "channel": channel,
+                                  "ts": f"{now:.6f}"})
+
+    async def slack_respond(self, request):
+        await request.read()
+        if self.slack_latency > 0:
+            await asyncio.sleep(self.slack_latency)
+        self.slack_messages += 1
+        self.replies.setdefault(request.match_info["request"], time.time())
+        return web.Response(text="ok")
+
+    async def stats(self, request):
+        return web.json_response({
+            "replies": self.replies,
+            "fill_sent": self.fill_sent,
+            "fill_events": self.fill_events,
+            "fill_posted": self.fill_posted,
+            "replayed": self.replayed,
+            "slack_messages": self.slack_messages,
+        })
+
+
+def price(symbol):
+    return 50 + sum(map(ord, symbol)) % 200
+
+
+def position(symbol):
+    return {"asset_id": symbol, "symbol": symbol, "exchange": "NASDAQ",
+            "asset_class": "us_equity", "qty": "10", "side": "long",
+            "avg_entry_price": str(price(symbol) - 1),
+            "current_price": str(price(symbol)),
+            "market_value": str(price(symbol) * 10)}
+
+
+def order(number, body):
+    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    return {
+        "id": f"00000000-0000-4000-8000-{number:012d}",
+        "client_order_id": body.get("client_order_id") or f"bench-{number}",
+        "created_at": now, "submitted_at": now, "filled_at": None,
+        "symbol": body["symbol"], "qty": str(body["qty"]),
+        "filled_qty": "0", "side": body["side"], "type": body["type"],
+        "time_in_force": body["time_in_force"],
+        "limit_price": body.get("limit_price"),
+        "stop_price": body.get("stop_price"), "status": "new",
+    }
+
+
+# The piece-th of the given number of fills of order number (the last one
+# completes it)
+
+
+def fill(number, at, piece=1, pieces=1):
+    symbol = SYMBOLS[number % len(SYMBOLS)]
+    filled = piece == pieces
+    o = order(number, {"symbol": symbol, "qty": number, "side": "buy",
+                       "type": "market", "time_in_force": "day"})
+    o.update({"filled_qty": f"{number * piece / pieces:g}",
+              "status": ("partially_filled", "filled")[filled],
+              "id": f"00000000-0000-4000-9000-{number:012d}"})
+    timestamp = datetime.datetime.fromtimestamp(
+        at, datetime.timezone.utc).isoformat()
+    return {"stream": "trade_updates", "data": {
+        "event": ("partial_fill", "fill")[filled],
+        "price": str(price(symbol)), "qty": f"{number / pieces:g}",
+        "position_qty": o["filled_qty"], "timestamp": timestamp, "order": o}}
+
+
+def serve_fakes(port, options):
+    web.run_app(FakeServices(**options).app(), host="127.0.0.1", port=port,
+                print=None, handle_signals=False)
+
+# Starts the stand-ins in a child process, so they do not compete with the
+# bot loop for the GIL, and waits for them to listen.
+
+
+def start_fakes(port, **options):
+    process = multiprocessing.Process(
+        target=serve_fakes, args=(port, options), daemon=True)
+    process.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.terminate()
+    raise RuntimeError(f"stand-ins did not start on port {port}")
+
+# Points tradebot at the stand-ins.  Must run before tradebot is imported,
+# since it reads its configuration at import time.
+
+
+def configure_tradebot(url):
+    os.environ.update({
+        "KEY_ID": "benchmark",
+        "SECRET_KEY": "benchmark",
+        "BASE_URL": url,
+        "DATA_URL": url,
+        "POLYGON_URL": url,
+        "SLACK_API_URL": f"{url}/api",
+        "SLACK_TOKEN": "benchmark",
+        "CHANNEL": FILLS_CHANNEL,
+        "RECORD_PATH": "",
+        "HISTORY_PATH": "",
+    })
+    os.environ.setdefault("ALPACA_RATE_LIMIT", "1000000")
+    os.environ.setdefault("ALPACA_BURST", "1000")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Load
+
+# A slash command for each kind of request in the mix: path and text
+
+
+def slash_command(kind, rng):
+    symbol = rng.choice(SYMBOLS)
+    if kind == "order":
+        qty = rng.randint(1, 100)
+        side = rng.choice(("buy", "sell"))
+        if rng.random() < 0.5:
+            return "/order", f"market {side} {qty} {symbol} day"
+        return "/order", f"limit {side} {qty} {symbol} gtc {price(symbol)}"
+    if kind == "list":
+        return "/list", rng.choice(("positions", "orders", "streams"))
+    if kind == "get_price":
+        return "/get_price", " ".join(rng.sample(SYMBOLS, rng.randint(1, 5)))
+    if kind == "clear":
+        return "/clear", rng.choice(("positions", "orders"))
+    if kind == "subscribe_streaming":
+        return "/subscribe_streaming", "trade_updates"
+    raise ValueError(f"unknown request kind {kind}")
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, weight = part.split("=")
+        mix[kind.strip()] = float(weight)
+    return mix
+
+# Sends one slash command through the ASGI app the way Slack would and
+# returns the HTTP status and body.
+
+
+async def call(app, path, form):
+    body = urllib.parse.urlencode(form).encode("utf-8")
+    received = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        received.append(message)
+    await app({"type": "http", "method": "POST", "path": path,
+               "headers": []}, receive, send)
+    return received[0]["status"], received[1]["body"].decode("utf-8")
+
+
+def slash_form(url, number, path, text):
+    return {
+        "command": path,
+        "text": text,
+        "trigger_id": f"benchmark.{number}",
+        "user_name": "benchmark",
+        "channel_name": f"benchmark-{number}",
+        "response_url": f"{url}/respond/{number}",
+    }
+
+
+async def run_load(tradebot, url, requests, concurrency, mix, seed):
+    rng = random.Random(seed)
+    kinds, weights = zip(*mix.items())
+    plan = [slash_command(kind, rng)
+            for kind in rng.choices(kinds, weights, k=requests)]
+    results = {}
+    numbers = iter(range(1, requests + 1))
+
+    async def worker():
+        for number in numbers:
+            path, text = plan[number - 1]
+            form = slash_form(url, number, path, text)
+            start = time.time()
+            status, answer = await call(tradebot.asgi_app, path, form)
+            results[number] = {"path": path, "sent": start,
+                               "answered": time.time(), "status": status,
+                               "answer": answer}
+    start = time.monotonic()
+    await asyncio.gather(*(worker() for i in range(concurrency)))
+    return results, time.monotonic() - start
+
+# True once the bot has no jobs, Slack messages or fill messages to update
+# left
+
+
+def idle(tradebot):
+    return (tradebot.jobs.depth == 0 and tradebot.slack._pending == 0
+            and len(tradebot.fills._orders) == 0)
+
+# Waits for the bot to be idle and for done(stats) to say the stand-ins have
+# sent everything, or for timeout seconds.
+
+
+async def drain(tradebot, session, url, done, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        async with session.get(f"{url}/_stats") as r:
+            stats = await r.json()
+        if idle(tradebot) and done(stats):
+            await asyncio.sleep(0.5)
+            if idle(tradebot):
+                break
+        await asyncio.sleep(0.2)
+    async with session.get(f"{url}/_stats") as r:
+        return await r.json()
+
+# Report
+
+
+def percentile(values, p):
+    if len(values) == 0:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def latency_row(name, seconds):
+    ms = [x * 1000 for x in seconds]
+    if len(ms) == 0:
+        return f"{name:<28}{0:>7}"
+    return (f"{name:<28}{len(ms):>7}{percentile(ms, 50):>10.1f}"
+            f"{percentile(ms, 99):>10.1f}{max(ms):>10.1f}")
+
+
+# busy_answer is tradebot's answer when its job queue is full
+
+
+def command_report(results, elapsed, stats, busy_answer):
+    lines = []
+    busy = len([x for x in results.values() if x["answer"] == busy_answer])
+    failed = len([x for x in results.values() if x["status"] != 200
+                  or x["answer"].startswith("ERROR")])
+    lines.append(f"Slash commands: {len(results)} in {elapsed:.2f}s "
+                 f"({len(results) / elapsed:.1f}/s), {busy} busy, "
+                 f"{failed} failed")
+    lines.append(f"{'':<28}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    paths = sorted(set(x["path"] for x in results.values()))
+    for path in paths:
+        answers = [x["answered"] - x["sent"] for x in results.values()
+                   if x["path"] == path]
+        lines.append(latency_row(f"{path} answer", answers))
+    unanswered = 0
+    for path in paths:
+        replies = []
+        for number, x in results.items():
+            if x["path"] != path or x["answer"] == busy_answer:
+                continue
+            replied = stats["replies"].get(str(number))
+            if replied is not None:
+                replies.append(replied - x["sent"])
+            elif x["answer"] != "":
+                replies.append(x["answered"] - x["sent"])
+            else:
+                unanswered += 1
+        lines.append(latency_row(f"{path} reply", replies))
+    if unanswered > 0:
+        lines.append(f"{unanswered} command(s) never replied.")
+    return "\n".join(lines)
+
+
+def fill_report(stats):
+    lines = []
+    sent, posted = stats["fill_sent"], stats["fill_posted"]
+    lag = [posted[n] - sent[n] for n in posted if n in sent]
+    lines.append(f"Fills: {stats['fill_events']} sent for {len(sent)} orders, "
+                 f"{len(posted)} orders shown filled in Slack")
+    lines.append(latency_row("fill to Slack", lag))
+    lines.append(f"Slack messages received: {stats['slack_messages']}")
+    return "\n".join(lines)
+
+
+async def benchmark(args):
+    import aiohttp
+    import tradebot
+    tradebot.use_loop(asyncio.get_running_loop())
+    url = os.environ["BASE_URL"]
+    async with aiohttp.ClientSession() as session:
+        if args.fills > 0:
+            form = slash_form(url, 0, "/subscribe_streaming", "trade_updates")
+            await call(tradebot.asgi_app, "/subscribe_streaming", form)
+        results, elapsed = await run_load(
+            tradebot, url, args.requests, args.concurrency,
+            parse_mix(args.mix), args.seed)
+        stats = await drain(
+            tradebot, session, url,
+            lambda stats: (len(stats["fill_sent"])
+                           >= args.fills // args.fill_pieces),
+            args.drain_timeout)
+    await tradebot.api.close()
+    await tradebot.slack.close()
+    return (command_report(results, elapsed, stats, tradebot.BUSY) + "\n"
+            + fill_report(stats))
+
+
+# Startup
+
+# Run in a fresh interpreter: imports tradebot, goes through ASGI startup
+# (which starts the warm-up), then sends a command answered without the
+# broker and, after sitting idle for the given number of seconds, one that
+# needs it.  Prints when each step was done, and when the broker command was
+# sent.
+STARTUP_PROBE = """
+import asyncio, json, sys, time, urllib.parse
+import tradebot
+imported = time.time()
+
+
+async def call(path, text):
+    body = urllib.parse.urlencode({"text": text}).encode("utf-8")
+
+    async def receive():
+        return {"type": "http.request", "body": body}
+
+    async def send(message):
+        pass
+    await tradebot.asgi_app({"type": "http", "method": "POST", "path": path,
+                             "headers": []}, receive, send)
+
+
+async def main():
+    lifespan = asyncio.Queue()
+    started = asyncio.Event()
+    await lifespan.put({"type": "lifespan.startup"})
+
+    async def send(message):
+        started.set()
+    asyncio.ensure_future(
+        tradebot.asgi_app({"type": "lifespan"}, lifespan.get, send))
+    await started.wait()
+    ready = time.time()
+    await call("/help_tradebot", "")
+    answered = time.time()
+    await asyncio.sleep(float(sys.argv[1]))
+    sent = time.time()
+    await call("/account_info", "")
+    print(json.dumps({"import": imported, "ready": ready,
+                      "first command": answered,
+                      "broker command sent": sent,
+                      "first broker command": time.time()}))
+asyncio.run(main())
+"""
+
+
+def startup_benchmark(runs, idle):
+    env = dict(os.environ, STATE_MIRROR="0")
+    here = os.path.dirname(os.path.abspath(__file__))
+    steps = {}
+    took = []
+    for i in range(runs):
+        start = time.time()
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE, str(idle)], cwd=here,
+            env=env, check=True, capture_output=True, text=True).stdout
+        times = json.loads(output.splitlines()[-1])
+        sent = times.pop("broker command sent")
+        took.append((times["first broker command"] - sent) * 1000)
+        for step, at in times.items():
+            steps.setdefault(step, []).append((at - start) * 1000)
+    warm_up = ("off", "on")[env.get("WARM_UP", "1") == "1"]
+    lines = [f"Cold starts: {runs}, warm-up {warm_up}, idle {idle}s before "
+             f"the first broker command",
+             f"{'ms after process start':<28}{'median':>10}{'max':>10}"]
+    for step, ms in steps.items():
+        lines.append(f"{step:<28}{statistics.median(ms):>10.1f}{max(ms):>10.1f}")
+    lines.append(f"{'broker command took (ms)':<28}"
+                 f"{statistics.median(took):>10.1f}{max(took):>10.1f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline tradebot benchmark")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="slash commands to send")
+    parser.add_argument("--concurrency", type=int, default=20,
+                        help="slash commands in flight at once")
+    parser.add_argument("--mix", default=DEFAULT_MIX,
+                        help="request kinds and weights, like " + DEFAULT_MIX)
+    parser.add_argument("--fills", type=int, default=2000,
+                        help="trade_updates fills to send")
+    parser.add_argument("--fill-rate", type=float, default=200,
+                        help="fills sent per second")
+    parser.add_argument("--fill-pieces", type=int, default=1,
+                        help="fills per order, all but the last partial")
+    parser.add_argument("--broker-latency", type=float, default=0.02,
+                        help="seconds added to every Alpaca request")
+    parser.add_argument("--slack-latency", type=float, default=0.05,
+                        help="seconds added to every Slack request")
+    parser.add_argument("--drain-timeout", type=float, default=60,
+                        help="seconds to wait for replies after the load")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--startup", type=int, default=0, metavar="RUNS",
+                        help="measure this many cold starts instead")
+    parser.add_argument("--startup-idle", type=float, default=1,
+                        help="seconds a cold start sits idle before its "
+                             "first broker command")
+    args = parser.parse_args()
+
+    port = free_port()
+    fakes = start_fakes(port, broker_latency=args.broker_latency,
+                        slack_latency=args.slack_latency, fills=args.fills,
+                        fill_rate=args.fill_rate, fill_pieces=args.fill_pieces)
+    try:
+        configure_tradebot(f"http://127.0.0.1:{port}")
+        if args.startup > 0:
+            print(startup_benchmark(args.startup, args.startup_idle))
+        else:
+            print(asyncio.run(benchmark(args)))
+    finally:
+        fakes.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+# Replays a tradebot journal
+#
+# Run the bot with RECORD_PATH set and it journals every slash command and
+# trade_updates event it receives.  This plays such a journal back into the
+# bot against the local stand-ins of benchmark.py, at the recorded pace or
+# up to 100x faster, to reproduce an incident (say, the fill burst at the
+# open) and profile it:
+#
+#     python replay.py tradebot.journal --speed 20 --profile replay.prof
+#
+# Replies go to the stand-in for Slack: each command's response_url and
+# channel are rewritten to point there, everything else is sent as recorded.
+import argparse
+import asyncio
+import cProfile
+import json
+import os
+import pstats
+import time
+import benchmark
+
+# Commands as (time, path, form) and events as (time, data), optionally only
+# those from start to start + duration seconds into the journal
+
+
+def read_journal(path, start=0, duration=None):
+    commands, events = [], []
+    t0 = None
+    with open(path, encoding="utf-8") as journal:
+        for line in journal:
+            if line.strip() == "":
+                continue
+            entry = json.loads(line)
+            if t0 is None:
+                t0 = entry["t"]
+            offset = entry["t"] - t0
+            if offset < start:
+                continue
+            if duration is not None and offset > start + duration:
+                break
+            if "command" in entry:
+                commands.append((entry["t"], entry["command"], entry["form"]))
+            elif entry.get("stream") == "trade_updates":
+                events.append((entry["t"], entry["data"]))
+    return commands, events
+
+# Sends each command at its time on the replay clock, without waiting for
+# earlier ones to be answered, as Slack would.
+
+
+async def replay_commands(tradebot, url, commands, clock):
+    results = {}
+
+    async def send(number, path, form):
+        form = dict(form,
+                    channel_name=f"benchmark-{number}",
+                    response_url=f"{url}/respond/{number}")
+        sent = time.time()
+        status, answer = await benchmark.call(tradebot.asgi_app, path, form)
+        results[number] = {"path": path, "sent": sent,
+                           "answered": time.time(), "status": status,
+                           "answer": answer}
+    tasks = []
+    for number, (t, path, form) in enumerate(commands, 1):
+        wait = clock(t) - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        tasks.append(asyncio.ensure_future(send(number, path, form)))
+    await asyncio.gather(*tasks)
+    return results
+
+
+async def replay(args, commands, events, clock, start):
+    import aiohttp
+    import tradebot
+    tradebot.use_loop(asyncio.get_running_loop())
+    url = os.environ["BASE_URL"]
+    async with aiohttp.ClientSession() as session:
+        if len(events) > 0:
+            form = benchmark.slash_form(
+                url, 0, "/subscribe_streaming", "trade_updates")
+            await benchmark.call(
+                tradebot.asgi_app, "/subscribe_streaming", form)
+        results = await replay_commands(tradebot, url, commands, clock)
+        stats = await benchmark.drain(
+            tradebot, session, url,
+            lambda stats: stats["replayed"] >= len(events),
+            args.drain_timeout)
+    elapsed = time.time() - start
+    await tradebot.api.close()
+    await tradebot.slack.close()
+    return "\n".join([
+        benchmark.command_report(results, elapsed, stats, tradebot.BUSY),
+        f"Stream events: {stats['replayed']} of {len(events)} replayed",
+        f"Slack messages received: {stats['slack_messages']}",
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a tradebot journal")
+    parser.add_argument("journal", help="file written with RECORD_PATH set")
+    parser.add_argument("--speed", type=float, default=1,
+                        help="how many times faster than recorded, 1 to 100")
+    parser.add_argument("--start", type=float, default=0,
+                        help="seconds into the journal to start from")
+    parser.add_argument("--duration", type=float, default=None,
+                        help="seconds of the journal to replay")
+    parser.add_argument("--broker-latency", type=float, default=0.02,
+                        help="seconds added to every Alpaca request")
+    parser.add_argument("--slack-latency", type=float, default=0.05,
+                        help="seconds added to every Slack request")
+    parser.add_argument("--drain-timeout", type=float, default=60,
+                        help="seconds to wait for replies after the replay")
+    parser.add_argument("--profile", default=None,
+                        help="write cProfile stats of the replay to this file")
+    args = parser.parse_args()
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed must be from 1 to 100")
+
+    commands, events = read_journal(args.journal, args.start, args.duration)
+    if len(commands) == 0 and len(events) == 0:
+        parser.error("nothing to replay")
+    # The replay clock: journal time t happens at clock(t), giving the bot
+    # and the stand-ins a moment to start first
+    t0 = min([x[0] for x in commands] + [x[0] for x in events])
+    start = time.time() + 2
+
+    def clock(t):
+        return start + (t - t0) / args.speed
+
+    port = benchmark.free_port()
+    fakes = benchmark.start_fakes(
+        port, broker_latency=args.broker_latency,
+        slack_latency=args.slack_latency,
+        script=[(clock(t), data) for t, data in events])
+    profile = cProfile.Profile() if args.profile else None
+    try:
+        benchmark.configure_tradebot(f"http://127.0.0.1:{port}")
+        # Imported here so the profile leaves out the import
+        import tradebot  # noqa: F401
+        if profile is not None:
+            profile.enable()
+        print(asyncio.run(replay(args, commands, events, clock, start)))
+    finally:
+        fakes.terminate()
+        if profile is not None:
+            profile.disable()
+            profile.dump_stats(args.profile)
+            pstats.Stats(profile).sort_stats("cumulative").print_stats(25)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,650 @@
+import asyncio
+import sqlite3
+import time
+import pytest
+import tradebot
+
+
+# Orders are parsed without the asset list
+@pytest.fixture(autouse=True)
+def no_asset_index(monkeypatch):
+    monkeypatch.setattr(tradebot.assets, "problem", lambda *args: None)
+
+
+@pytest.fixture
+def book(monkeypatch):
+    watched = set()
+    monkeypatch.setattr(tradebot.supervisor, "subscribe",
+                        lambda channel, owner: watched.add(channel))
+    monkeypatch.setattr(tradebot.supervisor, "unsubscribe",
+                        lambda channel, owner: watched.discard(channel))
+    book = tradebot.AlertBook()
+    book.watched = watched
+    return book
+
+
+def alert(symbol, above, threshold, repeat=False):
+    return {"symbol": symbol, "above": above, "threshold": threshold,
+            "repeat": repeat, "expires": time.time() + 3600,
+            "user": "U", "channel": "C"}
+
+
+# One tick crossing two one-shot alerts fires both and stops watching
+def test_alerts_one_tick_crosses_two_one_shot_alerts(book):
+    async def run():
+        book.add(alert("X", True, 100))
+        book.add(alert("X", True, 101))
+        return book.check("X", 102)
+    fired = asyncio.run(run())
+    assert [x["threshold"] for x in fired] == [100, 101]
+    assert book.alerts == {}
+    assert "X" not in book._levels
+    assert book.watched == set()
+
+
+# A one-shot alert firing alongside a disarmed repeating one that rearms
+def test_alerts_one_shot_fires_while_repeating_rearms(book):
+    async def run():
+        book.add(alert("AAPL", False, 180))
+        repeating = book.add(alert("AAPL", True, 190, repeat=True))
+        assert [x["id"] for x in book.check("AAPL", 191)] == [repeating["id"]]
+        return repeating, book.check("AAPL", 179)
+    repeating, fired = asyncio.run(run())
+    assert [x["threshold"] for x in fired] == [180]
+    assert list(book.alerts) == [repeating["id"]]
+    assert repeating["armed"]
+    assert book.watched == {"Q.AAPL"}
+
+
+# Basket files are only fetched from Slack, over https
+@pytest.mark.parametrize("url, allowed", [
+    ("https://files.slack.com/files-pri/T1-F1/basket.csv", True),
+    ("https://slack.com/files/basket.csv", True),
+    ("https://evilslack.com/basket.csv", False),
+    ("https://files.slack.com.evil.example/basket.csv", False),
+    ("http://files.slack.com/files-pri/T1-F1/basket.csv", False),
+    ("https://169.254.169.254/latest/meta-data/", False),
+])
+def test_slack_file_url(url, allowed):
+    assert tradebot.slack_file_url(url) == allowed
+
+
+def position(symbol, qty, entry):
+    return tradebot.entity.Position({
+        "symbol": symbol, "qty": str(qty), "avg_entry_price": str(entry),
+        "side": ("short", "long")[qty > 0], "current_price": str(entry)})
+
+
+# Closing a position the book has not loaded yet realizes against its entry
+def test_book_fill_on_unloaded_position_realizes_pnl():
+    book = tradebot.PortfolioBook()
+    book.fill("X", "sell", 100, 110, position("X", 100, 100))
+    assert book.realized == 1000
+    assert book.value()["positions"] == 0
+
+
+def test_book_fill_after_load():
+    book = tradebot.PortfolioBook()
+    book.load([position("X", -50, 20)])
+    book.fill("X", "buy", 20, 15)
+    book.fill("Y", "buy", 10, 5)
+    assert book.realized == 100
+    assert book.value()["positions"] == 2
+
+
+# A fill that arrives while the mirror is being seeded survives the older
+# snapshot
+def test_mirror_seed_keeps_events_that_arrive_meanwhile(monkeypatch):
+    mirror = tradebot.AccountMirror()
+    order = {"id": "o1", "symbol": "X", "side": "buy", "qty": "10",
+             "type": "market", "time_in_force": "day"}
+    fill = tradebot.entity.Entity({"event": "fill", "order": order,
+                                   "qty": "10", "price": "5",
+                                   "position_qty": "10"})
+
+    async def list_all_orders(status=None):
+        mirror.apply(fill)
+        return [tradebot.entity.Order(order)]
+
+    async def list_positions():
+        return []
+
+    async def get_account():
+        return tradebot.entity.Account({"buying_power": "1000"})
+    monkeypatch.setattr(tradebot.api, "list_all_orders", list_all_orders)
+    monkeypatch.setattr(tradebot.api, "list_positions", list_positions)
+    monkeypatch.setattr(tradebot.api, "get_account", get_account)
+    asyncio.run(mirror._seed())
+    assert mirror.orders == {}
+    assert float(mirror.positions["X"].qty) == 10
+
+
+# Notional orders have no qty
+def test_history_line_without_qty():
+    line = tradebot.history_line(
+        (0, "o1", "X", "fill", "buy", "market", None, None, 5.0))
+    assert line == "1970-01-01 00:00:00  fill: buy X market, ? at 5, Order id = o1"
+
+
+# Page buttons carry the query as /list arguments, within Slack's limit
+def test_list_page_buttons():
+    orders = [tradebot.entity.Order({
+        "id": str(i), "symbol": "X", "side": "buy", "qty": "1",
+        "type": "market", "time_in_force": "day", "filled_qty": "0",
+        "limit_price": None, "stop_price": None}) for i in range(120)]
+    query = tradebot.list_query(["orders", "side=buy", "sort=-qty", "page=2"])
+    text, blocks = tradebot.list_page(query, orders)
+    buttons = blocks[-1]["elements"]
+    assert [tradebot.list_query(x["value"].split())["page"]
+            for x in buttons] == [1, 3]
+    symbols = ",".join(f"S{i:04d}" for i in range(500))
+    query = tradebot.list_query(["orders", f"symbol={symbols}"])
+    text, blocks = tradebot.list_page(query, orders)
+    assert blocks[-1]["type"] == "context"
+
+
+@pytest.mark.parametrize("payload", [
+    "not json", "[]", '{"actions": ["x"]}',
+    '{"actions": [{"action_id": "list_next", "value": ""}]}',
+    '{"actions": [{"action_id": "list_next", "value": "streams"}]}',
+])
+def test_interactive_rejects_bad_payloads(payload):
+    answer = asyncio.run(tradebot.interactive_handler({"payload": payload}))
+    assert answer in ("", tradebot.BAD_ARGS)
+
+
+class RiskAPI:
+    def __init__(self, positions=(), open_orders=(), buying_power=1e9):
+        self.positions = [position(*x) for x in positions]
+        self.open_orders = [tradebot.entity.Order(x) for x in open_orders]
+        self.buying_power = buying_power
+
+    async def list_positions(self):
+        return self.positions
+
+    async def list_all_orders(self, status=None):
+        return self.open_orders
+
+    async def get_account(self):
+        return tradebot.entity.Account(
+            {"buying_power": str(self.buying_power)})
+
+
+def risk_check(monkeypatch, orders, last=None, api=None, **limits):
+    async def fetch(api, symbols):
+        return {x: (p, None) for x, p in (last or {}).items() if x in symbols}
+    monkeypatch.setattr(tradebot.prices, "fetch", fetch)
+    monkeypatch.setattr(tradebot.mirror, "ready", lambda: False)
+    engine = tradebot.RiskEngine(**limits)
+    return asyncio.run(engine.check(api or RiskAPI(), orders))
+
+
+def order(text):
+    return tradebot.parse_order(text.split())
+
+
+def test_risk_order_value(monkeypatch):
+    problems = risk_check(
+        monkeypatch, [order("limit buy 10 X day 50"),
+                      order("limit buy 11 X day 50")],
+        max_order_value=500)
+    assert problems[0] is None
+    assert problems[1].startswith("Order worth 550.00")
+
+
+def test_risk_position_value_across_the_basket(monkeypatch):
+    api = RiskAPI(positions=[("AAPL", 50, 100)])
+    problems = risk_check(
+        monkeypatch, [order("market buy 40 AAPL day")] * 5,
+        last={"AAPL": 100}, api=api, max_position_value=10000)
+    assert problems[0] is None
+    assert all(x.startswith("AAPL position would be worth 13,000.00")
+               for x in problems[1:])
+
+
+def test_risk_position_value_counts_open_orders(monkeypatch):
+    api = RiskAPI(positions=[("AAPL", 50, 100)], open_orders=[
+        {"id": "o1", "symbol": "AAPL", "side": "buy", "qty": "60",
+         "filled_qty": "10", "limit_price": "100", "type": "limit"},
+        {"id": "o2", "symbol": "AAPL", "side": "sell", "qty": "100",
+         "filled_qty": "0", "limit_price": "120", "type": "limit"}])
+    problems = risk_check(
+        monkeypatch, [order("market buy 1 AAPL day"),
+                      order("market sell 150 AAPL day")],
+        last={"AAPL": 100}, api=api, max_position_value=10000)
+    assert problems[0].startswith("AAPL position would be worth 10,100.00")
+    # Closing out 50 and the 100 sell on order leaves a 200 share short
+    assert problems[1].startswith("AAPL position would be worth 20,000.00")
+
+
+def test_risk_shrinking_a_position_passes(monkeypatch):
+    api = RiskAPI(positions=[("AAPL", 500, 100)])
+    problems = risk_check(
+        monkeypatch, [order("market sell 100 AAPL day")],
+        last={"AAPL": 100}, api=api, max_position_value=10000)
+    assert problems == [None]
+
+
+def test_risk_price_band(monkeypatch):
+    problems = risk_check(
+        monkeypatch, [order("limit buy 1 X day 104"),
+                      order("stop sell 1 X day 94")],
+        last={"X": 100}, price_band=0.05)
+    assert problems[0] is None
+    assert problems[1].startswith("Stop price 94 is more than 5% away")
+
+
+def test_risk_buying_power(monkeypatch):
+    api = RiskAPI(buying_power=1000, open_orders=[
+        {"id": "o1", "symbol": "Y", "side": "buy", "qty": "2",
+         "filled_qty": "0", "limit_price": None, "type": "market"}])
+    problems = risk_check(
+        monkeypatch, [order("limit buy 5 X day 100"),
+                      order("limit buy 4 X day 100"),
+                      order("limit sell 50 X day 100")],
+        last={"Y": 100}, api=api, buying_power=True)
+    assert problems[0] is None
+    assert problems[1].startswith("Order worth 400.00, with 700.00 of buys")
+    assert problems[2] is None
+
+
+def test_risk_refuses_an_order_it_cannot_price(monkeypatch):
+    problems = risk_check(
+        monkeypatch, [order("market buy 1 X day")], max_order_value=500)
+    assert problems[0].startswith("No price for X")
+    problems = risk_check(
+        monkeypatch, [order("market buy 1 X day")], price_band=0.05)
+    assert problems == [None]
+
+
+class FakeConn:
+    trading_ws = data_ws = None
+
+    def register(self, pattern, handler):
+        pass
+
+    async def subscribe(self, channels):
+        pass
+
+    async def unsubscribe(self, channels):
+        pass
+
+    async def close(self, renew):
+        pass
+
+
+# A connection that cannot even be built is retried like one that drops
+def test_supervisor_retries_when_the_connection_cannot_be_built(monkeypatch):
+    made = []
+
+    def make_conn():
+        made.append(1)
+        if len(made) == 1:
+            raise ValueError("bad credentials")
+        return FakeConn()
+    real_sleep = asyncio.sleep
+    monkeypatch.setattr(tradebot.asyncio, "sleep",
+                        lambda delay: real_sleep(0))
+    supervisor = tradebot.StreamSupervisor(make_conn, check_interval=0.01)
+
+    async def run():
+        supervisor.subscribe("T.X")
+        for _ in range(100):
+            if supervisor.connected:
+                break
+            await real_sleep(0.01)
+        connected = supervisor.connected
+        supervisor.unsubscribe("T.X")
+        await supervisor._task
+        return connected
+    assert asyncio.run(run())
+    assert len(made) == 2
+    assert supervisor.reconnects == 1
+
+
+# Trade, quote and bar events carry Unix milliseconds
+@pytest.mark.parametrize("channel, message", [
+    ("T.X", {"T": "X", "p": 10.0, "s": 100, "t": 1600000000123}),
+    ("Q.X", {"T": "X", "p": 9.9, "P": 10.1, "t": 1600000000123}),
+    ("AM.X", {"T": "X", "c": 10.0, "s": 1600000000123,
+              "e": 1600000060123}),
+])
+def test_event_time_of_market_data(channel, message):
+    socket = tradebot.supervised_socket()("key", "secret",
+                                          "https://data.example")
+    data = socket._cast(channel, message)
+    assert tradebot.event_time(data) == pytest.approx(1600000000.123)
+
+
+def test_event_time_of_order_updates():
+    data = tradebot.entity.Entity(
+        {"event": "fill", "timestamp": "2020-09-13T12:26:40.123Z"})
+    assert tradebot.event_time(data) == pytest.approx(1600000000.123)
+
+
+# Prices kept warm by a stream are timed like the ones from minute bars
+def test_price_cache_update_from_trade_stream():
+    socket = tradebot.supervised_socket()("key", "secret",
+                                          "https://data.example")
+    cache = tradebot.PriceCache()
+    cache.update("T.X", socket._cast(
+        "T.X", {"T": "X", "p": 10.0, "s": 100, "t": 1600000000123}))
+    price, at = cache.get("X")
+    assert price == 10.0
+    assert str(at) == "2020-09-13 08:26:40.123000-04:00"
+
+
+# A worker waiting for another's write lock on the shared state does not
+# hold up its bot loop
+def test_shared_state_waits_off_the_loop(tmp_path):
+    state = tradebot.SharedState(str(tmp_path / "shared.db"))
+    state.db()
+    other = sqlite3.connect(str(tmp_path / "shared.db"),
+                            isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    other.execute("INSERT INTO leases VALUES ('streams', 'other:1', ?)",
+                  (time.time() - 1,))
+
+    async def run():
+        lead = asyncio.ensure_future(state.run(state.lead, "streams"))
+        ticks = 0
+        start = time.monotonic()
+        while time.monotonic() - start < 0.5:
+            await asyncio.sleep(0.01)
+            ticks += 1
+        waiting = not lead.done()
+        other.execute("COMMIT")
+        return ticks, waiting, await lead
+    ticks, waiting, led = asyncio.run(run())
+    assert waiting and led
+    assert ticks > 25
+
+
+# Requests that find the bucket empty are let through by priority, then in
+# the order they came
+def test_rate_limiter_priority_order():
+    limiter = tradebot.RateLimiter(rate_per_minute=1200, burst=1)
+    order = []
+
+    async def request(name, priority):
+        await limiter.acquire(priority)
+        order.append(name)
+
+    async def run():
+        await limiter.acquire()
+        await asyncio.gather(
+            request("read", tradebot.PRIORITY_READ),
+            request("order", tradebot.PRIORITY_ORDER),
+            request("read again", tradebot.PRIORITY_READ),
+            request("cancel", tradebot.PRIORITY_URGENT))
+    asyncio.run(run())
+    assert order == ["cancel", "order", "read", "read again"]
+    assert limiter.waits[tradebot.PRIORITY_READ]["count"] == 3
+
+
+def test_rate_limiter_refill():
+    limiter = tradebot.RateLimiter(rate_per_minute=1200, burst=2)
+
+    async def run():
+        waits = [await limiter.acquire() for _ in range(3)]
+        await asyncio.sleep(0.5)
+        limiter._refill()
+        return waits, limiter.tokens
+    waits, tokens = asyncio.run(run())
+    assert max(waits[:2]) < 0.01
+    assert 0.03 < waits[2] < 0.2
+    assert tokens == 2
+
+
+def test_rate_limiter_pause():
+    limiter = tradebot.RateLimiter(rate_per_minute=6000, burst=5)
+
+    async def run():
+        limiter.pause(0.2)
+        return await limiter.acquire(tradebot.PRIORITY_URGENT)
+    assert asyncio.run(run()) >= 0.19
+
+
+# Slack retrying a slow /order with the same trigger_id places it once
+def test_retried_order_is_submitted_once(monkeypatch):
+    submitted = []
+    queued = []
+
+    async def submit_order(**order):
+        submitted.append(order)
+        return tradebot.entity.Order({"id": f"o{len(submitted)}"})
+    monkeypatch.setattr(tradebot.api, "submit_order", submit_order)
+    monkeypatch.setattr(tradebot, "submit_job",
+                        lambda func, *args: queued.append((func, args)) or "")
+    monkeypatch.setattr(tradebot, "start_background", lambda: None)
+    monkeypatch.setattr(tradebot.slack, "post", lambda channel, text: None)
+    monkeypatch.setattr(tradebot, "deliveries", tradebot.DedupeCache())
+    form = {"text": "limit buy 10 AAPL day 100", "trigger_id": "T1",
+            "channel_name": "general", "user_id": "U1"}
+
+    async def run():
+        for _ in range(3):
+            await tradebot.commands["/order"](dict(form))
+        for func, args in queued:
+            await func(*args)
+    asyncio.run(run())
+    assert len(submitted) == 1
+    assert submitted[0]["client_order_id"] == tradebot.client_order_id(form)
+
+
+# A retry that lands on another worker is caught through the shared store
+def test_dedupe_across_workers(tmp_path):
+    path = str(tmp_path / "shared.db")
+    first = tradebot.DedupeCache(store=tradebot.SharedState(path))
+    second = tradebot.DedupeCache(store=tradebot.SharedState(path))
+
+    async def run():
+        return [await first.seen("T1"), await second.seen("T1"),
+                await second.seen("T2"), await first.seen("")]
+    assert asyncio.run(run()) == [False, True, False, False]
+
+
+def test_dedupe_cache_forgets_after_ttl():
+    cache = tradebot.DedupeCache(ttl=0.05, max_size=2)
+
+    async def run():
+        seen = [await cache.seen("a"), await cache.seen("a")]
+        await asyncio.sleep(0.1)
+        seen.append(await cache.seen("a"))
+        return seen
+    assert asyncio.run(run()) == [False, True, False]
+
+
+def test_client_order_id_is_stable_per_delivery():
+    form = {"trigger_id": "T1"}
+    assert tradebot.client_order_id(form) == tradebot.client_order_id(form)
+    assert tradebot.client_order_id(form, 1) != tradebot.client_order_id(form)
+    assert len(tradebot.client_order_id(form)) <= 48
+    assert tradebot.client_order_id({}) is None
+
+
+class FakeSlack:
+    def __init__(self):
+        self.posts = []
+        self.updates = []
+
+    def post(self, channel, text, stream_event=None, callback=None):
+        self.posts.append((channel, text))
+        if callback is not None:
+            asyncio.get_running_loop().call_soon(
+                callback, {"ts": str(len(self.posts)), "channel": channel})
+
+    def update(self, lane, channel, ts, text, stream_event=None):
+        self.updates.append((channel, ts, text))
+
+
+def trade_update(event, qty=None, price=None, id="o1", symbol="AAPL",
+                 side="buy"):
+    return tradebot.entity.Entity({
+        "event": event, "qty": qty, "price": price,
+        "timestamp": "2020-09-13T12:26:40Z",
+        "order": {"id": id, "symbol": symbol, "side": side, "qty": "50",
+                  "type": "market", "time_in_force": "day"}})
+
+
+# Fills of one order are gathered into one message that shows the quantity
+# filled and its volume weighted average price, and the last event is
+# shown without waiting for the window
+def test_fill_notifier_coalesces_fills(monkeypatch):
+    slack = FakeSlack()
+    monkeypatch.setattr(tradebot, "slack", slack)
+    notifier = tradebot.FillNotifier(window=0.05)
+
+    async def run():
+        notifier.add(trade_update("partial_fill", "10", "10"), "fills")
+        await asyncio.sleep(0.01)
+        notifier.add(trade_update("partial_fill", "20", "11"), "fills")
+        notifier.add(trade_update("partial_fill", "10", "12"), "fills")
+        await asyncio.sleep(0.1)
+        notifier.add(trade_update("fill", "10", "16"), "fills")
+        await asyncio.sleep(0.01)
+    asyncio.run(run())
+    assert [x[1] for x in slack.posts] == [
+        "*Event*: partial_fill, market order of | buy 50 AAPL day | filled 10 at 10 average (1 fill)"]
+    assert [x[2] for x in slack.updates] == [
+        "*Event*: partial_fill, market order of | buy 50 AAPL day | filled 40 at 11 average (3 fills)",
+        "*Event*: fill, market order of | buy 50 AAPL day | filled 50 at 12 average (4 fills)"]
+    assert notifier._orders == {}
+
+
+# An order canceled while its first message is still being posted is
+# shown as canceled as soon as that post returns
+def test_fill_notifier_flushes_terminal_event_after_post(monkeypatch):
+    slack = FakeSlack()
+    monkeypatch.setattr(tradebot, "slack", slack)
+    notifier = tradebot.FillNotifier(window=10)
+
+    async def run():
+        notifier.add(trade_update("new"), "fills")
+        notifier.add(trade_update("partial_fill", "10", "10"), "fills")
+        notifier.add(trade_update("canceled"), "fills")
+        await asyncio.sleep(0.01)
+    asyncio.run(run())
+    assert [x[1] for x in slack.posts] == [
+        "*Event*: new, market order of | buy 50 AAPL day new",
+        "*Event*: partial_fill, market order of | buy 50 AAPL day | filled 10 at 10 average (1 fill)"]
+    assert [x[2] for x in slack.updates] == [
+        "*Event*: canceled, market order of | buy 50 AAPL day | filled 10 at 10 average (1 fill)"]
+    assert notifier._orders == {}
+
+
+@pytest.fixture
+def table(monkeypatch):
+    watched = set()
+    monkeypatch.setattr(tradebot.supervisor, "subscribe",
+                        lambda channel, owner: watched.add(owner))
+    monkeypatch.setattr(tradebot.supervisor, "unsubscribe",
+                        lambda channel, owner: watched.discard(owner))
+    table = tradebot.RouteTable()
+    table.add({"channel": "tech", "symbols": "AAPL,MSFT", "sides": "",
+               "events": ""})
+    table.add({"channel": "ops", "symbols": "", "sides": "sell",
+               "events": "fill,canceled"})
+    table.add({"channel": "orders", "symbols": "", "sides": "",
+               "events": "new"})
+    table.watched = watched
+    return table
+
+
+@pytest.mark.parametrize("data, channels", [
+    (trade_update("fill", "1", "1"), {"tech"}),
+    (trade_update("fill", "1", "1", side="sell"), {"tech", "ops"}),
+    (trade_update("canceled", symbol="TSLA", side="sell"), {"ops"}),
+    (trade_update("partial_fill", "1", "1", symbol="TSLA", side="sell"),
+     set()),
+    (trade_update("new", symbol="MSFT"), {"orders"}),
+])
+def test_routes_match(table, data, channels):
+    assert table.match(data) == channels
+
+
+def test_routes_remove_and_load(table):
+    assert table.watched == {"routes"}
+    assert table.remove(1) and not table.remove(1)
+    assert table.match(trade_update("fill", "1", "1")) == set()
+    table.load([{"id": 4, "channel": "tech", "symbols": "", "sides": "",
+                 "events": ""}])
+    assert list(table.routes) == [4]
+    assert table.match(trade_update("new")) == set()
+    assert table.match(trade_update("fill", "1", "1")) == {"tech"}
+    table.clear()
+    assert table.watched == set()
+
+
+# CHANNEL gets every event but "new" once Slack subscribed trade_updates,
+# besides the channels routed to
+@pytest.mark.parametrize("subscribed, event, channels", [
+    (True, "fill", {"general", "tech"}),
+    (False, "fill", {"tech"}),
+    (True, "new", {"orders"}),
+])
+def test_trade_updates_fall_back_to_channel(monkeypatch, table, subscribed,
+                                            event, channels):
+    sent = set()
+    monkeypatch.setattr(tradebot, "routes", table)
+    monkeypatch.setattr(tradebot, "book", tradebot.PortfolioBook())
+    monkeypatch.setattr(tradebot.mirror, "ready", lambda: False)
+    monkeypatch.setattr(tradebot.supervisor, "wanted_by",
+                        lambda channel, owner: subscribed)
+    monkeypatch.setattr(tradebot.fills, "add",
+                        lambda data, channel: sent.add(channel))
+    monkeypatch.setitem(tradebot.config, "channel", "general")
+    asyncio.run(tradebot.trade_updates_handler(
+        None, "trade_updates", trade_update(event, "1", "1")))
+    assert sent == channels
+
+
+def test_parse_order():
+    assert order("Limit BUY 0010 aapl GTC 100.5") == {
+        "symbol": "AAPL", "qty": "10", "side": "buy", "type": "limit",
+        "time_in_force": "gtc", "limit_price": "100.5"}
+    assert order("stop_limit sell 1 X day 9 10") == {
+        "symbol": "X", "qty": "1", "side": "sell", "type": "stop_limit",
+        "time_in_force": "day", "limit_price": "9", "stop_price": "10"}
+
+
+@pytest.mark.parametrize("text, problem", [
+    ("bogus buy 1 X day", "unknown order type"),
+    ("market buy 1 X", "market orders take 5 arguments"),
+    ("market hold 1 X day", "bad side hold"),
+    ("market buy 000 X day", "bad quantity 000"),
+    ("market buy 1.5 X day", "bad quantity 1.5"),
+    ("market buy 1 X week", "bad time in force week"),
+    ("limit buy 1 X day nan", "bad price nan"),
+    ("limit buy 1 X day -1", "bad price -1"),
+])
+def test_parse_order_problems(text, problem):
+    with pytest.raises(ValueError, match=problem):
+        order(text)
+
+
+# Orders submitted in the same instant as the last one on a page are
+# neither skipped nor listed twice
+def test_list_all_orders_pages_across_equal_times():
+    rest = tradebot.AsyncREST("key", "secret", "https://api.example",
+                              "https://data.example", "https://api.example")
+    base = 1600000000
+    times = [base + i // 7 for i in range(1203)]
+    stored = [tradebot.entity.Order({
+        "id": str(i), "submitted_at": tradebot.pd.Timestamp(
+            t, unit="s", tz="UTC").isoformat().replace("+00:00", "Z")})
+        for i, t in enumerate(times)]
+    calls = []
+
+    async def list_orders(status=None, limit=None, until=None,
+                          direction=None, symbols=None):
+        calls.append(until)
+        found = [x for x in stored if until is None
+                 or tradebot.pd.Timestamp(x.submitted_at)
+                 < tradebot.pd.Timestamp(until)]
+        found.sort(key=lambda x: x.submitted_at, reverse=True)
+        return found[:limit]
+    rest.list_orders = list_orders
+    orders = asyncio.run(rest.list_all_orders(status="all"))
+    assert sorted(int(x.id) for x in orders) == list(range(1203))
+    assert len(calls) == 3
@@ -1,88 +1,3074 @@
-from flask import Flask, request
-import alpaca_trade_api as tradeapi
-import requests
 import asyncio
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import csv
+import datetime
+import difflib
+import functools
+import hashlib
+import heapq
+import importlib
+import itertools
 import json
+import logging
 import os
-import multiprocessing
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+import urllib.parse
 
 
+# Heavy imports
+
+# alpaca_trade_api (which brings in pandas), aiohttp and Flask make up most of
+# the time it takes to import tradebot, and none of them is needed before the
+# first broker call, Slack message or Flask request.  They are imported on
+# first use through LazyModule, and warm_up() imports them in the background
+# as soon as the bot starts.
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+
+tradeapi = LazyModule("alpaca_trade_api")
+polygon = LazyModule("alpaca_trade_api.polygon")
+entity = LazyModule("alpaca_trade_api.entity")
+common = LazyModule("alpaca_trade_api.common")
+stream2 = LazyModule("alpaca_trade_api.stream2")
+aiohttp = LazyModule("aiohttp")
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+
 # Constants used throughout the script (names are self-explanatory)
 WRONG_NUM_ARGS = "ERROR: Incorrect amount of args.  Action did not complete."
 BAD_ARGS = "ERROR: Request error.  Action did not complete."
+BUSY = "Tradebot is busy right now.  Please try again in a moment."
 KEY_ID = ""  # Your API Key ID
 SECRET_KEY = ""  # Your Secret Key
 SLACK_TOKEN = ""  # Slack OAuth Access Token
 CHANNEL = ""
 
-config = {
-    "key_id": os.environ.get("KEY_ID", KEY_ID),
-    "secret_key": os.environ.get("SECRET_KEY", SECRET_KEY),
-    "base_url": os.environ.get("BASE_URL", "https://paper-api.alpaca.markets"),
-    "slack_token": os.environ.get("SLACK_TOKEN", SLACK_TOKEN),
-    "channel": os.environ.get("CHANNEL", CHANNEL)
-}
+config = {
+    "key_id": os.environ.get("KEY_ID", KEY_ID),
+    "secret_key": os.environ.get("SECRET_KEY", SECRET_KEY),
+    "base_url": os.environ.get("BASE_URL", "https://paper-api.alpaca.markets"),
+    "data_url": os.environ.get("DATA_URL", "https://data.alpaca.markets"),
+    "polygon_url": os.environ.get("POLYGON_URL", "https://api.polygon.io"),
+    "alpaca_pool_size": int(os.environ.get("ALPACA_POOL_SIZE", 20)),
+    # Alpaca requests allowed per minute across the whole process, and how
+    # many may go out back to back
+    "alpaca_rate_limit": int(os.environ.get("ALPACA_RATE_LIMIT", 200)),
+    "alpaca_burst": int(os.environ.get("ALPACA_BURST", 20)),
+    "slack_token": os.environ.get("SLACK_TOKEN", SLACK_TOKEN),
+    "channel": os.environ.get("CHANNEL", CHANNEL),
+    "slack_api_url": os.environ.get("SLACK_API_URL", "https://slack.com/api"),
+    # Slack outbox tuning: connections kept alive in the pool, messages
+    # allowed to wait in the send queue, and attempts per message
+    "slack_pool_size": int(os.environ.get("SLACK_POOL_SIZE", 10)),
+    "slack_queue_size": int(os.environ.get("SLACK_QUEUE_SIZE", 1000)),
+    "slack_max_retries": int(os.environ.get("SLACK_MAX_RETRIES", 5)),
+    # Job executor tuning: jobs run at once and jobs allowed to wait
+    "job_workers": int(os.environ.get("JOB_WORKERS", 32)),
+    "job_queue_size": int(os.environ.get("JOB_QUEUE_SIZE", 100)),
+    # Longest wait, in seconds, between attempts to reconnect the stream
+    "stream_max_backoff": float(os.environ.get("STREAM_MAX_BACKOFF", 60)),
+    # Seconds the fills of one order are gathered before its Slack message
+    # is updated
+    "fill_window": float(os.environ.get("FILL_WINDOW", 1)),
+    # Shortest time, in seconds, between two market data digests of a symbol
+    "digest_interval": float(os.environ.get("DIGEST_INTERVAL", 60)),
+    # Last-price cache: seconds a price stays fresh, and symbols kept
+    "price_ttl": float(os.environ.get("PRICE_TTL", 15)),
+    "price_cache_size": int(os.environ.get("PRICE_CACHE_SIZE", 5000)),
+    # Seconds between refreshes of the asset list symbols are checked against
+    "asset_refresh_interval": float(
+        os.environ.get("ASSET_REFRESH_INTERVAL", 3600)),
+    # Polygon quotes fetched at once by /get_price_polygon, and seconds
+    # allowed for each
+    "quote_concurrency": int(os.environ.get("QUOTE_CONCURRENCY", 10)),
+    "quote_timeout": float(os.environ.get("QUOTE_TIMEOUT", 5)),
+    # Orders /clear sends at once when the bulk endpoints are unavailable
+    "clear_concurrency": int(os.environ.get("CLEAR_CONCURRENCY", 10)),
+    # Pre-trade risk limits, each 0 (or RISK_BUYING_POWER=0) for none: the
+    # most an order and a position in one symbol may be worth, orders a user
+    # may place a minute, how far (as a fraction) a limit or stop price may
+    # be from the last price, and whether buys must fit the buying power
+    "risk_max_order_value": float(os.environ.get("RISK_MAX_ORDER_VALUE", 0)),
+    "risk_max_position_value": float(
+        os.environ.get("RISK_MAX_POSITION_VALUE", 0)),
+    "risk_max_orders_per_minute": int(
+        os.environ.get("RISK_MAX_ORDERS_PER_MINUTE", 0)),
+    "risk_price_band": float(os.environ.get("RISK_PRICE_BAND", 0)),
+    "risk_buying_power": os.environ.get("RISK_BUYING_POWER", "0") == "1",
+    # Largest /order_basket accepted, and orders it submits at once
+    "basket_max_orders": int(os.environ.get("BASKET_MAX_ORDERS", 500)),
+    "basket_concurrency": int(os.environ.get("BASKET_CONCURRENCY", 20)),
+    # Orders or positions on each page of /list
+    "list_page_size": int(os.environ.get("LIST_PAGE_SIZE", 50)),
+    # Seconds a Slack delivery is remembered, so a retry of it is dropped
+    "dedupe_ttl": float(os.environ.get("DEDUPE_TTL", 600)),
+    # File to journal slash commands and trade_updates events to, for
+    # replay.py; empty to not record
+    "record_path": os.environ.get("RECORD_PATH", ""),
+    # SQLite file the workers of a multi-worker deployment share state
+    # through, and seconds a worker holds the stream connection without
+    # renewing its claim; empty to run as a single process
+    "shared_state_path": os.environ.get("SHARED_STATE_PATH", ""),
+    "shared_lease_ttl": float(os.environ.get("SHARED_LEASE_TTL", 5)),
+    # SQLite file every trade_updates event is kept in, for /history; empty
+    # (the default) to keep no history
+    "history_path": os.environ.get("HISTORY_PATH", ""),
+    # Most price alerts kept at once, across all users
+    "alerts_max": int(os.environ.get("ALERTS_MAX", 50000)),
+    # Seconds between P&L posts to CHANNEL; 0 to not post them
+    "pnl_interval": float(os.environ.get("PNL_INTERVAL", 0)),
+    # Import modules and open connections in the background at startup
+    "warm_up": os.environ.get("WARM_UP", "1") == "1",
+    # Serve read commands from an account mirror kept current by
+    # trade_updates, reconciled against REST every so many seconds
+    "state_mirror": os.environ.get("STATE_MIRROR", "1") == "1",
+    "state_reconcile_interval": float(
+        os.environ.get("STATE_RECONCILE_INTERVAL", 60)),
+}
+
+# Background event loop
+
+# All network I/O (Slack delivery, broker calls, background jobs) runs on one
+# long-lived event loop.  Under Flask it lives in a daemon thread, created on
+# first use (and again in a forked child process, since threads do not survive
+# a fork); under an ASGI server it is the server's own loop.
+_loop = None
+_loop_pid = None
+_loop_lock = threading.Lock()
+
+
+def bot_loop():
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(
+                target=_loop.run_forever,
+                name="tradebot-loop",
+                daemon=True).start()
+        return _loop
+
+# Adopts the running loop as the bot loop (called by the ASGI entry point).
+
+
+def use_loop(loop):
+    global _loop, _loop_pid
+    with _loop_lock:
+        _loop = loop
+        _loop_pid = os.getpid()
+
+# Runs a coroutine on the bot loop and waits for its result; this is how
+# Flask's worker threads call into the async command handlers.
+
+
+def run_sync(coro):
+    return asyncio.run_coroutine_threadsafe(coro, bot_loop()).result()
+
+# Metrics
+
+# Counters, gauges and latency histograms, served at /metrics in the
+# Prometheus text format.  Every metric is declared up front below; counters
+# and histograms are updated where things happen, while gauges (and counters
+# something else already keeps) are read through a callback at scrape time.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+
+
+class Metrics:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._kinds = {}
+        self._values = {}
+        self._callbacks = {}
+        self._lock = threading.Lock()
+
+    def declare(self, name, kind, help):
+        self._kinds[name] = (kind, help)
+        self._values[name] = {}
+
+    # Reads a metric's value(s) at scrape time: func returns a number, or a
+    # {labels dict as a tuple of pairs: number} mapping.
+    def register(self, name, func):
+        self._callbacks[name] = func
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            values = self._values[name]
+            if key not in values:
+                values[key] = [[0] * len(self.buckets), 0.0, 0]
+            histogram = values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    # Observes how long the body of a with statement takes
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = []
+        for name, (kind, help) in self._kinds.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in self._callbacks:
+                try:
+                    values = self._callbacks[name]()
+                except Exception as e:
+                    logging.error(f"Metric {name} failed: {str(e)}")
+                    continue
+                if not isinstance(values, dict):
+                    values = {(): values}
+            else:
+                with self._lock:
+                    values = {k: v if kind != "histogram" else
+                              [list(v[0]), v[1], v[2]]
+                              for k, v in self._values[name].items()}
+            for labels, value in values.items():
+                if kind != "histogram":
+                    lines.append(f"{name}{metric_labels(labels)} {value:g}")
+                    continue
+                counts, total, count = value
+                for bound, n in zip(self.buckets, counts):
+                    le = labels + (("le", f"{bound:g}"),)
+                    lines.append(f"{name}_bucket{metric_labels(le)} {n}")
+                le = labels + (("le", "+Inf"),)
+                lines.append(f"{name}_bucket{metric_labels(le)} {count}")
+                lines.append(f"{name}_sum{metric_labels(labels)} {total:g}")
+                lines.append(f"{name}_count{metric_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def metric_labels(labels):
+    if len(labels) == 0:
+        return ""
+    pairs = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace(
+            '"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+metrics = Metrics()
+for name, kind, help in (
+    ("tradebot_command_seconds", "histogram",
+     "Time taken to answer a slash command"),
+    ("tradebot_command_errors_total", "counter",
+     "Slash commands that answered or replied with an error"),
+    ("tradebot_retried_deliveries_total", "counter",
+     "Slack retries of a slash command that were dropped"),
+    ("tradebot_busy_total", "counter",
+     "Slash commands turned away because the job queue was full"),
+    ("tradebot_job_seconds", "histogram",
+     "Time taken by a background job"),
+    ("tradebot_job_errors_total", "counter",
+     "Background jobs that raised"),
+    ("tradebot_job_queue_depth", "gauge",
+     "Jobs waiting for a worker"),
+    ("tradebot_alpaca_request_seconds", "histogram",
+     "Alpaca and Polygon HTTP request latency, per attempt"),
+    ("tradebot_alpaca_errors_total", "counter",
+     "Alpaca and Polygon requests that failed"),
+    ("tradebot_alpaca_retries_total", "counter",
+     "Alpaca and Polygon requests retried after a 429 or 504"),
+    ("tradebot_alpaca_rate_limit_wait_seconds_total", "counter",
+     "Time Alpaca requests spent waiting for the rate limiter"),
+    ("tradebot_alpaca_rate_limit_queued", "gauge",
+     "Alpaca requests waiting for the rate limiter"),
+    ("tradebot_slack_request_seconds", "histogram",
+     "Slack API request latency, per attempt"),
+    ("tradebot_slack_errors_total", "counter",
+     "Slack messages that could not be delivered or that Slack refused"),
+    ("tradebot_slack_retries_total", "counter",
+     "Slack API requests retried"),
+    ("tradebot_slack_delivery_seconds", "histogram",
+     "Time from queueing a Slack message to its delivery"),
+    ("tradebot_slack_queue_depth", "gauge",
+     "Slack messages waiting for delivery"),
+    ("tradebot_slack_dropped_total", "counter",
+     "Slack messages dropped because the outbox was full"),
+    ("tradebot_stream_events_total", "counter",
+     "Stream events received"),
+    ("tradebot_stream_lag_seconds", "histogram",
+     "Time from an event being produced to the bot receiving it"),
+    ("tradebot_stream_handler_seconds", "histogram",
+     "Time taken by a stream listener"),
+    ("tradebot_stream_handler_errors_total", "counter",
+     "Stream events whose listener raised"),
+    ("tradebot_stream_to_slack_seconds", "histogram",
+     "Time from an event being produced to its Slack message being delivered"),
+    ("tradebot_stream_connected", "gauge",
+     "Whether the stream connection is up"),
+    ("tradebot_stream_reconnects_total", "counter",
+     "Stream reconnections"),
+    ("tradebot_history_queue_depth", "gauge",
+     "Order events waiting to be written to the history"),
+    ("tradebot_history_dropped_total", "counter",
+     "Order events dropped because the history writer fell behind"),
+    ("tradebot_risk_rejections_total", "counter",
+     "Orders refused by a pre-trade risk check, by rule"),
+):
+    metrics.declare(name, kind, help)
+
+# Error from the broker, with the code and status_code of tradeapi's
+# APIError (defined here so raising one does not need tradeapi imported)
+
+
+class BrokerError(Exception):
+    def __init__(self, error, status):
+        super().__init__(error["message"])
+        self._error = error
+        self.status = status
+
+    @property
+    def code(self):
+        return self._error["code"]
+
+    @property
+    def status_code(self):
+        return self.status
+
+# Rate limiter
+
+# Alpaca allows a fixed number of requests per minute per account, and a few
+# busy /get_price users should not be able to spend them when /clear needs
+# them.  Every Alpaca request takes a token from one process-wide bucket; when
+# it runs dry, requests wait in priority order: cancels and liquidations
+# first, then new orders, then quotes and listings.  A 429 from Alpaca pauses
+# the bucket altogether.  Wait times are kept per priority for monitoring.
+PRIORITY_URGENT = 0
+PRIORITY_ORDER = 1
+PRIORITY_READ = 2
+PRIORITY_NAMES = ("urgent", "order", "read")
+
+
+class RateLimiter:
+    def __init__(self, rate_per_minute=200, burst=20):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst
+        self.tokens = burst
+        self.waits = {p: {"count": 0, "total": 0.0, "max": 0.0}
+                      for p in range(len(PRIORITY_NAMES))}
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = None
+
+    async def acquire(self, priority=PRIORITY_READ):
+        start = time.monotonic()
+        self._refill()
+        if (len(self._waiters) == 0 and self.tokens >= 1
+                and start >= self._paused_until):
+            self.tokens -= 1
+        else:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._seq), future))
+            self._schedule()
+            await future
+        waited = time.monotonic() - start
+        stats = self.waits[priority]
+        stats["count"] += 1
+        stats["total"] += waited
+        stats["max"] = max(stats["max"], waited)
+        return waited
+
+    # Stops handing out tokens for the given number of seconds
+    def pause(self, seconds):
+        self._paused_until = max(
+            self._paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _schedule(self):
+        if self._wakeup is not None:
+            return
+        now = time.monotonic()
+        delay = max(self._paused_until - now, (1 - self.tokens) / self.rate, 0)
+        self._wakeup = asyncio.get_running_loop().call_later(
+            delay, self._release)
+
+    def _release(self):
+        self._wakeup = None
+        self._refill()
+        while (len(self._waiters) > 0 and self.tokens >= 1
+               and time.monotonic() >= self._paused_until):
+            future = heapq.heappop(self._waiters)[2]
+            if future.done():
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+        if len(self._waiters) > 0:
+            self._schedule()
+
+# Non-blocking Alpaca client
+
+# tradeapi.REST is built on requests and blocks whichever thread calls it.
+# AsyncREST covers the endpoints the bot uses over one pooled aiohttp session
+# on the bot loop and returns the same entity objects, so commands can await
+# broker calls without holding anything else up.
+
+
+class AsyncREST:
+    def __init__(self, key_id, secret_key, base_url, data_url, polygon_url,
+                 pool_size=20, max_retries=3, retry_wait=3, limiter=None):
+        self.key_id = key_id
+        self.secret_key = secret_key
+        self.base_url = base_url.rstrip("/")
+        self.data_url = data_url.rstrip("/")
+        self.polygon_url = polygon_url.rstrip("/")
+        self.pool_size = pool_size
+        self.max_retries = max_retries
+        self.retry_wait = retry_wait
+        self.limiter = limiter
+        self.polygon = AsyncPolygon(self)
+        self._session = None
+        self._session_loop = None
+
+    # The pooled session is tied to the loop that created it.
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session_loop is not loop:
+            self._session_loop = loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    # Sends one request, retrying on 429/504 like tradeapi.REST does, and
+    # raises BrokerError for broker errors.  Alpaca requests go
+    # through the rate limiter at the given priority.  Metrics are kept per
+    # endpoint, which defaults to the URL's path.
+    async def _request(self, method, url, params=None, body=None,
+                       auth=True, priority=PRIORITY_READ, endpoint=None):
+        endpoint = endpoint or urllib.parse.urlparse(url).path
+        headers = {}
+        if auth:
+            headers["APCA-API-KEY-ID"] = self.key_id
+            headers["APCA-API-SECRET-KEY"] = self.secret_key
+        if params:
+            params = {k: str(v).lower() if isinstance(v, bool) else str(v)
+                      for k, v in params.items() if v is not None}
+        session = self._get_session()
+        limiter = self.limiter if auth else None
+        for attempt in range(self.max_retries + 1):
+            if limiter is not None:
+                await limiter.acquire(priority)
+            try:
+                with metrics.timer("tradebot_alpaca_request_seconds",
+                                   method=method, endpoint=endpoint):
+                    async with session.request(
+                            method, url, params=params, json=body,
+                            headers=headers, allow_redirects=False) as r:
+                        text = await r.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc("tradebot_alpaca_errors_total",
+                            endpoint=endpoint, status=type(e).__name__)
+                raise
+            if r.status in (429, 504) and attempt < self.max_retries:
+                metrics.inc("tradebot_alpaca_retries_total",
+                            endpoint=endpoint, status=r.status)
+                retry_after = float(
+                    r.headers.get("Retry-After", self.retry_wait))
+                if r.status == 429 and limiter is not None:
+                    limiter.pause(retry_after)
+                else:
+                    await asyncio.sleep(retry_after)
+                continue
+            if r.status >= 400:
+                metrics.inc("tradebot_alpaca_errors_total",
+                            endpoint=endpoint, status=r.status)
+                try:
+                    error = json.loads(text)
+                except ValueError:
+                    error = None
+                if not isinstance(error, dict) or "code" not in error:
+                    error = {"code": r.status,
+                             "message": error.get("message", text)
+                             if isinstance(error, dict) else text}
+                raise BrokerError(error, r.status)
+            return json.loads(text) if text else None
+
+    async def get(self, path, params=None):
+        return await self._request("GET", f"{self.base_url}/v2{path}", params)
+
+    async def post(self, path, body=None, priority=PRIORITY_ORDER):
+        return await self._request(
+            "POST", f"{self.base_url}/v2{path}", body=body, priority=priority)
+
+    async def delete(self, path, params=None, priority=PRIORITY_URGENT,
+                     endpoint=None):
+        return await self._request(
+            "DELETE", f"{self.base_url}/v2{path}", params, priority=priority,
+            endpoint=endpoint)
+
+    async def get_account(self):
+        return entity.Account(await self.get("/account"))
+
+    async def get_clock(self):
+        return entity.Clock(await self.get("/clock"))
+
+    async def list_positions(self):
+        return [entity.Position(p) for p in await self.get("/positions")]
+
+    async def list_assets(self, status=None, asset_class=None):
+        return [entity.Asset(a) for a in await self.get(
+            "/assets", {"status": status, "asset_class": asset_class})]
+
+    async def list_orders(self, status=None, limit=None, after=None,
+                          until=None, direction=None, symbols=None):
+        orders = await self.get("/orders", {
+            "status": status,
+            "limit": limit,
+            "after": after,
+            "until": until,
+            "direction": direction,
+            "symbols": ",".join(symbols) if symbols else None,
+        })
+        return [entity.Order(o) for o in orders]
+
+    # Every order with the given status, newest first.  Alpaca answers with
+    # at most 500 at a time, so this walks back through them by submission
+    # time.  until is exclusive, so each page asks up to just past the last
+    # one's oldest order, to include the orders submitted in the same
+    # instant, and drops the ones it already has.
+    async def list_all_orders(self, status=None, symbols=None):
+        orders, seen, until = [], set(), None
+        while True:
+            page = await self.list_orders(status=status, limit=500,
+                                          until=until, direction="desc",
+                                          symbols=symbols)
+            new = [x for x in page if x.id not in seen]
+            orders += new
+            seen.update(x.id for x in new)
+            if len(page) < 500 or len(new) == 0:
+                return orders
+            oldest = page[-1]._raw.get("submitted_at")
+            if oldest is None:
+                return orders
+            until = (pd.Timestamp(oldest)
+                     + pd.Timedelta(microseconds=1)).isoformat()
+
+    async def submit_order(self, symbol, qty, side, type, time_in_force,
+                           limit_price=None, stop_price=None,
+                           client_order_id=None, priority=PRIORITY_ORDER):
+        body = {
+            "symbol": symbol,
+            "qty": qty,
+            "side": side,
+            "type": type,
+            "time_in_force": time_in_force,
+        }
+        if limit_price is not None:
+            body["limit_price"] = common.FLOAT(limit_price)
+        if stop_price is not None:
+            body["stop_price"] = common.FLOAT(stop_price)
+        if client_order_id is not None:
+            body["client_order_id"] = client_order_id
+        try:
+            return entity.Order(await self.post("/orders", body, priority))
+        except BrokerError as e:
+            # A retried submission: the order went through the first time
+            if (client_order_id is not None and e.status == 422
+                    and "client_order_id" in str(e)):
+                return await self.get_order_by_client_order_id(client_order_id)
+            raise
+
+    async def get_order_by_client_order_id(self, client_order_id):
+        return entity.Order(await self.get(
+            "/orders:by_client_order_id", {"client_order_id": client_order_id}))
+
+    async def cancel_order(self, order_id):
+        await self.delete(f"/orders/{order_id}", endpoint="/v2/orders/{id}")
+
+    # Bulk endpoints: each returns one {"symbol"/"id", "status", "body"}
+    # entry per position closed or order canceled.
+    async def close_all_positions(self):
+        return await self.delete("/positions")
+
+    async def cancel_all_orders(self):
+        return await self.delete("/orders")
+
+    async def get_barset(self, symbols, timeframe, limit=None):
+        if not isinstance(symbols, str):
+            symbols = ",".join(symbols)
+        return entity.BarSet(await self._request(
+            "GET", f"{self.data_url}/v1/bars/{timeframe}",
+            {"symbols": symbols, "limit": limit}))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncPolygon:
+    def __init__(self, rest):
+        self.rest = rest
+
+    async def last_quote(self, symbol):
+        resp = await self.rest._request(
+            "GET", f"{self.rest.polygon_url}/v1/last_quote/stocks/{symbol}",
+            {"apiKey": self.rest.key_id}, auth=False,
+            endpoint="/v1/last_quote/stocks/{symbol}")
+        return polygon.entity.Quote(resp["last"])
+
+
+# Set up environment
+api = AsyncREST(
+    key_id=config.get('key_id'),
+    secret_key=config.get('secret_key'),
+    base_url=config.get('base_url'),
+    data_url=config.get('data_url'),
+    polygon_url=config.get('polygon_url'),
+    pool_size=config.get('alpaca_pool_size'),
+    limiter=RateLimiter(
+        rate_per_minute=config.get('alpaca_rate_limit'),
+        burst=config.get('alpaca_burst'),
+    ),
+)
+metrics.register(
+    "tradebot_alpaca_rate_limit_wait_seconds_total",
+    lambda: {(("priority", PRIORITY_NAMES[p]),): stats["total"]
+             for p, stats in api.limiter.waits.items()})
+metrics.register("tradebot_alpaca_rate_limit_queued",
+                 lambda: api.limiter.queued)
+
+# Shared state
+
+# Several workers (uvicorn --workers, gunicorn -w) can serve the same bot when
+# they share one SQLite database in WAL mode.  It holds the dedupe cache, the
+# streams Slack asked for and a lease naming the one worker (the leader) that
+# runs the stream connection.  The leader also publishes stream health and
+# the account mirror there for the others to read.  Each process opens its
+# own connection, used only from one thread of its own that the bot loop
+# hands every call to through run(), so a worker waiting its turn for the
+# database never holds up the loop.  Every statement is a short local
+# transaction.
+
+
+class SharedState:
+    def __init__(self, path, lease_ttl=5, interval=1):
+        self.path = path
+        self.lease_ttl = lease_ttl
+        self.interval = interval
+        self.leader = False
+        self._db = None
+        self._pid = None
+        self._executor = None
+        self._executor_pid = None
+
+    @property
+    def enabled(self):
+        return self.path != ""
+
+    def executor(self):
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor_pid = os.getpid()
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="tradebot-shared")
+        return self._executor
+
+    # Runs func(*args), one of the methods below, on the database thread
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor(), functools.partial(func, *args))
+
+    # The same without waiting for it, for writes nobody needs the answer of.
+    # Calls run in the order they are made.
+    def submit(self, func, *args):
+        def done(future):
+            if future.exception() is not None:
+                logging.error(f"Shared state write failed: {str(future.exception())}")
+        self.executor().submit(func, *args).add_done_callback(done)
+
+    @property
+    def worker(self):
+        return f"{os.uname().nodename}:{os.getpid()}"
+
+    def db(self):
+        if self._db is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self.leader = False
+            self._db = sqlite3.connect(
+                self.path, timeout=2, isolation_level=None,
+                check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY, holder TEXT, expires REAL);
+                CREATE TABLE IF NOT EXISTS deliveries (
+                    key TEXT PRIMARY KEY, at REAL);
+                CREATE INDEX IF NOT EXISTS deliveries_at ON deliveries (at);
+                CREATE TABLE IF NOT EXISTS streams (
+                    channel TEXT PRIMARY KEY, destination TEXT);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY, value TEXT, updated REAL);
+                CREATE TABLE IF NOT EXISTS mirror_orders (
+                    id TEXT PRIMARY KEY, raw TEXT);
+                CREATE TABLE IF NOT EXISTS mirror_positions (
+                    symbol TEXT PRIMARY KEY, raw TEXT);
+                CREATE TABLE IF NOT EXISTS alerts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, symbol TEXT,
+                    above INTEGER, threshold REAL, repeat INTEGER,
+                    expires REAL, channel TEXT, user TEXT);
+                CREATE TABLE IF NOT EXISTS routes (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT, channel TEXT,
+                    symbols TEXT, sides TEXT, events TEXT);
+            """)
+        return self._db
+
+    # Reads see one snapshot; writes take the lock up front
+    @contextlib.contextmanager
+    def transaction(self, write=True):
+        db = self.db()
+        db.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    # Takes or renews the named lease; True while this worker holds it
+    def lead(self, name):
+        now = time.time()
+        cursor = self.db().execute("""
+            INSERT INTO leases (name, holder, expires) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET
+                holder = excluded.holder, expires = excluded.expires
+            WHERE leases.holder = excluded.holder OR leases.expires < ?
+        """, (name, self.worker, now + self.lease_ttl, now))
+        return cursor.rowcount == 1
+
+    # True if key was seen in the last ttl seconds; otherwise remembers it
+    def seen(self, key, ttl):
+        now = time.time()
+        cursor = self.db().execute("""
+            INSERT INTO deliveries (key, at) VALUES (?, ?)
+            ON CONFLICT (key) DO UPDATE SET at = excluded.at
+            WHERE deliveries.at < ?
+        """, (key, now, now - ttl))
+        return cursor.rowcount == 0
+
+    def forget(self, ttl):
+        self.db().execute(
+            "DELETE FROM deliveries WHERE at < ?", (time.time() - ttl,))
+
+    # Streams Slack asked for, as {channel: channel to post digests to}
+    def streams(self):
+        return dict(self.db().execute(
+            "SELECT channel, destination FROM streams"))
+
+    def want(self, channel, destination):
+        self.db().execute(
+            "INSERT OR REPLACE INTO streams VALUES (?, ?)",
+            (channel, destination))
+
+    def unwant(self, channel):
+        self.db().execute("DELETE FROM streams WHERE channel = ?", (channel,))
+
+    def put(self, key, value, db=None):
+        (db or self.db()).execute(
+            "INSERT OR REPLACE INTO meta VALUES (?, ?, ?)",
+            (key, json.dumps(value), time.time()))
+
+    # A value the leader put, or None if it is more than a lease old
+    def get(self, key):
+        row = self.db().execute(
+            "SELECT value, updated FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None or time.time() - row[1] > self.lease_ttl:
+            return None
+        return json.loads(row[0])
+
+    # Replaces the published account mirror
+    def put_mirror(self, orders, positions, account):
+        with self.transaction() as db:
+            db.execute("DELETE FROM mirror_orders")
+            db.executemany("INSERT INTO mirror_orders VALUES (?, ?)", [
+                (o["id"], json.dumps(o)) for o in orders])
+            db.execute("DELETE FROM mirror_positions")
+            db.executemany("INSERT INTO mirror_positions VALUES (?, ?)", [
+                (p["symbol"], json.dumps(p)) for p in positions])
+            self.put("mirror", {"version": time.time_ns(),
+                                "account": account}, db)
+
+    # The published account mirror as (version, account, orders, positions),
+    # or None if there is none
+    def get_mirror(self):
+        with self.transaction(write=False) as db:
+            row = db.execute(
+                "SELECT value FROM meta WHERE key = 'mirror'").fetchone()
+            if row is None:
+                return None
+            mirror = json.loads(row[0])
+            orders = [json.loads(x) for (x,) in db.execute(
+                "SELECT raw FROM mirror_orders")]
+            positions = [json.loads(x) for (x,) in db.execute(
+                "SELECT raw FROM mirror_positions")]
+        return mirror["version"], mirror["account"], orders, positions
+
+    # Version of the published account mirror
+    def mirror_version(self):
+        row = self.db().execute(
+            "SELECT value FROM meta WHERE key = 'mirror'").fetchone()
+        return None if row is None else json.loads(row[0])["version"]
+
+    # Price alerts, as dicts of the alerts table's columns.  Ids are never
+    # reused, so (count, largest id) changes whenever the set does.
+    def add_alert(self, alert):
+        return self.db().execute("""
+            INSERT INTO alerts (symbol, above, threshold, repeat, expires,
+                channel, user) VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, tuple(alert[k] for k in ALERT_FIELDS[1:])).lastrowid
+
+    def remove_alert(self, id, user=None):
+        if user is None:
+            cursor = self.db().execute("DELETE FROM alerts WHERE id = ?", (id,))
+        else:
+            cursor = self.db().execute(
+                "DELETE FROM alerts WHERE id = ? AND user = ?", (id, user))
+        return cursor.rowcount == 1
+
+    def alerts(self, user=None):
+        query = f"SELECT {', '.join(ALERT_FIELDS)} FROM alerts"
+        if user is None:
+            rows = self.db().execute(query)
+        else:
+            rows = self.db().execute(query + " WHERE user = ?", (user,))
+        return [dict(zip(ALERT_FIELDS, row)) for row in rows]
+
+    def alerts_version(self):
+        return self.db().execute(
+            "SELECT COUNT(*), MAX(id) FROM alerts").fetchone()
+
+    # Routes of trade_updates events to channels, in the same way
+    def add_route(self, route):
+        return self.db().execute("""
+            INSERT INTO routes (channel, symbols, sides, events)
+            VALUES (?, ?, ?, ?)
+        """, tuple(route[k] for k in ROUTE_FIELDS[1:])).lastrowid
+
+    def remove_route(self, id, channel=None):
+        if channel is None:
+            cursor = self.db().execute("DELETE FROM routes WHERE id = ?", (id,))
+        else:
+            cursor = self.db().execute(
+                "DELETE FROM routes WHERE id = ? AND channel = ?", (id, channel))
+        return cursor.rowcount == 1
+
+    def routes(self, channel=None):
+        query = f"SELECT {', '.join(ROUTE_FIELDS)} FROM routes"
+        if channel is None:
+            rows = self.db().execute(query)
+        else:
+            rows = self.db().execute(query + " WHERE channel = ?", (channel,))
+        return [dict(zip(ROUTE_FIELDS, row)) for row in rows]
+
+    def routes_version(self):
+        return self.db().execute(
+            "SELECT COUNT(*), MAX(id) FROM routes").fetchone()
+
+
+ALERT_FIELDS = ("id", "symbol", "above", "threshold", "repeat", "expires",
+                "channel", "user")
+ROUTE_FIELDS = ("id", "channel", "symbols", "sides", "events")
+
+
+shared = SharedState(
+    config["shared_state_path"],
+    lease_ttl=config["shared_lease_ttl"],
+)
+
+# Recorder
+
+# With a path set, every slash command form (less Slack's verification token)
+# and every trade_updates event is appended to it as one line of compact JSON
+# with the time it arrived, so replay.py can play a trading day back.  Lines
+# are buffered and flushed every flush_interval seconds.
+
+
+class Recorder:
+    def __init__(self, path, flush_interval=1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._file = None
+        self._pid = None
+        self._flushing = False
+
+    def command(self, path, form):
+        form = {k: v for k, v in form.items() if k != "token"}
+        self._write({"t": time.time(), "command": path, "form": form})
+
+    def event(self, stream, data):
+        self._write({"t": time.time(), "stream": stream, "data": data._raw})
+
+    def _write(self, entry):
+        if not self.path:
+            return
+        if self._file is None or self._pid != os.getpid():
+            self._file = open(self.path, "a", encoding="utf-8")
+            self._pid = os.getpid()
+        self._file.write(json.dumps(
+            entry, separators=(",", ":"), default=str) + "\n")
+        if not self._flushing:
+            self._flushing = True
+            asyncio.get_running_loop().call_later(
+                self.flush_interval, self._flush)
+
+    def _flush(self):
+        self._flushing = False
+        self._file.flush()
+
+
+recorder = Recorder(config["record_path"])
+
+# Slack deliveries already handled
+
+# Slack retries a slash command it did not get an answer to in time, with the
+# same trigger_id, and a slow handler must not run (and trade) twice.
+# DedupeCache remembers keys for ttl seconds, dropping the oldest past
+# max_size, or keeps them in the shared store when there is one, since a
+# retry can land on another worker.
+
+
+class DedupeCache:
+    def __init__(self, ttl=600, max_size=10000, store=None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.store = store
+        self._seen = collections.OrderedDict()
+
+    # True if key was seen within ttl; otherwise remembers it.  A missing key
+    # is never a duplicate.
+    async def seen(self, key):
+        if key is None or key == "":
+            return False
+        if self.store is not None and self.store.enabled:
+            try:
+                return await self.store.run(self.store.seen, key, self.ttl)
+            except sqlite3.Error as e:
+                logging.error(f"Shared dedupe cache failed: {str(e)}")
+                return False
+        now = time.monotonic()
+        while len(self._seen) > 0:
+            oldest, at = next(iter(self._seen.items()))
+            if now - at <= self.ttl and len(self._seen) < self.max_size:
+                break
+            del self._seen[oldest]
+        if key in self._seen:
+            return True
+        self._seen[key] = now
+        return False
+
+
+deliveries = DedupeCache(ttl=config["dedupe_ttl"], store=shared)
+
+# Client order id for the index-th order placed by a slash command.  It is
+# derived from the delivery's trigger_id, so a retried delivery that gets
+# past the dedupe cache (after a restart, say) resubmits under the same id and
+# Alpaca refuses the duplicate.
+
+
+def client_order_id(form, index=0):
+    trigger_id = form.get("trigger_id")
+    if not trigger_id:
+        return None
+    digest = hashlib.sha1(f"{trigger_id}:{index}".encode("utf-8"))
+    return "tradebot-" + digest.hexdigest()[:32]
+
+# Slash command handlers are coroutines taking the command's form fields.
+# command() registers one under its path for both entry points: the ASGI app
+# awaits it on the bot loop, and the Flask view runs it there via run_sync.
+# Retried deliveries are answered with an empty acknowledgement; the first
+# delivery is still the one that replies.  Answers starting with ERROR count
+# as command errors, as do replies through reply_private.
+commands = {}
+
+
+def command(path):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def dispatch(form):
+            start_background()
+            recorder.command(path, form)
+            if await deliveries.seen(form.get("trigger_id")):
+                logging.info(f"Dropped retried delivery of {path}")
+                metrics.inc("tradebot_retried_deliveries_total", command=path)
+                return ""
+            with metrics.timer("tradebot_command_seconds", command=path):
+                try:
+                    text = await handler(form)
+                except Exception:
+                    metrics.inc("tradebot_command_errors_total", command=path)
+                    raise
+            if text and text.startswith("ERROR"):
+                metrics.inc("tradebot_command_errors_total", command=path)
+            return text
+        commands[path] = dispatch
+        return handler
+    return decorator
+
+# The Flask app (tradebot:app), which handles HTTP requests from Slack on
+# Flask's threads.  It is built on first use, so the ASGI entry point never
+# imports Flask.
+
+
+_flask_app = None
+
+
+def flask_app():
+    global _flask_app
+    if _flask_app is None:
+        from flask import Flask, request
+        app = Flask(__name__)
+        for path, dispatch in commands.items():
+            def view(dispatch=dispatch):
+                return run_sync(dispatch(request.form.to_dict())) or ""
+            app.add_url_rule(path, dispatch.__name__, view, methods=["POST"])
+        app.add_url_rule("/metrics", "metrics", metrics_view)
+        _flask_app = app
+        warm_up()
+    return _flask_app
+
+
+def __getattr__(name):
+    if name == "app":
+        return flask_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# Streams that can be subscribed to, besides market data streams: quotes,
+# trades and minute bars for a symbol (Q.AAPL, T.AAPL, AM.AAPL)
+streams = (
+    "trade_updates",
+)
+MARKET_DATA_STREAM = re.compile(r'^(Q|T|AM)\.([A-Z][A-Z0-9.]*)$')
+
+# Canonical name of a stream as typed by a user, or None if there is no
+# such stream
+
+
+def stream_name(stream):
+    if stream in streams:
+        return stream
+    kind, _, symbol = stream.partition(".")
+    stream = f"{kind.upper()}.{symbol.upper()}"
+    if MARKET_DATA_STREAM.match(stream):
+        return stream
+    return None
+
+
+# Slack outbox
+
+# Every message to Slack is queued here and delivered by the bot loop over a
+# pooled keep-alive connection, so handlers and stream listeners never wait on
+# Slack.  Messages are grouped into one lane per destination (a channel or a
+# response_url): a lane delivers its messages in order, and a 429 from Slack
+# pauses only that lane for as long as Retry-After asks.
+
+
+class SlackOutbox:
+    def __init__(self, token, api_url, pool_size=10, max_queue=1000,
+                 max_retries=5, idle_timeout=30):
+        self.token = token
+        self.api_url = api_url.rstrip("/")
+        self.pool_size = pool_size
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.idle_timeout = idle_timeout
+        self.dropped = 0
+        self._pid = None
+        self._reset()
+
+    # Lanes and the session belong to the bot loop of one process; a forked
+    # child starts over with its own.
+    def _reset(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending = 0
+            self._lock = threading.Lock()
+            self._session = None
+            self._session_loop = None
+            self._lanes = {}
+            self._not_before = {}
+
+    # Posts text to a channel through chat.postMessage.  For a message about
+    # a stream event, stream_event is the stream and the time the event was
+    # produced, to measure how long it took to reach Slack.  callback, if
+    # given, is called on the bot loop with Slack's answer (which holds the
+    # message's ts and channel id), or with None if delivery failed.
+    def post(self, channel, text, stream_event=None, callback=None, **fields):
+        return self._enqueue(channel, "chat.postMessage",
+                             dict(fields, channel=channel, text=text),
+                             stream_event, callback)
+
+    # Replaces the text of a posted message through chat.update.  channel and
+    # ts are from Slack's answer to the post; lane is the channel as given
+    # to post(), so the update is delivered after it.
+    def update(self, lane, channel, ts, text, stream_event=None, **fields):
+        return self._enqueue(lane, "chat.update",
+                             dict(fields, channel=channel, ts=ts, text=text),
+                             stream_event)
+
+    # Replies through a slash command's response_url (only visible to the
+    # user who ran the command, unless told otherwise).
+    def respond(self, response_url, text, **fields):
+        return self._enqueue(response_url, response_url,
+                             dict(fields, text=text))
+
+    # Queues one message for delivery; returns False (and drops it) when the
+    # outbox is already holding max_queue messages.
+    def _enqueue(self, lane, method, body, stream_event=None, callback=None):
+        if not lane:
+            return False
+        self._reset()
+        with self._lock:
+            if self._pending >= self.max_queue:
+                self.dropped += 1
+                logging.warning(f"Slack outbox full, dropping message to {lane}")
+                return False
+            self._pending += 1
+        message = (method, body, time.monotonic(), stream_event, callback)
+        bot_loop().call_soon_threadsafe(self._route, lane, message)
+        return True
+
+    def _route(self, lane, message):
+        pending = self._lanes.get(lane)
+        if pending is None:
+            pending = self._lanes[lane] = asyncio.Queue()
+            asyncio.ensure_future(self._drain(lane, pending))
+        pending.put_nowait(message)
+
+    # Delivers one lane's messages in order; the lane goes away after sitting
+    # idle for idle_timeout seconds.
+    async def _drain(self, lane, pending):
+        while True:
+            try:
+                method, body, queued, stream_event, callback = (
+                    await asyncio.wait_for(pending.get(), self.idle_timeout))
+            except asyncio.TimeoutError:
+                if pending.empty():
+                    del self._lanes[lane]
+                    self._not_before.pop(lane, None)
+                    return
+                continue
+            result = None
+            try:
+                result = await self._deliver(lane, method, body)
+                metrics.observe("tradebot_slack_delivery_seconds",
+                                time.monotonic() - queued,
+                                method=slack_method(method))
+                if stream_event is not None and stream_event[1] is not None:
+                    metrics.observe("tradebot_stream_to_slack_seconds",
+                                    time.time() - stream_event[1],
+                                    stream=stream_event[0])
+            except Exception as e:
+                metrics.inc("tradebot_slack_errors_total",
+                            method=slack_method(method))
+                logging.error(f"Slack delivery to {lane} failed: {str(e)}")
+            finally:
+                with self._lock:
+                    self._pending -= 1
+            if callback is not None:
+                try:
+                    callback(result)
+                except Exception:
+                    logging.exception(f"Slack delivery callback for {lane} failed")
+
+    async def _deliver(self, lane, method, body):
+        session = self._get_session()
+        if method.startswith("http"):
+            url, headers = method, {}
+        else:
+            url = f"{self.api_url}/{method}"
+            headers = {"Authorization": f"Bearer {self.token}"}
+        for attempt in range(self.max_retries):
+            wait = self._not_before.get(lane, 0) - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            if attempt > 0:
+                metrics.inc("tradebot_slack_retries_total",
+                            method=slack_method(method))
+            try:
+                with metrics.timer("tradebot_slack_request_seconds",
+                                   method=slack_method(method)):
+                    async with session.post(
+                            url, json=body, headers=headers) as r:
+                        result = None
+                        if (r.status < 400
+                                and r.content_type == "application/json"):
+                            result = await r.json()
+                if r.status == 429:
+                    retry_after = float(r.headers.get("Retry-After", 1))
+                    self._not_before[lane] = time.monotonic() + retry_after
+                    continue
+                if r.status >= 500:
+                    raise aiohttp.ClientResponseError(
+                        r.request_info, r.history, status=r.status)
+                if result is not None and not result.get("ok", True):
+                    metrics.inc("tradebot_slack_errors_total",
+                                method=slack_method(method))
+                    logging.error(
+                        f"Slack {method} error: {result.get('error')}")
+                    return None
+                return result
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logging.warning(f"Slack {lane}: {str(e)}, retrying")
+                await asyncio.sleep(min(2 ** attempt, 30))
+        raise RuntimeError(f"gave up after {self.max_retries} attempts")
+
+    # Opens a pooled connection to the Web API ahead of the first message
+    async def warm_up(self):
+        async with self._get_session().post(
+                f"{self.api_url}/auth.test", json={},
+                headers={"Authorization": f"Bearer {self.token}"}) as r:
+            await r.read()
+
+    # Yields the lines of a file shared in Slack.  Nothing but Slack's own
+    # file URLs is fetched, so the token goes nowhere else and the bot cannot
+    # be pointed at other hosts.
+    async def file_lines(self, url):
+        if not slack_file_url(url):
+            raise ValueError("only files shared in Slack can be read")
+        headers = {"Authorization": f"Bearer {self.token}"}
+        async with self._get_session().get(
+                url, headers=headers, allow_redirects=False) as r:
+            r.raise_for_status()
+            if r.status != 200:
+                raise RuntimeError(f"Slack answered {r.status} for the file")
+            async for line in r.content:
+                yield line.decode("utf-8")
+
+    # Uploads text as a file to a channel (by id), through Slack's external
+    # upload: ask for an upload URL, send the file there, then share it.
+    async def upload(self, channel, filename, content, comment=None):
+        session = self._get_session()
+        headers = {"Authorization": f"Bearer {self.token}"}
+        data = content.encode("utf-8")
+
+        async def call(method, fields):
+            async with session.post(f"{self.api_url}/{method}", data=fields,
+                                    headers=headers) as r:
+                r.raise_for_status()
+                result = await r.json(content_type=None)
+            if not result.get("ok"):
+                raise RuntimeError(f"Slack {method}: {result.get('error')}")
+            return result
+        with metrics.timer("tradebot_slack_request_seconds",
+                           method="files.upload"):
+            ticket = await call("files.getUploadURLExternal",
+                                {"filename": filename, "length": len(data)})
+            async with session.post(ticket["upload_url"], data=data) as r:
+                r.raise_for_status()
+            fields = {"files": json.dumps([{"id": ticket["file_id"],
+                                            "title": filename}]),
+                      "channel_id": channel}
+            if comment:
+                fields["initial_comment"] = comment
+            await call("files.completeUploadExternal", fields)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    # The pooled session is tied to the loop that created it.
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session_loop is not loop:
+            self._session_loop = loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_size, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=15))
+        return self._session
+
+
+slack = SlackOutbox(
+    config["slack_token"],
+    config["slack_api_url"],
+    pool_size=config["slack_pool_size"],
+    max_queue=config["slack_queue_size"],
+    max_retries=config["slack_max_retries"],
+)
+
+
+metrics.register("tradebot_slack_queue_depth", lambda: slack._pending)
+metrics.register("tradebot_slack_dropped_total", lambda: slack.dropped)
+
+# True for an https URL on slack.com or one of its subdomains, such as a
+# file's url_private on files.slack.com
+
+
+def slack_file_url(url):
+    parts = urllib.parse.urlparse(url)
+    host = (parts.hostname or "").lower()
+    return (parts.scheme == "https"
+            and (host == "slack.com" or host.endswith(".slack.com")))
+
+# Metrics label for a Slack message's method: the Web API method, or
+# response_url for replies to a slash command
+
+
+def slack_method(method):
+    return "response_url" if method.startswith("http") else method
+
+
+def reply_private(form, text):
+    if text.startswith("ERROR"):
+        metrics.inc("tradebot_command_errors_total",
+                    command=form.get("command", ""))
+    slack.respond(form.get("response_url"), text)
+
+# Job executor
+
+# Slack gives a slash command 3 seconds to answer, which a broker round-trip
+# can easily eat.  Handlers therefore queue the slow part of a command as a
+# job and return immediately; a fixed number of workers on the bot loop run
+# the jobs and report back through the Slack outbox.  Once max_queue jobs
+# are waiting, new commands are turned away instead of piling up behind them.
+
+
+class JobExecutor:
+    def __init__(self, workers=32, max_queue=100):
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queued = 0
+        self._lock = threading.Lock()
+        self._queue = None
+
+    # Number of jobs waiting for a worker
+    @property
+    def depth(self):
+        return self._queued
+
+    # Queues the coroutine function func(*args) from any thread; returns
+    # False when the queue is full.
+    def submit(self, func, *args):
+        with self._lock:
+            if self._queued >= self.max_queue:
+                return False
+            self._queued += 1
+        bot_loop().call_soon_threadsafe(self._put, (func, args))
+        return True
+
+    def _put(self, job):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            for i in range(self.workers):
+                asyncio.ensure_future(self._work())
+        self._queue.put_nowait(job)
+
+    async def _work(self):
+        while True:
+            func, args = await self._queue.get()
+            with self._lock:
+                self._queued -= 1
+            try:
+                with metrics.timer("tradebot_job_seconds", job=func.__name__):
+                    await func(*args)
+            except Exception as e:
+                metrics.inc("tradebot_job_errors_total", job=func.__name__)
+                logging.error(f"Job {func.__name__} failed: {str(e)}")
+
+
+jobs = JobExecutor(
+    workers=config["job_workers"],
+    max_queue=config["job_queue_size"],
+)
+metrics.register("tradebot_job_queue_depth", lambda: jobs.depth)
+
+# Awaits func(item) for every item, at most limit at a time and each within
+# timeout seconds.  Results come back in order, with the exception in place
+# of any call that failed.
+
+
+async def fan_out(func, items, limit, timeout=None):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def call(item):
+        async with semaphore:
+            return await asyncio.wait_for(func(item), timeout)
+    return await asyncio.gather(*map(call, items), return_exceptions=True)
+
+# Short description of a failed call for a Slack reply
+
+
+def describe_error(e):
+    if isinstance(e, asyncio.TimeoutError):
+        return "timed out"
+    return str(e)
+
+# Queues a job and gives the slash command its immediate answer
+
+
+def submit_job(func, *args):
+    if not jobs.submit(func, *args):
+        metrics.inc("tradebot_busy_total")
+        return BUSY
+    return ""
+
+# Stream supervisor
+
+# A single StreamConn, running on the bot loop, carries every stream the bot
+# listens to.  subscribe() and unsubscribe() only change the set of wanted
+# channels; the supervisor task brings the live connection in line with it,
+# and when the connection drops it reconnects with exponential backoff and
+# resubscribes to everything that is still wanted.
+
+
+class StreamSupervisor:
+    def __init__(self, make_conn, max_backoff=60, check_interval=1):
+        self.make_conn = make_conn
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self.owners = {}
+        self.stats = {}
+        self.connected = False
+        self.reconnects = 0
+        self.generation = 0
+        self._handlers = {}
+        self._subscribed = set()
+        self._changed = None
+        self._task = None
+
+    # Registers a stream listener, like StreamConn.on
+    def on(self, channel_pat):
+        def decorator(func):
+            self._handlers[channel_pat] = func
+            return func
+        return decorator
+
+    # Channels are subscribed on behalf of owners ("slack" for the channels
+    # users asked for, or a part of the bot that needs the events itself) and
+    # stay subscribed while any owner still wants them.
+    @property
+    def channels(self):
+        return set(self.owners)
+
+    def wanted_by(self, channel, owner):
+        return owner in self.owners.get(channel, ())
+
+    def subscribe(self, channel, owner="slack"):
+        owners = self.owners.setdefault(channel, set())
+        if len(owners) == 0:
+            self.stats[channel] = {"events": 0, "last_event": None, "lag": None}
+            self._kick()
+        owners.add(owner)
+
+    def unsubscribe(self, channel, owner="slack"):
+        owners = self.owners.get(channel)
+        if owners is None:
+            return
+        owners.discard(owner)
+        if len(owners) == 0:
+            del self.owners[channel]
+            self.stats.pop(channel, None)
+            self._kick()
+
+    def _kick(self):
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        self._changed.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def _run(self):
+        backoff = 1
+        while self.channels:
+            conn = None
+            try:
+                conn = self._connect()
+                self._subscribed = set()
+                await self._sync(conn)
+                self.connected = True
+                self.generation += 1
+                backoff = 1
+                while self.channels and self._alive(conn):
+                    try:
+                        await asyncio.wait_for(
+                            self._changed.wait(), self.check_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    self._changed.clear()
+                    await self._sync(conn)
+            except Exception as e:
+                logging.error(f"Stream connection failed: {str(e)}")
+            finally:
+                self.connected = False
+                try:
+                    if conn is not None:
+                        await conn.close(False)
+                except Exception:
+                    pass
+            if not self.channels:
+                break
+            self.reconnects += 1
+            await asyncio.sleep(backoff + random.uniform(0, backoff / 2))
+            backoff = min(backoff * 2, self.max_backoff)
+
+    def _connect(self):
+        conn = self.make_conn()
+        for pattern, handler in self._handlers.items():
+            conn.register(pattern, self._listener(handler))
+        return conn
+
+    # Brings the connection's subscriptions in line with self.channels.
+    # StreamConn cannot unlisten trading channels, so events for those are
+    # dropped by the listener instead.
+    async def _sync(self, conn):
+        added = self.channels - self._subscribed
+        removed = self._subscribed - self.channels
+        if added:
+            await conn.subscribe(sorted(added))
+        if removed:
+            await conn.unsubscribe(sorted(removed))
+        self._subscribed = set(self.channels)
+
+    # StreamConn gives up on a dropped socket quietly, so liveness is read
+    # off each socket that has streams: it is gone, or the task reading it
+    # has ended.
+    @staticmethod
+    def _alive(conn):
+        for ws in (conn.trading_ws, conn.data_ws):
+            if not getattr(ws, "_streams", None):
+                continue
+            task = getattr(ws, "_consume_task", None)
+            if task is not None and task.done():
+                if not task.cancelled() and task.exception() is not None:
+                    logging.error(f"Stream reader failed: {str(task.exception())}")
+                return False
+            if getattr(ws, "_ws", 1) is None:
+                return False
+        return True
+
+    def _listener(self, handler):
+        async def listener(conn, channel, data):
+            stats = self.stats.get(channel)
+            if stats is None:
+                return
+            now = time.time()
+            stats["events"] += 1
+            stats["last_event"] = now
+            stream = channel.split(".")[0]
+            metrics.inc("tradebot_stream_events_total", stream=stream)
+            sent = event_time(data)
+            if sent is not None:
+                stats["lag"] = now - sent
+                metrics.observe("tradebot_stream_lag_seconds", now - sent,
+                                stream=stream)
+            # An exception here would end StreamConn's reader and, with it,
+            # the stream
+            try:
+                with metrics.timer("tradebot_stream_handler_seconds",
+                                   stream=stream):
+                    await handler(conn, channel, data)
+            except Exception:
+                metrics.inc("tradebot_stream_handler_errors_total",
+                            stream=stream)
+                logging.exception(f"{channel} listener failed")
+        return listener
+
+    # One line per active channel with its event count, age of the last
+    # event and how far behind the exchange it was delivered.
+    def health(self):
+        now = time.time()
+        lines = []
+        for channel in sorted(self.channels):
+            stats = self.stats[channel]
+            line = f'{channel}: {stats["events"]} events'
+            if not self.wanted_by(channel, "slack"):
+                line = f'{channel} (internal): {stats["events"]} events'
+            if stats["last_event"] is not None:
+                line += f', last {now - stats["last_event"]:.0f}s ago'
+            if stats["lag"] is not None:
+                line += f', lag {stats["lag"]:.2f}s'
+            lines.append(line)
+        state = ("down, reconnecting", "up")[self.connected]
+        lines.append(f'Connection {state}, {self.reconnects} reconnect(s)')
+        return lines
+
+# When an event was produced, when it says so.  Trade, quote and bar events
+# carry Unix milliseconds, which the library's Trade and Quote entities read
+# as nanoseconds, so the raw value is converted here, in the exchange's time
+# zone like the bars from REST; order updates carry an ISO time.
+
+
+def event_timestamp(data):
+    raw = getattr(data, "_raw", None)
+    if isinstance(raw, dict):
+        ts = raw.get("timestamp")
+    else:
+        ts = getattr(data, "timestamp", None)
+    if ts is None:
+        return None
+    try:
+        if isinstance(ts, (int, float)):
+            return pd.Timestamp(ts, unit="ms", tz="UTC").tz_convert(
+                "America/New_York")
+        return pd.Timestamp(ts)
+    except (TypeError, ValueError):
+        return None
+
+# Time an event was produced, in seconds since the epoch, when it says so
+
+
+def event_time(data):
+    ts = event_timestamp(data)
+    return ts.timestamp() if ts is not None else None
+
+
+# A StreamConn whose sockets leave reconnecting to the supervisor.  After a
+# drop, StreamConn's own retry loop would race the supervisor with a second
+# socket (and raise, once out of retries, in a task nobody awaits); these
+# sockets connect as usual the first time and stay down after a drop.
+
+
+@functools.lru_cache(maxsize=None)
+def supervised_socket():
+    class SupervisedSocket(stream2._StreamConn):
+        async def _ensure_ws(self):
+            if self._consume_task is None:
+                await super()._ensure_ws()
+    return SupervisedSocket
+
+
+def stream_conn():
+    conn = tradeapi.StreamConn(
+        key_id=config.get('key_id'),
+        secret_key=config.get('secret_key'),
+        base_url=config.get('base_url'),
+        data_url=config.get('data_url'),
+    )
+    key_id, secret_key, oauth = common.get_credentials(
+        config.get('key_id'), config.get('secret_key'))
+    conn.trading_ws = supervised_socket()(
+        key_id, secret_key, config.get('base_url'), oauth)
+    conn.data_ws = supervised_socket()(
+        key_id, secret_key, config.get('data_url'), oauth)
+    return conn
+
+
+supervisor = StreamSupervisor(
+    stream_conn,
+    max_backoff=config["stream_max_backoff"],
+)
+metrics.register("tradebot_stream_connected",
+                 lambda: int(supervisor.connected))
+metrics.register("tradebot_stream_reconnects_total",
+                 lambda: supervisor.reconnects)
+
+# Account mirror
+
+# Open orders, positions and the account, seeded from REST and then kept up
+# to date from trade_updates events, so the read commands can answer from
+# memory.  The mirror subscribes to trade_updates on its own behalf and is
+# only trusted while the stream connection it was seeded against is up; a
+# reconnect (when events may have been missed) triggers a reseed, and a
+# background task reconciles it against REST every reconcile_interval
+# seconds.  Until it is trusted, callers fall back to REST.
+#
+# With shared state, only the leader keeps the mirror, and publishes it (a
+# moment after each change) for the other workers to load.
+
+
+class AccountMirror:
+    def __init__(self, enabled=True, reconcile_interval=60,
+                 publish_delay=0.05):
+        self.enabled = enabled
+        self.reconcile_interval = reconcile_interval
+        self.publish_delay = publish_delay
+        self.orders = {}
+        self.positions = {}
+        self.account = None
+        self._generation = None
+        self._task = None
+        self._version = None
+        self._publishing = False
+        self._pending = None
+        self._published = False
+
+    def ready(self):
+        if not self.enabled:
+            return False
+        if shared.enabled and not shared.leader:
+            return self._published
+        if self._task is None:
+            supervisor.subscribe("trade_updates", "mirror")
+            self._task = asyncio.ensure_future(self._reconcile())
+        return self.trusted
+
+    @property
+    def trusted(self):
+        return (self._generation == supervisor.generation
+                and supervisor.connected)
+
+    # Stops keeping the mirror, when this worker is no longer the leader
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            supervisor.unsubscribe("trade_updates", "mirror")
+        self._generation = None
+        self._pending = None
+
+    def _publish_soon(self):
+        if shared.enabled and not self._publishing:
+            self._publishing = True
+            asyncio.get_running_loop().call_later(
+                self.publish_delay,
+                lambda: asyncio.ensure_future(self._publish()))
+
+    async def _publish(self):
+        self._publishing = False
+        try:
+            await shared.run(
+                shared.put_mirror,
+                [o._raw for o in self.orders.values()],
+                [p._raw for p in self.positions.values()],
+                self.account._raw if self.account is not None else None)
+        except sqlite3.Error as e:
+            logging.error(f"Publishing the account mirror failed: {str(e)}")
+
+    # Loads the leader's mirror, if it changed, on the other workers.
+    # coordinate() calls it every second, and ready() answers from the last
+    # load, so commands never wait on the database.
+    async def load(self):
+        trusted, published = await shared.run(self._read, self._version)
+        if published is not None:
+            self._version, account, orders, positions = published
+            self.orders = {o["id"]: entity.Order(o) for o in orders}
+            self.positions = {p["symbol"]: entity.Position(p)
+                              for p in positions}
+            self.account = (entity.Account(account)
+                            if account is not None else None)
+        self._published = trusted
+
+    # Whether the leader trusts its mirror, and the mirror if it is newer
+    # than version (on the database thread)
+    @staticmethod
+    def _read(version):
+        if not shared.get("mirror_trusted"):
+            return False, None
+        if shared.mirror_version() == version:
+            return True, None
+        published = shared.get_mirror()
+        return published is not None, published
+
+    # Reseeds once the stream is (re)connected, and again every
+    # reconcile_interval seconds.
+    async def _reconcile(self):
+        seeded_at = 0
+        while True:
+            due = (self._generation != supervisor.generation or
+                   time.monotonic() - seeded_at > self.reconcile_interval)
+            if due and supervisor.connected:
+                seeded_at = time.monotonic()
+                await self._seed()
+            await asyncio.sleep(1)
+
+    # Events that arrive while Alpaca is being asked may be missing from its
+    # answer, so they are kept and applied again on top of it.
+    async def _seed(self):
+        generation = supervisor.generation
+        self._pending = []
+        try:
+            orders, positions, account = await asyncio.gather(
+                api.list_all_orders(status="open"),
+                api.list_positions(),
+                api.get_account())
+        except Exception as e:
+            self._pending = None
+            logging.error(f"Account mirror reseed failed: {str(e)}")
+            return
+        pending, self._pending = self._pending, None
+        self.orders = {o.id: o for o in orders}
+        self.positions = {p.symbol: p for p in positions}
+        self.account = account
+        self._generation = generation
+        for data in pending:
+            self._apply(data)
+        self._publish_soon()
+
+    # Open orders, newest first, as list_orders returns them
+    def open_orders(self):
+        return sorted(self.orders.values(),
+                      key=lambda x: x._raw.get("submitted_at") or "",
+                      reverse=True)
+
+    # Applies one trade_updates event
+    def apply(self, data):
+        if self._pending is not None:
+            self._pending.append(data)
+        if self._generation is None:
+            return
+        self._apply(data)
+        self._publish_soon()
+
+    def _apply(self, data):
+        order = data.order
+        if data.event in ("fill", "canceled", "expired", "rejected",
+                          "replaced", "done_for_day"):
+            self.orders.pop(order["id"], None)
+        else:
+            self.orders[order["id"]] = entity.Order(order)
+        if data.event in ("fill", "partial_fill"):
+            self._fill(order, float(data.qty), float(data.price),
+                       getattr(data, "position_qty", None))
+
+    def _fill(self, order, qty, price, position_qty):
+        symbol = order["symbol"]
+        signed = qty if order["side"] == "buy" else -qty
+        old = self.positions.get(symbol)
+        old_qty = float(old.qty) if old is not None else 0
+        if position_qty is not None:
+            new_qty = float(position_qty)
+        else:
+            new_qty = old_qty + signed
+        if new_qty == 0:
+            self.positions.pop(symbol, None)
+        else:
+            if old is None or old_qty * new_qty < 0:
+                entry = price
+            elif abs(new_qty) > abs(old_qty):
+                entry = (float(old.avg_entry_price) * abs(old_qty)
+                         + price * qty) / abs(new_qty)
+            else:
+                entry = float(old.avg_entry_price)
+            raw = dict(old._raw) if old is not None else {"symbol": symbol}
+            raw.update({
+                "qty": f"{new_qty:g}",
+                "side": ("short", "long")[new_qty > 0],
+                "avg_entry_price": f"{entry:g}",
+                "current_price": f"{price:g}",
+            })
+            self.positions[symbol] = entity.Position(raw)
+        # Buying power moves by roughly the fill's notional until the next
+        # reconcile brings in the broker's own figure.
+        if self.account is not None:
+            raw = dict(self.account._raw)
+            raw["buying_power"] = f'{float(raw["buying_power"]) - signed * price:.2f}'
+            self.account = entity.Account(raw)
+
+
+mirror = AccountMirror(
+    enabled=config["state_mirror"],
+    reconcile_interval=config["state_reconcile_interval"],
+)
+
+# Last-price cache
+
+# The latest known price of each symbol, shared by /get_price, /order and the
+# market data streams.  Entries go stale after ttl seconds and the least
+# recently used are evicted past max_size.  Misses are filled from the minute
+# bars endpoint, one request for all of them (and only one at a time per
+# symbol), while an active quote, trade or bar stream keeps its symbol fresh.
+
+
+class PriceCache:
+    def __init__(self, ttl=15, max_size=5000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._inflight = {}
+
+    def put(self, symbol, price, at):
+        self._entries[symbol] = (price, at, time.monotonic())
+        self._entries.move_to_end(symbol)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    # (price, time) if a fresh price is cached, else None
+    def get(self, symbol):
+        entry = self._entries.get(symbol)
+        if entry is None or time.monotonic() - entry[2] > self.ttl:
+            return None
+        self._entries.move_to_end(symbol)
+        return entry[:2]
+
+    # Prices of several symbols as {symbol: (price, time)}, asking the broker
+    # only for the ones not cached.  Symbols without a price are left out.
+    async def fetch(self, api, symbols):
+        prices = {}
+        missing = []
+        waiting = {}
+        for symbol in symbols:
+            cached = self.get(symbol)
+            if cached is not None:
+                prices[symbol] = cached
+            elif symbol in self._inflight:
+                waiting[symbol] = self._inflight[symbol]
+            elif symbol not in missing:
+                missing.append(symbol)
+        if missing:
+            loop = asyncio.get_running_loop()
+            for symbol in missing:
+                waiting[symbol] = self._inflight[symbol] = loop.create_future()
+            try:
+                bars = await api.get_barset(missing, "minute", 1)
+                for symbol in missing:
+                    if len(bars.get(symbol, [])) > 0:
+                        self.put(symbol, bars[symbol][0].c, bars[symbol][0].t)
+                    self._inflight.pop(symbol).set_result(self.get(symbol))
+            except Exception as e:
+                for symbol in missing:
+                    future = self._inflight.pop(symbol, None)
+                    if future is not None:
+                        future.set_exception(e)
+                        # Only the caller that made the request reports it
+                        future.exception()
+                raise
+        for symbol, future in waiting.items():
+            if symbol not in prices:
+                price = await future
+                if price is not None:
+                    prices[symbol] = price
+        return prices
+
+    # Keeps a symbol hot from a market data stream event
+    def update(self, channel, data):
+        kind, symbol = channel.split(".", 1)
+        if kind == "T":
+            price = data.price
+        elif kind == "AM":
+            price = data.close
+        elif data.bidprice and data.askprice:
+            price = (data.bidprice + data.askprice) / 2
+        else:
+            return
+        self.put(symbol, price, event_timestamp(data))
+
+
+prices = PriceCache(
+    ttl=config["price_ttl"],
+    max_size=config["price_cache_size"],
+)
+
+# Asset index
+
+# The active US equities, as a sorted array of symbols with a byte each for
+# whether they can be traded and shorted, so commands can check a symbol with
+# one bisect instead of a broker round trip that only comes back with an
+# error.  Unknown symbols get suggestions: symbols that start with what was
+# typed, then close matches, fewest typos first.  The list is loaded at
+# startup and refreshed every refresh_interval seconds; until it is loaded,
+# every symbol passes and the broker has the last word.
+
+
+class AssetIndex:
+    def __init__(self, refresh_interval=3600, retry_interval=60):
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self.symbols = []
+        self._tradable = bytearray()
+        self._shortable = bytearray()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._refresh())
+
+    async def _refresh(self):
+        while True:
+            try:
+                self.load(await api.list_assets(
+                    status="active", asset_class="us_equity"))
+                await asyncio.sleep(self.refresh_interval)
+            except Exception as e:
+                logging.error(f"Asset list refresh failed: {str(e)}")
+                await asyncio.sleep(self.retry_interval)
+
+    def load(self, assets):
+        assets = sorted(assets, key=lambda x: x.symbol)
+        self._tradable = bytearray(
+            bool(x._raw.get("tradable")) for x in assets)
+        self._shortable = bytearray(
+            bool(x._raw.get("shortable") and x._raw.get("easy_to_borrow"))
+            for x in assets)
+        self.symbols = [x.symbol for x in assets]
+
+    # What is wrong with trading symbol, or None.  Only checks that it exists
+    # unless side is given; a sell is only checked for shorting when the
+    # account mirror shows fewer than qty shares held.
+    def problem(self, symbol, side=None, qty=None):
+        if len(self.symbols) == 0:
+            return None
+        i = bisect.bisect_left(self.symbols, symbol)
+        if i == len(self.symbols) or self.symbols[i] != symbol:
+            suggestions = self.suggest(symbol)
+            if len(suggestions) == 0:
+                return f"Unknown symbol {symbol}."
+            return f"Unknown symbol {symbol}.  Did you mean {' or '.join(suggestions)}?"
+        if side is None:
+            return None
+        if not self._tradable[i]:
+            return f"{symbol} is not tradable."
+        if side == "sell" and not self._shortable[i] and not held(symbol, qty):
+            return f"{symbol} cannot be sold short."
+        return None
+
+    def suggest(self, symbol, limit=3):
+        start = bisect.bisect_left(self.symbols, symbol)
+        found = []
+        for candidate in self.symbols[start:start + limit]:
+            if candidate.startswith(symbol):
+                found.append(candidate)
+        close = difflib.get_close_matches(symbol, self.symbols, 10, 0.6)
+        for candidate in sorted(close, key=lambda x: typos(symbol, x)):
+            if candidate not in found and typos(symbol, candidate) <= 2:
+                found.append(candidate)
+        return found[:limit]
+
+# Edits (insertions, deletions, substitutions and swaps of two neighbouring
+# letters) that turn one string into another
+
+
+def typos(a, b):
+    rows = [list(range(len(b) + 1))]
+    for i in range(1, len(a) + 1):
+        row = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            row[j] = min(rows[-1][j] + 1, row[j - 1] + 1,
+                         rows[-1][j - 1] + (a[i - 1] != b[j - 1]))
+            if (i > 1 and j > 1 and a[i - 1] == b[j - 2]
+                    and a[i - 2] == b[j - 1]):
+                row[j] = min(row[j], rows[-2][j - 2] + 1)
+        rows.append(row)
+    return rows[-1][-1]
+
+
+assets = AssetIndex(refresh_interval=config["asset_refresh_interval"])
+
+# An error naming every unknown symbol among those given, or None
+
+
+def symbol_problems(symbols):
+    problems = [assets.problem(x.upper()) for x in symbols if x.strip() != ""]
+    problems = [x for x in problems if x is not None]
+    if len(problems) == 0:
+        return None
+    return "ERROR: " + "  ".join(problems)
+
+# Pre-trade risk checks
+
+# Orders are checked against the limits in config before they are sent, using
+# the price cache and the account mirror (or REST, when the mirror is not
+# trusted), so an order the desk would not want never reaches Alpaca.  The
+# orders in a basket are checked together, each on top of the ones before it
+# and of the account's open orders, and an order whose value a limit needs
+# but whose price nobody has (no last trade for a market order) is refused.
+# The per-user order rate is counted in each process, like the Alpaca rate
+# limit.
+
+
+class RiskEngine:
+    def __init__(self, max_order_value=0, max_position_value=0,
+                 max_orders_per_minute=0, price_band=0, buying_power=False):
+        self.max_order_value = max_order_value
+        self.max_position_value = max_position_value
+        self.max_orders_per_minute = max_orders_per_minute
+        self.price_band = price_band
+        self.buying_power = buying_power
+        self._placed = {}
+
+    # Counts an order placed by user; says so if there were too many in the
+    # last minute
+    def throttle(self, user):
+        if self.max_orders_per_minute == 0:
+            return None
+        now = time.monotonic()
+        placed = self._placed.setdefault(user, collections.deque())
+        while len(placed) > 0 and now - placed[0] > 60:
+            placed.popleft()
+        if len(placed) >= self.max_orders_per_minute:
+            return self._reject("orders_per_minute", f"No more than {self.max_orders_per_minute} orders a minute.")
+        placed.append(now)
+        return None
+
+    # What is wrong with each order (keyword arguments for submit_order), or
+    # None, in order
+    async def check(self, api, orders):
+        if not (self.max_order_value or self.max_position_value
+                or self.price_band or self.buying_power):
+            return [None] * len(orders)
+        positions = account = None
+        open_orders = []
+        if self.max_position_value or self.buying_power:
+            if mirror.ready():
+                open_orders = list(mirror.orders.values())
+            else:
+                open_orders = await api.list_all_orders(status="open")
+        if self.max_position_value:
+            if mirror.ready():
+                positions = mirror.positions
+            else:
+                positions = {x.symbol: x for x in await api.list_positions()}
+        if self.buying_power:
+            if mirror.ready() and mirror.account is not None:
+                account = mirror.account
+            else:
+                account = await api.get_account()
+        symbols = {x["symbol"] for x in orders}
+        symbols.update(x.symbol for x in open_orders)
+        last = await prices.fetch(api, list(symbols))
+        exposure = self._exposure(open_orders, last)
+        return [self._check(x, last.get(x["symbol"]), positions, account,
+                            exposure)
+                for x in orders]
+
+    # What orders already waiting to fill may add: shares to buy and to sell
+    # of each symbol, and the dollars the buys will take
+    def _exposure(self, open_orders, last):
+        exposure = {"shares": {}, "bought": 0.0}
+        for order in open_orders:
+            raw = order._raw
+            price = float(raw.get("limit_price") or raw.get("stop_price") or 0)
+            if price == 0 and order.symbol in last:
+                price = float(last[order.symbol][0])
+            if raw.get("qty") is not None:
+                qty = float(raw["qty"]) - float(raw.get("filled_qty") or 0)
+            elif raw.get("notional") is not None and price > 0:
+                qty = float(raw["notional"]) / price
+            else:
+                continue
+            buys, sells = exposure["shares"].get(order.symbol, (0.0, 0.0))
+            if raw.get("side") == "buy":
+                exposure["shares"][order.symbol] = (buys + qty, sells)
+                exposure["bought"] += qty * price
+            else:
+                exposure["shares"][order.symbol] = (buys, sells + qty)
+        return exposure
+
+    # Checks one order on top of exposure, and adds it there if it passes
+    def _check(self, order, quote, positions, account, exposure):
+        qty = float(order["qty"])
+        last = float(quote[0]) if quote is not None else None
+        for kind in ("limit_price", "stop_price"):
+            price = order.get(kind)
+            if self.price_band and price is not None and last:
+                if abs(float(price) / last - 1) > self.price_band:
+                    return self._reject("price_band", f'{kind.replace("_", " ").capitalize()} {price} is more than {self.price_band:.0%} away from the last price {last:g}.')
+        if not (self.max_order_value or self.max_position_value
+                or self.buying_power):
+            return None
+        price = float(order.get("limit_price") or order.get("stop_price")
+                      or last or 0)
+        if price == 0:
+            return self._reject("no_price", f'No price for {order["symbol"]} to check the order against the risk limits.')
+        value = qty * price
+        if self.max_order_value and value > self.max_order_value:
+            return self._reject("order_value", f"Order worth {value:,.2f} is over the {self.max_order_value:,.2f} limit.")
+        buys, sells = exposure["shares"].get(order["symbol"], (0.0, 0.0))
+        if positions is not None:
+            # Alpaca gives short positions a negative qty.  Only the orders
+            # on the same side count, since the others may never fill.
+            position = positions.get(order["symbol"])
+            held = float(position.qty) if position is not None else 0.0
+            before = held + buys if order["side"] == "buy" else held - sells
+            after = before + (qty if order["side"] == "buy" else -qty)
+            worth = abs(after) * price
+            if worth > self.max_position_value and abs(after) > abs(before):
+                return self._reject("position_value", f'{order["symbol"]} position would be worth {worth:,.2f}, over the {self.max_position_value:,.2f} limit.')
+        if account is not None and order["side"] == "buy":
+            spent = exposure["bought"] + value
+            if spent > float(account.buying_power):
+                if exposure["bought"] > 0:
+                    return self._reject("buying_power", f"Order worth {value:,.2f}, with {exposure['bought']:,.2f} of buys already on order, is over the buying power of {float(account.buying_power):,.2f}.")
+                return self._reject("buying_power", f"Order worth {value:,.2f} is over the buying power of {float(account.buying_power):,.2f}.")
+        if order["side"] == "buy":
+            exposure["shares"][order["symbol"]] = (buys + qty, sells)
+            exposure["bought"] += value
+        else:
+            exposure["shares"][order["symbol"]] = (buys, sells + qty)
+        return None
+
+    def _reject(self, rule, text):
+        metrics.inc("tradebot_risk_rejections_total", rule=rule)
+        return text
+
+
+risk = RiskEngine(
+    max_order_value=config["risk_max_order_value"],
+    max_position_value=config["risk_max_position_value"],
+    max_orders_per_minute=config["risk_max_orders_per_minute"],
+    price_band=config["risk_price_band"],
+    buying_power=config["risk_buying_power"],
+)
+
+# True if the account mirror shows at least qty shares of symbol held, or if
+# it cannot tell
+
+
+def held(symbol, qty):
+    if not mirror.ready():
+        return True
+    position = mirror.positions.get(symbol)
+    try:
+        return position is not None and float(position.qty) >= float(qty)
+    except (TypeError, ValueError):
+        return True
+
+# Market data digests
+
+# A quote stream can tick many times a second per symbol, far more than a
+# Slack channel can take.  MarketDigest keeps only the latest quote, trade and
+# minute bar of each symbol and posts them together as one digest, at most
+# once per interval per symbol, to the channel that subscribed.
+
+
+class MarketDigest:
+    def __init__(self, interval=60):
+        self.interval = interval
+        self.destinations = {}
+        self._latest = {}
+        self._updates = {}
+        self._last_post = {}
+        self._scheduled = set()
+
+    def add(self, channel, data):
+        kind, symbol = channel.split(".", 1)
+        self._latest.setdefault(symbol, {})[kind] = data
+        self._updates[symbol] = self._updates.get(symbol, 0) + 1
+        if symbol not in self._scheduled:
+            self._scheduled.add(symbol)
+            due = self._last_post.get(symbol, 0) + self.interval
+            asyncio.get_running_loop().call_later(
+                max(0, due - time.monotonic()), self._flush, symbol)
+
+    def _flush(self, symbol):
+        self._scheduled.discard(symbol)
+        self._last_post[symbol] = time.monotonic()
+        latest = self._latest.pop(symbol, {})
+        updates = self._updates.pop(symbol, 0)
+        parts = {}
+        for kind, data in latest.items():
+            destination = self.destinations.get(f"{kind}.{symbol}")
+            if destination is not None:
+                parts.setdefault(destination, []).append(
+                    digest_part(kind, data))
+        for destination, lines in parts.items():
+            text = f'*{symbol}*: {" | ".join(lines)} ({updates} update{("", "s")[updates > 1]})'
+            slack.post(destination, text)
+
+
+def digest_part(kind, data):
+    if kind == "Q":
+        return f'Bid {data.bidprice} x {data.bidsize}, Ask {data.askprice} x {data.asksize}'
+    if kind == "T":
+        return f'Last trade {data.price} x {data.size}'
+    return f'Minute bar O {data.open} H {data.high} L {data.low} C {data.close} V {data.volume}'
+
+
+digest = MarketDigest(interval=config["digest_interval"])
+
+# Fill notifications
+
+# A large order can fill in dozens of pieces, and one message per piece soon
+# runs into Slack's rate limit for the channel.  FillNotifier gives each
+# order one message per channel instead: the first fill is posted right away,
+# and later fills are gathered for window seconds at a time and shown by
+# updating that message in place (chat.update) with the quantity filled so
+# far and its average price.  The order's last event (filled, canceled and so
+# on) is shown as soon as the message can be updated.  An order with no event
+# for idle_timeout seconds is forgotten.  Other events are posted as they
+# come.
+
+
+class FillNotifier:
+    def __init__(self, window=1, idle_timeout=300):
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self._orders = {}
+
+    def add(self, data, channel):
+        key = (data.order["id"], channel)
+        state = self._orders.get(key)
+        if state is None and data.event != "partial_fill":
+            slack.post(channel, event_text(data),
+                       stream_event=("trade_updates", event_time(data)))
+            return
+        if state is None:
+            state = self._orders[key] = {
+                "fills": 0, "qty": 0.0, "notional": 0.0, "ts": None,
+                "lane": channel, "channel": None, "sending": False,
+                "dirty": True, "timer": None, "idle": False}
+        if data.event in ("fill", "partial_fill"):
+            state["fills"] += 1
+            state["qty"] += float(data.qty)
+            state["notional"] += float(data.qty) * float(data.price)
+        state["text"] = fill_text(data, state)
+        state["stream_event"] = ("trade_updates", event_time(data))
+        state["final"] = data.event in FINAL_EVENTS
+        state["dirty"] = True
+        if state["ts"] is None and not state["sending"]:
+            self._send(key, state)
+        else:
+            self._schedule(key, (self.window, 0)[state["final"]])
+
+    def _send(self, key, state):
+        state["sending"] = True
+        state["dirty"] = False
+        slack.post(state["lane"], state["text"],
+                   stream_event=state["stream_event"],
+                   callback=lambda result: self._posted(key, result))
+
+    def _posted(self, key, result):
+        state = self._orders.get(key)
+        if state is None:
+            return
+        state["sending"] = False
+        if result is not None:
+            state["ts"], state["channel"] = result.get("ts"), result.get("channel")
+        self._schedule(key, (0, self.window)[
+            state["dirty"] and not state["final"]])
+
+    # Flushes the order's message after delay, unless a flush is already due
+    def _schedule(self, key, delay):
+        state = self._orders[key]
+        if state["timer"] is not None:
+            if delay > 0 and not state["idle"]:
+                return
+            state["timer"].cancel()
+        state["idle"] = False
+        state["timer"] = asyncio.get_running_loop().call_later(
+            delay, self._flush, key)
+
+    def _flush(self, key):
+        state = self._orders[key]
+        state["timer"] = None
+        if state["sending"]:
+            # _posted() schedules the next flush
+            return
+        if state["dirty"]:
+            if state["ts"] is None:
+                # Posting failed; start over with a new message
+                self._send(key, state)
+                return
+            slack.update(state["lane"], state["channel"], state["ts"],
+                         state["text"], stream_event=state["stream_event"])
+            state["dirty"] = False
+        if state["final"]:
+            del self._orders[key]
+            return
+        state["idle"] = True
+        state["timer"] = asyncio.get_running_loop().call_later(
+            self.idle_timeout, self._orders.pop, key, None)
+
+
+# Events after which an order sees no more fills
+FINAL_EVENTS = ("fill", "canceled", "expired", "rejected", "done_for_day",
+                "replaced")
+
+
+def event_text(data):
+    if data.event == "fill" or data.event == "partial_fill":
+        return f'*Event*: {data.event}, {data.order["type"]} order of | {data.order["side"]} {data.order["qty"]} {data.order["symbol"]} {data.order["time_in_force"]} | {data.event} at {data.price}'
+    return f'*Event*: {data.event}, {data.order["type"]} order of | {data.order["side"]} {data.order["qty"]} {data.order["symbol"]} {data.order["time_in_force"]} {data.event}'
+
+# One order's fills so far, as filled quantity and average price
+
+
+def fill_text(data, state):
+    average = state["notional"] / state["qty"] if state["qty"] > 0 else 0
+    return f'*Event*: {data.event}, {data.order["type"]} order of | {data.order["side"]} {data.order["qty"]} {data.order["symbol"]} {data.order["time_in_force"]} | filled {state["qty"]:g} at {round(average, 4):g} average ({state["fills"]} fill{("", "s")[state["fills"] > 1]})'
+
+
+fills = FillNotifier(window=config["fill_window"])
+
+# Event routing
+
+# Besides CHANNEL (which gets every event once trade_updates is subscribed),
+# channels can ask for the trade_updates events they care about, filtered by
+# symbol, side and event.  Routes are indexed by symbol, with the ones for
+# any symbol under None, so an event is only checked against the routes for
+# its own symbol.  A channel gets each event once, however many of its routes
+# match, and all of them share the fill notifier and the Slack outbox.  The
+# table listens to trade_updates on its own behalf while it has routes.
+#
+# With shared state, routes live in the store and the leader loads them, as
+# with price alerts.
+
+
+class RouteTable:
+    def __init__(self):
+        self.routes = {}
+        self._filters = {}
+        self._by_symbol = {}
+        self._ids = itertools.count(1)
+        self.version = None
+
+    # Adds a route: a channel and comma separated symbols, sides and events,
+    # each empty for any
+    def add(self, route):
+        route = dict(route)
+        if route.get("id") is None:
+            route["id"] = next(self._ids)
+        symbols, sides, events = (
+            frozenset(x for x in route[k].split(",") if x != "")
+            for k in ("symbols", "sides", "events"))
+        if len(self.routes) == 0:
+            supervisor.subscribe("trade_updates", "routes")
+        self.routes[route["id"]] = route
+        self._filters[route["id"]] = (sides, events)
+        for symbol in symbols or (None,):
+            self._by_symbol.setdefault(symbol, set()).add(route["id"])
+        return route
+
+    def remove(self, id):
+        route = self.routes.pop(id, None)
+        if route is None:
+            return False
+        del self._filters[id]
+        for symbol in [x for x in route["symbols"].split(",") if x] or [None]:
+            ids = self._by_symbol[symbol]
+            ids.discard(id)
+            if len(ids) == 0:
+                del self._by_symbol[symbol]
+        if len(self.routes) == 0:
+            supervisor.unsubscribe("trade_updates", "routes")
+        return True
+
+    # Makes the table hold exactly the given routes
+    def load(self, routes):
+        ids = set()
+        for route in routes:
+            ids.add(route["id"])
+            if route["id"] not in self.routes:
+                self.add(route)
+        for id in [x for x in self.routes if x not in ids]:
+            self.remove(id)
+
+    def clear(self):
+        for id in list(self.routes):
+            self.remove(id)
+        self.version = None
+
+    # Channels an event goes to.  Routes without an event filter skip "new".
+    def match(self, data):
+        order = data.order
+        channels = set()
+        for symbol in (order["symbol"], None):
+            for id in self._by_symbol.get(symbol, ()):
+                sides, events = self._filters[id]
+                if sides and order["side"] not in sides:
+                    continue
+                if data.event not in events if events else data.event == "new":
+                    continue
+                channels.add(self.routes[id]["channel"])
+        return channels
+
+
+routes = RouteTable()
+
+# Order history
+
+# Every trade_updates event is kept in a local SQLite database, indexed by
+# symbol, time and order id, so /history can look back without asking Alpaca.
+# The stream listener only queues events; a writer thread stores them in
+# batches of up to batch_size, at most flush_interval seconds after they
+# arrive, so the bot loop never waits on the disk.  If the writer falls more
+# than max_queue events behind, new events are dropped (and counted).  With
+# shared state, only the leader records, and any worker can read.
+
+
+class OrderHistory:
+    def __init__(self, path, batch_size=500, flush_interval=0.25,
+                 max_queue=10000):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return self.path != ""
+
+    @property
+    def pending(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    # Starts and stops recording, by listening to trade_updates
+    def start(self):
+        if self.enabled:
+            supervisor.subscribe("trade_updates", "history")
+
+    def stop(self):
+        supervisor.unsubscribe("trade_updates", "history")
+
+    def add(self, data):
+        if not self.enabled:
+            return
+        if self._queue is None or self._pid != os.getpid():
+            self._queue = queue.Queue(self.max_queue)
+            self._pid = os.getpid()
+            threading.Thread(target=self._write, name="tradebot-history",
+                             daemon=True).start()
+        order = data.order
+        row = (event_time(data) or time.time(), order.get("id"),
+               order.get("symbol"), data.event, order.get("side"),
+               order.get("type"), order.get("qty"),
+               getattr(data, "qty", None), getattr(data, "price", None),
+               json.dumps(data._raw, separators=(",", ":"), default=str))
+        try:
+            self._queue.put_nowait(row)
+        except queue.Full:
+            self.dropped += 1
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=5)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.executescript("""
+            CREATE TABLE IF NOT EXISTS order_events (
+                id INTEGER PRIMARY KEY, at REAL, order_id TEXT,
+                symbol TEXT, event TEXT, side TEXT, type TEXT, qty REAL,
+                fill_qty REAL, fill_price REAL, raw TEXT);
+            CREATE INDEX IF NOT EXISTS order_events_at
+                ON order_events (at);
+            CREATE INDEX IF NOT EXISTS order_events_symbol
+                ON order_events (symbol, at);
+            CREATE INDEX IF NOT EXISTS order_events_order_id
+                ON order_events (order_id, at);
+        """)
+        return db
+
+    def _write(self):
+        db = self._connect()
+        while True:
+            rows = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self._queue.get(
+                        timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                with db:
+                    db.executemany("""
+                        INSERT INTO order_events (at, order_id, symbol, event,
+                            side, type, qty, fill_qty, fill_price, raw)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """, rows)
+            except sqlite3.Error as e:
+                logging.error(f"Order history write failed: {str(e)}")
+
+    # Events since the given time, newest first, for a symbol, an order or
+    # everything: (number of events, the latest limit of them)
+    async def query(self, since, limit, symbol=None, order_id=None):
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self._query, since, limit, symbol, order_id)
+
+    def _query(self, since, limit, symbol, order_id):
+        where, params = "at >= ?", [since]
+        if symbol is not None:
+            where, params = "symbol = ? AND " + where, [symbol] + params
+        if order_id is not None:
+            where, params = "order_id = ? AND " + where, [order_id] + params
+        db = self._connect()
+        try:
+            count = db.execute(
+                f"SELECT COUNT(*) FROM order_events WHERE {where}",
+                params).fetchone()[0]
+            rows = db.execute(f"""
+                SELECT at, order_id, symbol, event, side, type, qty,
+                    fill_qty, fill_price
+                FROM order_events WHERE {where}
+                ORDER BY at DESC, id DESC LIMIT ?
+            """, params + [limit]).fetchall()
+        finally:
+            db.close()
+        return count, rows
+
+
+history = OrderHistory(config["history_path"])
+metrics.register("tradebot_history_queue_depth", lambda: history.pending)
+metrics.register("tradebot_history_dropped_total", lambda: history.dropped)
+
+# Portfolio P&L
+
+# The book holds every position as one row of numpy columns (signed quantity,
+# average entry price, last price and the previous close), so valuing the
+# whole book (unrealized P&L, exposure by side, the day's movers) is a
+# handful of array operations however many positions there are.  Positions
+# are loaded from the account mirror (or REST) as trade_updates starts and
+# before each valuation, market data streams mark last prices in place as
+# they tick, and fills from trade_updates add to the realized P&L of the
+# day.  With shared state, the
+# leader sees the fills and publishes the realized P&L for the other workers.
+
+
+class PortfolioBook:
+    def __init__(self):
+        self.symbols = []
+        self.realized = 0.0
+        self.loaded = False
+        self._rows = {}
+        self._columns = None
+        self._day = None
+
+    @property
+    def columns(self):
+        if self._columns is None:
+            self._columns = {name: np.zeros(0)
+                             for name in ("qty", "entry", "last", "prev")}
+        return self._columns
+
+    def load(self, positions):
+        positions = list(positions)
+        self.symbols = [p.symbol for p in positions]
+        self._rows = {symbol: i for i, symbol in enumerate(self.symbols)}
+        entry = np.array([float(p.avg_entry_price) for p in positions])
+        last = np.array([float(p._raw.get("current_price") or p.avg_entry_price)
+                         for p in positions])
+        prev = np.array([float(p._raw.get("lastday_price") or 0)
+                         for p in positions])
+        self._columns = {
+            "qty": np.array([abs(float(p.qty)) * (-1, 1)[p.side == "long"]
+                             for p in positions]),
+            "entry": entry,
+            "last": last,
+            # Positions opened today have no previous close
+            "prev": np.where(prev > 0, prev, entry),
+        }
+        self.loaded = True
+
+    # Sets last prices from {symbol: (price, time)}, as PriceCache returns
+    def mark(self, quotes):
+        quotes = {s: q for s, q in quotes.items() if s in self._rows}
+        if len(quotes) > 0:
+            rows = np.fromiter((self._rows[s] for s in quotes), int)
+            self.columns["last"][rows] = [q[0] for q in quotes.values()]
+
+    # Books a fill: any part of it that reduces the position realizes P&L
+    # against the average entry price.  A symbol the book has no row for
+    # starts from position, the one held before the fill (None if flat).
+    def fill(self, symbol, side, qty, price, position=None):
+        self._roll()
+        signed = qty if side == "buy" else -qty
+        row = self._rows.get(symbol)
+        if row is None:
+            row = self._rows[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            held, entry = 0, price
+            if position is not None:
+                held = abs(float(position.qty)) * (-1, 1)[position.side == "long"]
+                entry = float(position.avg_entry_price)
+            for name, value in (("qty", held), ("entry", entry),
+                                ("last", price), ("prev", price)):
+                self.columns[name] = np.append(self.columns[name], value)
+        c = self.columns
+        held = c["qty"][row]
+        if held * signed < 0:
+            closed = min(abs(held), qty)
+            self.realized += closed * (price - c["entry"][row]) * np.sign(held)
+        new = held + signed
+        if held * new <= 0:
+            c["entry"][row] = price
+        elif abs(new) > abs(held):
+            c["entry"][row] = (c["entry"][row] * abs(held) + price * qty) / abs(new)
+        c["qty"][row] = new
+        c["last"][row] = price
+
+    # Realized P&L counts from midnight
+    def _roll(self):
+        today = time.strftime("%Y-%m-%d")
+        if self._day != today:
+            self._day = today
+            self.realized = 0.0
+
+    # Values the whole book
+    def value(self, movers=5):
+        self._roll()
+        c = self.columns
+        market_value = c["qty"] * c["last"]
+        day = c["qty"] * (c["last"] - c["prev"])
+        change = (c["last"] - c["prev"]) / np.where(c["prev"] != 0, c["prev"], 1)
+        top = [i for i in np.argsort(-np.abs(day)) if c["qty"][i] != 0][:movers]
+        return {
+            "positions": int(np.count_nonzero(c["qty"])),
+            "unrealized": float((c["qty"] * (c["last"] - c["entry"])).sum()),
+            "day": float(day.sum()),
+            "long": float(market_value[market_value > 0].sum()),
+            "short": float(market_value[market_value < 0].sum()),
+            "movers": [(self.symbols[i], float(change[i]), float(day[i]))
+                       for i in top],
+        }
+
+
+book = PortfolioBook()
+
+# Loads the book with the positions held as trade_updates starts, so fills
+# on them realize P&L against their entry price
+
+
+async def load_book(api):
+    try:
+        if mirror.ready():
+            positions = mirror.positions.values()
+        else:
+            positions = await api.list_positions()
+        book.load(positions)
+    except Exception as e:
+        logging.error(f"P&L book load failed: {str(e)}")
+
+# Price alerts
+
+# Alerts are kept per symbol in two lists sorted by price level: those waiting
+# for the price to rise to their level and those waiting for it to fall to
+# theirs.  A price update bisects both lists, so it only touches the alerts it
+# crosses, however many are set.  A one-shot alert is dropped once it fires; a
+# repeating one is disarmed and waits in the other list for the price to come
+# back rearm (a fraction of its threshold) past the threshold before it can
+# fire again.  Alerts expire at their own time.  Each symbol with an alert is
+# kept fresh by its quote stream.
+#
+# With shared state, alerts live in the store, and the leader evaluates them:
+# it loads any change (keeping the state of alerts it already has) and drops
+# alerts from the store when they fire or expire.
+
+
+class AlertBook:
+    def __init__(self, rearm=0.001):
+        self.rearm = rearm
+        self.alerts = {}
+        self._levels = {}
+        self._expiry = []
+        self._ids = itertools.count(1)
+        self._sweeping = False
+        self.version = None
+
+    def add(self, alert):
+        alert = dict(alert, armed=True)
+        if alert.get("id") is None:
+            alert["id"] = next(self._ids)
+        self.alerts[alert["id"]] = alert
+        if alert["symbol"] not in self._levels:
+            self._levels[alert["symbol"]] = ([], [])
+            supervisor.subscribe(f'Q.{alert["symbol"]}', "alerts")
+        self._place(alert)
+        heapq.heappush(self._expiry, (alert["expires"], alert["id"]))
+        if not self._sweeping:
+            self._sweeping = True
+            asyncio.get_running_loop().call_later(1, self._expire)
+        return alert
 
-# Set up environment
-conn = tradeapi.StreamConn(
-    key_id=config.get('key_id'),
-    secret_key=config.get('secret_key'),
-    base_url=config.get('base_url'),
-)
-api = tradeapi.REST(
-    key_id=config.get('key_id'),
-    secret_key=config.get('secret_key'),
-    base_url=config.get('base_url'),
-)
+    # Makes the book hold exactly the given alerts
+    def load(self, alerts):
+        ids = set()
+        for alert in alerts:
+            ids.add(alert["id"])
+            if alert["id"] not in self.alerts:
+                self.add(alert)
+        for id in [x for x in self.alerts if x not in ids]:
+            self.remove(id)
 
-# Initialize the Flask object which will be used to handle HTTP requests
-# from Slack
-app = Flask(__name__)
+    def remove(self, id):
+        alert = self.alerts.get(id)
+        if alert is None:
+            return False
+        rising, falling = self._levels[alert["symbol"]]
+        levels = (falling, rising)[alert["rising"]]
+        del levels[bisect.bisect_left(levels, (alert["level"], id))]
+        self._drop(alert)
+        self._prune(alert["symbol"])
+        return True
 
- 
-# Initialize the dictionary of streams that we are listening to; None
-# denotes not listening
-streams = {
-    "trade_updates": None,
-}
+    # Forgets every alert, when this worker is no longer the leader
+    def clear(self):
+        for symbol in self._levels:
+            supervisor.unsubscribe(f"Q.{symbol}", "alerts")
+        self.alerts.clear()
+        self._levels.clear()
+        self._expiry.clear()
+        self.version = None
 
+    # Alerts that fire at this price
+    def check(self, symbol, price):
+        levels = self._levels.get(symbol)
+        if levels is None:
+            return []
+        rising, falling = levels
+        i = bisect.bisect_right(rising, (price, float("inf")))
+        j = bisect.bisect_left(falling, (price, 0))
+        crossed = rising[:i] + falling[j:]
+        del rising[:i], falling[j:]
+        fired = []
+        for level, id in crossed:
+            alert = self.alerts[id]
+            if alert["armed"]:
+                fired.append(alert)
+            if alert["armed"] and not alert["repeat"]:
+                self._drop(alert)
+            else:
+                alert["armed"] = not alert["armed"]
+                self._place(alert)
+        self._prune(symbol)
+        return fired
 
-def reply_private(request, text):
-    requests.post(
-        url=request.form.get("response_url"),
-        data=json.dumps({"text": text}),
-        headers={"Content-type": "application/json"},
-    )
+    # An armed alert waits at its threshold for the price to cross it in its
+    # direction; a disarmed one waits a little past it the other way.
+    def _place(self, alert):
+        alert["rising"] = alert["above"] == alert["armed"]
+        alert["level"] = alert["threshold"]
+        if not alert["armed"]:
+            alert["level"] *= (1 - self.rearm, 1 + self.rearm)[alert["rising"]]
+        bisect.insort(self._levels[alert["symbol"]][not alert["rising"]],
+                      (alert["level"], alert["id"]))
+
+    def _drop(self, alert):
+        del self.alerts[alert["id"]]
+        if shared.enabled:
+            shared.submit(shared.remove_alert, alert["id"])
+
+    # Stops watching a symbol's quotes once no alert waits on it
+    def _prune(self, symbol):
+        if self._levels.get(symbol) == ([], []):
+            del self._levels[symbol]
+            supervisor.unsubscribe(f"Q.{symbol}", "alerts")
+
+    def _expire(self):
+        now = time.time()
+        while len(self._expiry) > 0 and self._expiry[0][0] <= now:
+            expires, id = heapq.heappop(self._expiry)
+            try:
+                self.remove(id)
+            except sqlite3.Error as e:
+                logging.error(f"Dropping expired alert failed: {str(e)}")
+        self._sweeping = len(self.alerts) > 0
+        if self._sweeping:
+            asyncio.get_running_loop().call_later(1, self._expire)
+
+
+alerts = AlertBook()
+
+# Tells the user who set an alert that it fired
+
+
+def notify_alert(alert, price):
+    text = f'<@{alert["user"]}> *{alert["symbol"]}* is at {price:g}, {("below", "above")[alert["above"]]} {alert["threshold"]:g} (alert #{alert["id"]}{("", ", repeating")[alert["repeat"]]})'
+    slack.post(alert["channel"], text)
+
+# Loads and marks the book, then describes it
+
+
+async def pnl_report(api):
+    if mirror.ready():
+        positions = mirror.positions.values()
+    else:
+        positions = await api.list_positions()
+    book.load(positions)
+    book.mark(await prices.fetch(api, book.symbols))
+    pnl = book.value()
+    if shared.enabled and not shared.leader:
+        realized = await shared.run(shared.get, "realized_pnl") or 0.0
+    else:
+        realized = book.realized
+    text = f'P&L of {pnl["positions"]} positions...\nUnrealized = {pnl["unrealized"]:+,.2f}\nRealized today = {realized:+,.2f}\nChange today = {pnl["day"]:+,.2f}\nLong = {pnl["long"]:,.2f}, Short = {pnl["short"]:,.2f}, Gross = {pnl["long"] - pnl["short"]:,.2f}, Net = {pnl["long"] + pnl["short"]:,.2f}'
+    if len(pnl["movers"]) > 0:
+        text += "\nTop movers today: " + ", ".join(
+            f"{symbol} {change:+.2%} ({day:+,.2f})"
+            for symbol, change, day in pnl["movers"])
+    return text
+
+# Posts the P&L to the channel every pnl_interval seconds (from the leader
+# only, with shared state)
+
+
+async def post_pnl(interval):
+    while True:
+        await asyncio.sleep(interval)
+        if shared.enabled and not shared.leader:
+            continue
+        try:
+            slack.post(config["channel"], await pnl_report(api))
+        except Exception as e:
+            logging.error(f"P&L post failed: {str(e)}")
 
 # Streaming handlers
 
+# The streams Slack asked for.  In a single process they go straight to the
+# supervisor; with shared state they are kept in the store, and the leader
+# (right away, if that is this worker) subscribes to them.
+
+
+async def stream_wanted(stream):
+    if shared.enabled:
+        return stream in await shared.run(shared.streams)
+    return supervisor.wanted_by(stream, "slack")
+
+
+async def want_stream(stream, destination):
+    if shared.enabled:
+        await shared.run(shared.want, stream, destination)
+        if shared.leader:
+            await sync_streams()
+        return
+    supervisor.subscribe(stream)
+    if MARKET_DATA_STREAM.match(stream):
+        digest.destinations[stream] = destination
+
+
+async def drop_stream(stream):
+    if shared.enabled:
+        await shared.run(shared.unwant, stream)
+        if shared.leader:
+            await sync_streams()
+        return
+    supervisor.unsubscribe(stream)
+    digest.destinations.pop(stream, None)
+
+# Price alerts set through Slack.  In a single process they go straight to the
+# alert book; with shared state they are kept in the store for the leader.
+
+
+async def create_alert(alert):
+    if shared.enabled:
+        id = await shared.run(shared.add_alert, alert)
+        if shared.leader:
+            await sync_alerts()
+        return id
+    return alerts.add(alert)["id"]
+
+
+async def user_alerts(user):
+    if shared.enabled:
+        found = await shared.run(shared.alerts, user)
+    else:
+        found = [x for x in alerts.alerts.values() if x["user"] == user]
+    return sorted([x for x in found if x["expires"] > time.time()],
+                  key=lambda x: x["id"])
+
+
+async def cancel_alert(id, user):
+    if shared.enabled:
+        cancelled = await shared.run(shared.remove_alert, id, user)
+        if cancelled and shared.leader:
+            await sync_alerts()
+        return cancelled
+    alert = alerts.alerts.get(id)
+    return alert is not None and alert["user"] == user and alerts.remove(id)
+
+
+async def alert_count():
+    if shared.enabled:
+        return (await shared.run(shared.alerts_version))[0]
+    return len(alerts.alerts)
+
+# Event routes set through Slack, kept like price alerts
+
+
+async def create_route(route):
+    if shared.enabled:
+        id = await shared.run(shared.add_route, route)
+        if shared.leader:
+            await sync_routes()
+        return id
+    return routes.add(route)["id"]
+
+
+async def channel_routes(channel):
+    if shared.enabled:
+        found = await shared.run(shared.routes, channel)
+    else:
+        found = [x for x in routes.routes.values() if x["channel"] == channel]
+    return sorted(found, key=lambda x: x["id"])
+
+
+async def remove_route(id, channel):
+    if shared.enabled:
+        removed = await shared.run(shared.remove_route, id, channel)
+        if removed and shared.leader:
+            await sync_routes()
+        return removed
+    route = routes.routes.get(id)
+    return route is not None and route["channel"] == channel and routes.remove(id)
+
+# Health lines for /list streams, from the leader when it is another worker
+
+
+async def stream_health():
+    if shared.enabled and not shared.leader:
+        health = await shared.run(shared.get, "stream_health")
+        if health is None and len(await shared.run(shared.streams)) > 0:
+            return ["No worker holds the stream connection right now."]
+        return health or []
+    if len(supervisor.channels) == 0:
+        return []
+    return supervisor.health()
+
 # Subscribe to streaming channel(s).  Must contain one or more arguments
 # representing streams you want to connect to.
 
 
-@app.route("/subscribe_streaming", methods=["POST"])
-def stream_data_handler():
-    args = request.form.get("text").split(" ")
+@command("/subscribe_streaming")
+async def stream_data_handler(form):
+    args = form.get("text").split(" ")
     if len(args) == 1 and args[0].strip() == "":
         return BAD_ARGS
     try:
         connected = 0
         for stream in args:
-            # If the specified stream exists in the dictionary and it hasn't
-            # been initialized, subscribe and listen to it.
-            if streams[stream] is None:
-                streams[stream] = multiprocessing.Process(
-                    target=runThread, args=(stream,))
-                streams[stream].start()
+            # If the specified stream exists and we aren't listening to it
+            # yet, have the supervisor subscribe to it.  Market data digests
+            # go to the channel that subscribed.
+            stream = stream_name(stream)
+            if stream is not None and not await stream_wanted(stream):
+                await want_stream(stream, form.get("channel_name"))
                 connected += 1
         if len(args) == connected:
             text = f"Subscription{('','s')[connected > 1]} to {(' ').join(args)} sent."
-            response = requests.post(
-                url="https://slack.com/api/chat.postMessage",
-                data={
-                    "token": config["slack_token"],
-                    "channel": request.form.get("channel_name"),
-                    "text": text})
+            slack.post(form.get("channel_name"), text)
             return ""
         else:
             return f"{len(args) - connected} subscription(s) failed."
@@ -93,28 +3079,22 @@ def stream_data_handler():
 # representing streams you want to disconnect to.
 
 
-@app.route("/unsubscribe_streaming", methods=["POST"])
-def unsubscribe_handler():
-    args = request.form.get("text").split(" ")
+@command("/unsubscribe_streaming")
+async def unsubscribe_handler(form):
+    args = form.get("text").split(" ")
     if len(args) == 1 and args[0].strip() == "":
         return BAD_ARGS
     try:
         disconnected = 0
         for stream in args:
-            # If the specified stream exists in the dictionary and it has been
-            # initialized, stop listening.
-            if streams[stream] is not None:
-                streams[stream].terminate()
-                streams[stream] = None
+            # If we are listening to the specified stream, stop listening.
+            stream = stream_name(stream)
+            if stream is not None and await stream_wanted(stream):
+                await drop_stream(stream)
                 disconnected += 1
         if len(args) == disconnected:
             text = f"Unsubscription{('', 's')[disconnected > 1]} to {(' ').join(args)} sent."
-            response = requests.post(
-                url="https://slack.com/api/chat.postMessage",
-                data={
-                    "token": config["slack_token"],
-                    "channel": request.form.get("channel_name"),
-                    "text": text})
+            slack.post(form.get("channel_name"), text)
             return ""
         else:
             return f"{len(args) - disconnected} unsubscription(s) failed."
@@ -124,235 +3104,860 @@ def unsubscribe_handler():
 # Stream listeners
 
 
-@conn.on(r'trade_updates')
+@supervisor.on(r'^trade_updates$')
 async def trade_updates_handler(conn, chan, data):
-    if data.event == "new":
-        return ""
-    elif data.event == "fill" or data.event == "partial_fill":
-        text = f'*Event*: {data.event}, {data.order["type"]} order of | {data.order["side"]} {data.order["qty"]} {data.order["symbol"]} {data.order["time_in_force"]} | {data.event} at {data.price}'
-    else:
-        text = f'*Event*: {data.event}, {data.order["type"]} order of | {data.order["side"]} {data.order["qty"]} {data.order["symbol"]} {data.order["time_in_force"]} {data.event}'
-    response = requests.post(url="https://slack.com/api/chat.postMessage", data={
-        "token": config["slack_token"],
-        "channel": config["channel"],
-        "text": text
-    })
+    recorder.event(chan, data)
+    symbol = data.order["symbol"]
+    before = mirror.positions.get(symbol) if mirror.ready() else None
+    mirror.apply(data)
+    history.add(data)
+    if data.event in ("fill", "partial_fill"):
+        book.fill(symbol, data.order["side"], float(data.qty),
+                  float(data.price), before)
+    channels = routes.match(data)
+    if supervisor.wanted_by(chan, "slack") and data.event != "new":
+        channels.add(config["channel"])
+    for channel in channels:
+        fills.add(data, channel)
     return ""
 
-# Helper function to listen to a stream
 
+@supervisor.on(r'^(Q|T|AM)\.')
+async def market_data_handler(conn, chan, data):
+    prices.update(chan, data)
+    symbol = chan.split(".", 1)[1]
+    price = prices.get(symbol)
+    if price is not None:
+        book.mark({symbol: price})
+        for alert in alerts.check(symbol, price[0]):
+            notify_alert(alert, price[0])
+    if chan in digest.destinations:
+        digest.add(chan, data)
+
+# Multi-worker coordination
+
+# With shared state, every worker runs coordinate() on its bot loop.  The
+# worker holding the streams lease is the leader: it brings its supervisor in
+# line with the streams in the store, keeps the account mirror and the order
+# history, and publishes stream health and whether the mirror can be trusted.
+# A worker that loses the lease (its loop stalled, say) drops its stream
+# connection; when the leader dies, its lease runs out and another worker
+# takes over.
+
+
+async def coordinate():
+    while True:
+        try:
+            was_leader = shared.leader
+            shared.leader = await shared.run(shared.lead, "streams")
+            if shared.leader:
+                if not was_leader and not book.loaded:
+                    asyncio.ensure_future(load_book(api))
+                await sync_streams()
+                if mirror.enabled:
+                    mirror.ready()
+                history.start()
+                await sync_alerts()
+                await sync_routes()
+                await shared.run(shared.put, "mirror_trusted", mirror.trusted)
+                await shared.run(shared.put, "realized_pnl", book.realized)
+                await shared.run(shared.put, "stream_health",
+                                 supervisor.health()
+                                 if len(supervisor.channels) > 0 else [])
+                await shared.run(shared.forget, deliveries.ttl)
+            else:
+                if was_leader:
+                    logging.warning("Lost the streams lease, disconnecting")
+                    stop_streams()
+                if mirror.enabled:
+                    await mirror.load()
+        except sqlite3.Error as e:
+            logging.error(f"Worker coordination failed: {str(e)}")
+        await asyncio.sleep(shared.interval)
+
+
+async def sync_streams():
+    wanted = await shared.run(shared.streams)
+    for channel in supervisor.channels:
+        if supervisor.wanted_by(channel, "slack") and channel not in wanted:
+            supervisor.unsubscribe(channel)
+            digest.destinations.pop(channel, None)
+    for channel, destination in wanted.items():
+        if not supervisor.wanted_by(channel, "slack"):
+            supervisor.subscribe(channel)
+        if MARKET_DATA_STREAM.match(channel):
+            digest.destinations[channel] = destination
+
+
+def stop_streams():
+    mirror.stop()
+    history.stop()
+    alerts.clear()
+    routes.clear()
+    for channel in supervisor.channels:
+        supervisor.unsubscribe(channel)
+    digest.destinations.clear()
+
+
+async def sync_alerts():
+    version = await shared.run(shared.alerts_version)
+    if version != alerts.version:
+        alerts.load(await shared.run(shared.alerts))
+        alerts.version = version
+
+
+async def sync_routes():
+    version = await shared.run(shared.routes_version)
+    if version != routes.version:
+        routes.load(await shared.run(shared.routes))
+        routes.version = version
 
-def runThread(stream):
-    conn.run([stream])
+# Starts the background work of a process once, on the bot loop: the asset
+# index; with shared state, coordinate(), otherwise the order history; and
+# the P&L posts
+
+
+_background_pid = None
+
+
+def start_background():
+    global _background_pid
+    if _background_pid == os.getpid():
+        return
+    _background_pid = os.getpid()
+    assets.start()
+    if shared.enabled:
+        asyncio.ensure_future(coordinate())
+    else:
+        history.start()
+        asyncio.ensure_future(load_book(api))
+    if config["pnl_interval"] > 0:
+        asyncio.ensure_future(post_pnl(config["pnl_interval"]))
 
 # Order/Account handlers
 
 # Execute an order.  Must contain 5, 6, or 7 arguments: type, symbol,
 # quantity, side, time in force, limit price (optional), and stop price
 # (optional).
-@app.route("/order", methods=["POST"])
-def order_handler():
-    args = request.form.get("text").split(" ")
+@command("/order")
+async def order_handler(form):
+    args = form.get("text").split(" ")
     if len(args) == 0 :
         return WRONG_NUM_ARGS
+    try:
+        order = parse_order(args)
+    except ValueError as e:
+        return f"ERROR: {str(e)}"
 
-    async def sub_order(api, request, args):
-        if args[0].lower() == "market":
-            if len(args) != 5:
-                reply_private(request, WRONG_NUM_ARGS)
+    async def sub_order(api, form, order):
+        try:
+            problem = (await risk.check(api, [order]))[0]
+            if problem is None:
+                problem = risk.throttle(form.get("user_id"))
+            if problem is not None:
+                reply_private(form, f"ERROR: Order rejected.  {problem}")
                 return
-            try:
-                args[3] = args[3].upper()
-                order = api.submit_order(
-                    args[3],
-                    args[2],
-                    args[1],
-                    args[0].lower(),
-                    args[4])
-                price = api.get_barset(args[3], 'minute', 1)[args[3]][0].c
-                text = f'Market order of | {args[1]} {args[2]} {args[3]} {args[4]} |, current equity price at {price}.  Order id = {order.id}.'
-                response = requests.post(
-                    url="https://slack.com/api/chat.postMessage",
-                    data={
-                        "token": config["slack_token"],
-                        "channel": request.form.get("channel_name"),
-                        "text": text})
-            except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
-        elif args[0].lower() == "limit":
-            if len(args) != 6:
-                reply_private(request, WRONG_NUM_ARGS)
+            result = await api.submit_order(
+                client_order_id=client_order_id(form), **order)
+            slack.post(form.get("channel_name"),
+                       await order_text(api, order, result))
+        except Exception as e:
+            reply_private(form, f"ERROR: {str(e)}")
+    return submit_job(sub_order, api, form, order)
+
+# What /order posts about an order it submitted
+
+
+async def order_text(api, order, result):
+    what = f'{order["side"]} {order["qty"]} {order["symbol"]} {order["time_in_force"]}'
+    if order["type"] == "market":
+        quote = (await prices.fetch(api, [order["symbol"]])).get(order["symbol"])
+        price = quote[0] if quote else "unknown"
+        return f'Market order of | {what} |, current equity price at {price}.  Order id = {result.id}.'
+    if order["type"] == "limit":
+        return f'Limit order of | {what} at limit price {order["limit_price"]} | submitted.  Order id = {result.id}.'
+    if order["type"] == "stop":
+        return f'Stop order of | {what} at stop price {order["stop_price"]} | submitted.  Order id = {result.id}.'
+    return f'Stop-Limit order of | {what} at stop price {order["stop_price"]} and limit price {order["limit_price"]} | submitted.  Order id = {result.id}.'
+
+# Submits a basket of orders.  Takes either the orders inline, separated by
+# semicolons or new lines, each written like the arguments to /order, or the
+# URL of a CSV file shared in Slack with one order per row in the same order
+# (type, side, qty, symbol, time_in_force, limit_price, stop_price).  All
+# orders are checked before any is sent.
+
+
+@command("/order_basket")
+async def order_basket_handler(form):
+    text = form.get("text").strip()
+    if text == "":
+        return WRONG_NUM_ARGS
+    url = text.strip("<>")
+    is_url = url.startswith("https://") or url.startswith("http://")
+    if is_url and not slack_file_url(url):
+        return "ERROR: Only CSV files shared in Slack can be read."
+
+    async def sub_order_basket(api, form, text):
+        try:
+            if is_url:
+                rows = csv_rows(slack.file_lines(url))
+            else:
+                rows = inline_rows(text)
+            orders, errors = await parse_basket(rows)
+            if len(errors) == 0:
+                problems = await risk.check(api, orders)
+                errors = [f"Order {number}: {problem}" for number, problem
+                          in enumerate(problems, 1) if problem is not None]
+            if len(errors) == 0 and len(orders) > 0:
+                problem = risk.throttle(form.get("user_id"))
+                if problem is not None:
+                    errors.append(problem)
+            if len(errors) > 0:
+                reply_private(form, "Basket rejected, nothing was submitted.\n" + "\n".join(errors))
                 return
-            try:
-                args[3] = args[3].upper()
-                order = api.submit_order(
-                    args[3],
-                    args[2],
-                    args[1],
-                    args[0].lower(),
-                    args[4],
-                    limit_price=args[5])
-                text = f'Limit order of | {args[1]} {args[2]} {args[3]} {args[4]} at limit price {args[5]} | submitted.  Order id = {order.id}.'
-                response = requests.post(
-                    url="https://slack.com/api/chat.postMessage",
-                    data={
-                        "token": config["slack_token"],
-                        "channel": request.form.get("channel_name"),
-                        "text": text})
-            except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
-        elif args[0].lower() == "stop":
-            if len(args) != 6:
-                return WRONG_NUM_ARGS
-            try:
-                args[3] = args[3].upper()
-                order = api.submit_order(
-                    args[3],
-                    args[2],
-                    args[1],
-                    args[0].lower(),
-                    args[4],
-                    stop_price=args[5])
-                text = f'Stop order of | {args[1]} {args[2]} {args[3]} {args[4]} at stop price {args[5]} | submitted.  Order id = {order.id}.'
-                response = requests.post(
-                    url="https://slack.com/api/chat.postMessage",
-                    data={
-                        "token": config["slack_token"],
-                        "channel": request.form.get("channel_name"),
-                        "text": text})
-            except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
-        elif args[0].lower() == "stop_limit":
-            if len(args) != 7:
-                reply_private(request, WRONG_NUM_ARGS)
+            if len(orders) == 0:
+                reply_private(form, "Basket is empty.")
                 return
-            try:
-                args[3] = args[3].upper()
-                order = api.submit_order(
-                    args[3],
-                    args[2],
-                    args[1],
-                    args[0].lower(),
-                    args[4],
-                    limit_price=args[5],
-                    stop_price=args[6])
-                text = f'Stop-Limit order of | {args[1]} {args[2]} {args[3]} {args[4]} at stop price {args[6]} and limit price {args[5]} | submitted.  Order id = {order.id}.'
-                response = requests.post(
-                    url="https://slack.com/api/chat.postMessage",
-                    data={
-                        "token": config["slack_token"],
-                        "channel": request.form.get("channel_name"),
-                        "text": text})
-            except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
+            for index, order in enumerate(orders):
+                order["client_order_id"] = client_order_id(form, index)
+            results = await fan_out(
+                lambda order: api.submit_order(**order), orders,
+                config["basket_concurrency"])
+            slack.post(form.get("channel_name"), basket_table(orders, results))
+        except Exception as e:
+            reply_private(form, f"ERROR: {str(e)}")
+    return submit_job(sub_order_basket, api, form, text)
+
+# Number of /order arguments for each order type
+ORDER_ARGS = {"market": 5, "limit": 6, "stop": 6, "stop_limit": 7}
+TIME_IN_FORCE = ("day", "gtc", "opg", "cls", "ioc", "fok")
+
+# Checks one order written like the arguments to /order and returns the
+# keyword arguments for submit_order, or raises ValueError saying what is
+# wrong with it.
+
+
+def parse_order(args):
+    args = [x.strip() for x in args if x.strip() != ""]
+    if len(args) == 0 or args[0].lower() not in ORDER_ARGS:
+        raise ValueError("unknown order type")
+    type = args[0].lower()
+    if len(args) != ORDER_ARGS[type]:
+        raise ValueError(f"{type} orders take {ORDER_ARGS[type]} arguments")
+    side, qty, symbol, time_in_force = args[1:5]
+    order = {
+        "symbol": symbol.upper(),
+        "qty": qty,
+        "side": side.lower(),
+        "type": type,
+        "time_in_force": time_in_force.lower(),
+    }
+    if order["side"] not in ("buy", "sell"):
+        raise ValueError(f"bad side {side}")
+    if not qty.isdigit() or int(qty) == 0:
+        raise ValueError(f"bad quantity {qty}")
+    order["qty"] = qty = str(int(qty))
+    if order["time_in_force"] not in TIME_IN_FORCE:
+        raise ValueError(f"bad time in force {time_in_force}")
+    problem = assets.problem(order["symbol"], order["side"], qty)
+    if problem is not None:
+        raise ValueError(problem)
+    price_args = args[5:]
+    if type == "stop":
+        order["stop_price"] = price_args[0]
+    elif type == "limit":
+        order["limit_price"] = price_args[0]
+    elif type == "stop_limit":
+        order["limit_price"], order["stop_price"] = price_args
+    for price in price_args:
+        try:
+            if not 0 < float(price) < float("inf"):
+                raise ValueError
+        except ValueError:
+            raise ValueError(f"bad price {price}")
+    return order
+
+# Basket rows, one list of arguments per order, from inline text or from the
+# lines of a CSV file (a header row is skipped)
+
+
+async def inline_rows(text):
+    for line in re.split(r'[;\n]', text):
+        if line.strip() != "":
+            yield line.split()
+
+
+async def csv_rows(lines):
+    async for line in lines:
+        for row in csv.reader([line]):
+            if len(row) > 0 and row[0].strip().lower() != "type":
+                yield row
+
+# Checks every row of a basket, returning the orders and one error line per
+# bad row
+
+
+async def parse_basket(rows):
+    orders, errors = [], []
+    number = 0
+    async for row in rows:
+        number += 1
+        if number > config["basket_max_orders"]:
+            errors.append(f'More than {config["basket_max_orders"]} orders.')
+            break
+        try:
+            orders.append(parse_order(row))
+        except ValueError as e:
+            errors.append(f"Order {number}: {str(e)}")
+    return orders, errors
+
+# One table with the outcome of every order in a basket
+
+
+def basket_table(orders, results):
+    failed = len([x for x in results if isinstance(x, Exception)])
+    lines = [f"{'#':>4}  {'Symbol':<8}{'Side':<6}{'Qty':>8}  {'Type':<11}Result"]
+    for number, (order, result) in enumerate(zip(orders, results), 1):
+        if isinstance(result, Exception):
+            outcome = f"ERROR: {describe_error(result)}"
         else:
-            return BAD_ARGS
-    asyncio.run(sub_order(api, request, args))
-    return ""
+            outcome = f"Order id = {result.id}"
+        lines.append(f"{number:>4}  {order['symbol']:<8}{order['side']:<6}{order['qty']:>8}  {order['type']:<11}{outcome}")
+    text = f"Basket of {len(orders)} orders submitted, {failed} failed."
+    return text + "\n```\n" + "\n".join(lines) + "\n```"
 
-# Lists certain things.  Must contain 1 argument: orders, positions, or
-# streams.
+# Lists certain things.  Takes orders, positions or streams.  Orders and
+# positions take filters (symbol=, side=, and for orders type=, each a comma
+# separated list), sort= a column (with a leading - for descending) and
+# page=, as in /list orders symbol=AAPL,MSFT side=buy sort=-qty; they are
+# listed a page at a time with buttons for the next and previous pages, or,
+# with "file", all at once as a file in the channel.
 
 
-@app.route("/list", methods=["POST"])
-def list_handler():
-    args = request.form.get("text").split(" ")
+@command("/list")
+async def list_handler(form):
+    args = form.get("text").split()
     if len(args) == 0:
         return WRONG_NUM_ARGS
-    if args[0] == "positions":
-        try:
-            positions = api.list_positions()
-            if len(positions) == 0:
-                return "No positions."
-            positions = map(
-                lambda x: (f'Symbol: {x.symbol}, Qty: {x.qty}, Side: {x.side}, Entry price: {x.avg_entry_price}, Current price: {x.current_price}'),
-                positions)
-            return "Listing positions...\n" + '\n'.join(positions)
-        except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
-    elif args[0] == "orders" :
-        try:
-            orders = api.list_orders(status="open")
-            if len(orders) == 0:
-                return "No orders."
-            orders = map(
-                lambda x: (f'Symbol: {x.symbol}, Qty: {x.qty}, Side: {x.side}, Type: {x.type}, Time in Force: {x.time_in_force}, Amount Filled: {x.filled_qty}{(f", Stop Price = {x.stop_price}","")[x.stop_price == None]}{(f", Limit Price = {x.limit_price}","")[x.limit_price == None]}, Order id = {x.id}'),
-                orders)
-            return "Listing orders...\n" + '\n'.join(orders)
-        except Exception as e:
-            reply_private(request, f"ERROR: {str(e)}")
-    elif args[0] == "streams":
-        text = "Listing active streams...\n"
+    if args[0] == "streams":
         try:
-            for stream in streams:
-                if streams[stream] is not None:
-                    text += (stream + "\n")
-            if text == "Listing active streams...\n":
+            health = await stream_health()
+            if len(health) == 0:
                 return "No active streams."
-            return text
+            return "Listing active streams...\n" + '\n'.join(health)
         except Exception as e:
-            reply_private(request, f"ERROR: {str(e)}")
+            return f"ERROR: {str(e)}"
+    try:
+        query = list_query(args)
+    except ValueError as e:
+        return f"ERROR: {str(e)}"
+    return await start_list(form, query)
+
+# A page from the account mirror is sent straight away; asking Alpaca, or
+# uploading a file, is queued as a job.
+
+
+async def start_list(form, query, replace=False):
+    if mirror.ready() and not query["file"]:
+        await sub_list(api, form, query, replace)
+        return ""
+    return submit_job(sub_list, api, form, query, replace)
+
+
+async def sub_list(api, form, query, replace=False):
+    try:
+        items = await list_items(api, query)
+        if query["file"]:
+            if len(items) == 0:
+                reply_private(form, f'No {query["what"]}.')
+                return
+            await slack.upload(
+                form.get("channel_id"), f'{query["what"]}.txt',
+                "\n".join(list_table(query["what"], items)),
+                f'{len(items)} {query["what"]}')
+            return
+        text, blocks = list_page(query, items)
+        slack.respond(form.get("response_url"), text, blocks=blocks,
+                      replace_original=replace)
+    except Exception as e:
+        reply_private(form, f"ERROR: {str(e)}")
+
+# /list columns to sort by, and the filters each listing takes with the
+# values they allow (None for any)
+
+LIST_SORTS = {
+    "orders": {
+        "symbol": lambda x: x.symbol,
+        "side": lambda x: x.side,
+        "qty": lambda x: float(x.qty or 0),
+        "type": lambda x: x.type,
+        "filled": lambda x: float(x.filled_qty or 0),
+        "age": lambda x: x._raw.get("submitted_at") or "",
+    },
+    "positions": {
+        "symbol": lambda x: x.symbol,
+        "side": lambda x: x.side,
+        "qty": lambda x: float(x.qty),
+        "value": lambda x: position_value(x)[0],
+        "pl": lambda x: position_value(x)[1],
+    },
+}
+LIST_FILTERS = {
+    "orders": {"symbol": None, "side": ("buy", "sell"),
+               "type": ("market", "limit", "stop", "stop_limit",
+                        "trailing_stop")},
+    "positions": {"symbol": None, "side": ("long", "short")},
+}
+# Slack refuses a section of a message longer than 3000 characters, and a
+# button value longer than 2000
+LIST_CHUNK_CHARS = 2900
+SLACK_VALUE_CHARS = 2000
+
+# Reads the arguments of /list orders or positions into a query, raising
+# ValueError if one is wrong.  A query is also what the page buttons carry.
+
+
+def list_query(args):
+    what = args[0].lower()
+    if what not in LIST_SORTS:
+        raise ValueError("list orders, positions or streams")
+    query = {"what": what, "filters": {}, "sort": None, "page": 1,
+             "file": False}
+    for arg in args[1:]:
+        key, _, value = arg.lower().partition("=")
+        if key == "file" and value == "":
+            query["file"] = True
+        elif key == "sort" and value.lstrip("-") in LIST_SORTS[what]:
+            query["sort"] = value
+        elif key == "page" and value.isdigit() and int(value) > 0:
+            query["page"] = int(value)
+        elif key in LIST_FILTERS[what] and value != "":
+            values = [x for x in value.split(",") if x != ""]
+            allowed = LIST_FILTERS[what][key]
+            if key == "symbol":
+                values = [x.upper() for x in values]
+            elif not set(values) <= set(allowed):
+                raise ValueError(f'{key} is one of {", ".join(allowed)}')
+            query["filters"][key] = values
+        else:
+            raise ValueError(f'cannot list {what} by {arg}; sort by {", ".join(LIST_SORTS[what])}')
+    return query
+
+# The orders or positions a query asks for, filtered and sorted.  Orders come
+# newest first and positions by symbol unless sorted otherwise.
+
+
+async def list_items(api, query):
+    filters = query["filters"]
+    if query["what"] == "positions":
+        if mirror.ready():
+            items = list(mirror.positions.values())
+        else:
+            items = await api.list_positions()
+        items.sort(key=lambda x: x.symbol)
+    elif mirror.ready():
+        items = mirror.open_orders()
     else:
+        items = await api.list_all_orders(
+            status="open", symbols=filters.get("symbol"))
+    for key, values in filters.items():
+        items = [x for x in items if getattr(x, key) in values]
+    if query["sort"] is not None:
+        column = query["sort"].lstrip("-")
+        items.sort(key=LIST_SORTS[query["what"]][column],
+                   reverse=query["sort"].startswith("-"))
+    return items
+
+# A position's market value and unrealized P/L at its current price,
+# worked out here since positions the mirror opened from fills come without
+# Alpaca's own figures
+
+
+def position_value(position):
+    qty = float(position.qty)
+    price = float(position._raw.get("current_price") or 0)
+    return qty * price, qty * (price - float(position.avg_entry_price))
+
+# One line per order or position, under a header line
+
+
+def list_table(what, items):
+    if what == "positions":
+        lines = [f"{'Symbol':<8}{'Side':<6}{'Qty':>10}{'Entry':>12}{'Current':>12}{'Value':>14}{'P/L':>12}"]
+        for x in items:
+            value, pl = position_value(x)
+            lines.append(f"{x.symbol:<8}{x.side:<6}{x.qty:>10}{x.avg_entry_price:>12}{x._raw.get('current_price') or '':>12}{value:>14,.2f}{pl:>12,.2f}")
+        return lines
+    lines = [f"{'Symbol':<8}{'Side':<6}{'Qty':>8}  {'Type':<11}{'TIF':<5}{'Filled':>8}{'Limit':>10}{'Stop':>10}  Order id"]
+    for x in items:
+        lines.append(f"{x.symbol:<8}{x.side:<6}{x.qty or '':>8}  {x.type:<11}{x.time_in_force:<5}{x.filled_qty or '':>8}{x.limit_price or '':>10}{x.stop_price or '':>10}  {x.id}")
+    return lines
+
+# One page of a listing as a message: the table, in sections of at most
+# LIST_CHUNK_CHARS, and buttons for the pages either side of it.  Each
+# button carries the query for its page, so paging needs no state; a page is
+# listed afresh when asked for.
+
+
+def list_page(query, items):
+    what = query["what"]
+    if len(items) == 0:
+        return f"No {what}.", None
+    size = config["list_page_size"]
+    pages = (len(items) + size - 1) // size
+    page = min(query["page"], pages)
+    first = (page - 1) * size
+    shown = items[first:first + size]
+    text = f"Listing {what} {first + 1}-{first + len(shown)} of {len(items)}, page {page} of {pages}..."
+    header, *lines = list_table(what, shown)
+    blocks = [{"type": "section", "text": {"type": "mrkdwn", "text": text}}]
+    # Room left in a section after the header and the ``` around the table
+    room = LIST_CHUNK_CHARS - len(header) - 8
+    chunks, length = [[]], 0
+    for line in lines:
+        if length + len(line) + 1 > room and len(chunks[-1]) > 0:
+            chunks.append([])
+            length = 0
+        chunks[-1].append(line)
+        length += len(line) + 1
+    for chunk in chunks:
+        body = "```\n" + "\n".join([header] + chunk) + "\n```"
+        blocks.append({"type": "section",
+                       "text": {"type": "mrkdwn", "text": body}})
+    buttons = []
+    for label, number in (("Previous", page - 1), ("Next", page + 1)):
+        value = list_args(query, number)
+        if 1 <= number <= pages and len(value) <= SLACK_VALUE_CHARS:
+            buttons.append({
+                "type": "button",
+                "text": {"type": "plain_text", "text": label},
+                "action_id": f"list_{label.lower()}",
+                "value": value,
+            })
+    if len(buttons) > 0:
+        blocks.append({"type": "actions", "elements": buttons})
+    elif pages > 1:
+        blocks.append({"type": "context", "elements": [{
+            "type": "mrkdwn",
+            "text": "Too many filters for page buttons; add page= or file."}]})
+    return text, blocks
+
+# The /list arguments for a page of a query, as a page button carries them
+
+
+def list_args(query, page):
+    args = [query["what"]]
+    args += [f'{key}={",".join(values)}'
+             for key, values in query["filters"].items()]
+    if query["sort"] is not None:
+        args.append(f'sort={query["sort"]}')
+    return " ".join(args + [f"page={page}"])
+
+# Clicks on buttons in the bot's messages, which Slack posts to the app's
+# interactivity request URL as a JSON payload.  The /list page buttons show
+# their page in place of the one clicked on.
+
+
+@command("/interactive")
+async def interactive_handler(form):
+    try:
+        payload = json.loads(form.get("payload") or "{}")
+        actions = payload.get("actions", [])
+    except (ValueError, AttributeError):
         return BAD_ARGS
+    for action in actions:
+        if not isinstance(action, dict) or action.get("action_id") not in (
+                "list_previous", "list_next"):
+            continue
+        try:
+            query = list_query(str(action.get("value")).split())
+        except (ValueError, IndexError):
+            return BAD_ARGS
+        form = {
+            "command": "/list",
+            "response_url": payload.get("response_url"),
+            "channel_id": payload.get("channel", {}).get("id"),
+            "user_id": payload.get("user", {}).get("id"),
+        }
+        return await start_list(form, query, True)
+    return ""
+
+# Looks back through the order history.  Takes an optional symbol or order id
+# and an optional period such as 30m, 12h, 7d or 2w (default 1d), in either
+# order.
+
+PERIOD = re.compile(r'^(\d+)([mhdw])$')
+PERIOD_SECONDS = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+ORDER_ID = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$')
+HISTORY_LINES = 50
+
+
+@command("/history")
+async def history_handler(form):
+    args = form.get("text").split()
+    if len(args) > 2:
+        return WRONG_NUM_ARGS
+    if not history.enabled:
+        return "ERROR: No order history is kept.  Set HISTORY_PATH to keep one."
+    period, subject = "1d", None
+    for arg in args:
+        if PERIOD.match(arg.lower()):
+            period = arg.lower()
+        elif subject is None:
+            subject = arg
+        else:
+            return BAD_ARGS
+    amount, unit = PERIOD.match(period).groups()
+    since = time.time() - int(amount) * PERIOD_SECONDS[unit]
+    try:
+        if subject is None:
+            count, events = await history.query(since, HISTORY_LINES)
+            subject = "all symbols"
+        elif ORDER_ID.match(subject.lower()):
+            subject = subject.lower()
+            count, events = await history.query(
+                since, HISTORY_LINES, order_id=subject)
+            subject = f"order {subject}"
+        else:
+            subject = subject.upper()
+            count, events = await history.query(
+                since, HISTORY_LINES, symbol=subject)
+        if count == 0:
+            return f"No order events for {subject} in the last {period}."
+        lines = map(history_line, events)
+        text = f"Order events for {subject} in the last {period}, newest first"
+        if count > len(events):
+            text += f" (latest {len(events)} of {count})"
+        return text + "...\n" + "\n".join(lines)
+    except Exception as e:
+        return f'ERROR: {str(e)}'
+
+# One line of /history: when, the event, the order and any fill
+
+
+def history_line(event):
+    at, order_id, symbol, name, side, type, qty, fill_qty, fill_price = event
+    when = datetime.datetime.fromtimestamp(at, datetime.timezone.utc)
+    # Notional orders have no qty
+    qty = "" if qty is None else f" {qty:g}"
+    text = f'{when:%Y-%m-%d %H:%M:%S}  {name}: {side}{qty} {symbol} {type}'
+    if fill_price is not None:
+        fill_qty = "?" if fill_qty is None else f"{fill_qty:g}"
+        text += f', {fill_qty} at {fill_price:g}'
+    return text + f', Order id = {order_id}'
+
+# Routes trade_updates events to this channel.  "add" takes any of
+# symbols=, sides= and events=, each a comma separated list (all if left
+# out), as in /route add symbols=AAPL,MSFT events=fill,canceled; "list" shows
+# the channel's routes and "remove" takes a route id.
+
+TRADE_EVENTS = ("new", "fill", "partial_fill", "canceled", "expired",
+                "done_for_day", "replaced", "rejected", "pending_new",
+                "stopped", "pending_cancel", "pending_replace", "calculated",
+                "suspended", "order_replace_rejected", "order_cancel_rejected")
+
+
+@command("/route")
+async def route_handler(form):
+    args = form.get("text").split()
+    if len(args) == 0:
+        return WRONG_NUM_ARGS
+    channel = form.get("channel_name")
+    try:
+        if args[0] == "list":
+            found = await channel_routes(channel)
+            if len(found) == 0:
+                return "No routes to this channel."
+            lines = map(
+                lambda x: (f'#{x["id"]}: Symbols: {x["symbols"] or "all"}, Sides: {x["sides"] or "all"}, Events: {x["events"] or "all but new"}'),
+                found)
+            return "Listing routes...\n" + "\n".join(lines)
+        if args[0] == "remove":
+            if len(args) != 2:
+                return WRONG_NUM_ARGS
+            id = args[1].lstrip("#")
+            if not id.isdigit() or not await remove_route(int(id), channel):
+                return f"ERROR: This channel has no route #{id}."
+            return f"Route #{id} removed."
+        if args[0] != "add":
+            return BAD_ARGS
+        route = {"channel": channel, "symbols": "", "sides": "", "events": ""}
+        for arg in args[1:]:
+            key, _, values = arg.partition("=")
+            values = [x for x in values.split(",") if x != ""]
+            if key not in ("symbols", "sides", "events") or len(values) == 0:
+                return BAD_ARGS
+            if key == "symbols":
+                values = [x.upper() for x in values]
+                problems = symbol_problems(values)
+                if problems is not None:
+                    return problems
+            else:
+                values = [x.lower() for x in values]
+            if key == "sides" and not set(values) <= {"buy", "sell"}:
+                return BAD_ARGS
+            if key == "events" and not set(values) <= set(TRADE_EVENTS):
+                return BAD_ARGS
+            route[key] = ",".join(values)
+        id = await create_route(route)
+        return f"Route #{id} added: trade_updates events to #{channel}."
+    except Exception as e:
+        return f'ERROR: {str(e)}'
+
+# Sets, lists or cancels price alerts.  Takes a symbol, > or <, a price, and
+# optionally "repeat" and how long the alert lasts (like 12h or 7d, default
+# 1d), as in /alert AAPL > 190 repeat 7d; or "list"; or "cancel" and an
+# alert id.  An alert fires when the price reaches its threshold.
+
+ALERT = re.compile(r'^([A-Za-z.]+)\s*([<>])=?\s*(\d+(?:\.\d+)?)((?:\s+\S+)*)$')
+
+
+@command("/alert")
+async def alert_handler(form):
+    text = form.get("text").strip()
+    args = text.split()
+    if len(args) == 0:
+        return WRONG_NUM_ARGS
+    user = form.get("user_id")
+    try:
+        if args[0] == "list":
+            found = await user_alerts(user)
+            if len(found) == 0:
+                return "No alerts."
+            lines = map(
+                lambda x: (f'#{x["id"]}: {x["symbol"]} {("<", ">")[x["above"]]} {x["threshold"]:g}, {("once", "repeating")[x["repeat"]]}, expires {datetime.datetime.fromtimestamp(x["expires"], datetime.timezone.utc):%Y-%m-%d %H:%M} UTC'),
+                found)
+            return "Listing alerts...\n" + "\n".join(lines)
+        if args[0] == "cancel":
+            if len(args) != 2:
+                return WRONG_NUM_ARGS
+            id = args[1].lstrip("#")
+            if not id.isdigit() or not await cancel_alert(int(id), user):
+                return f"ERROR: You have no alert #{id}."
+            return f"Alert #{id} cancelled."
+        match = ALERT.match(text)
+        if match is None:
+            return BAD_ARGS
+        symbol, op, threshold, options = match.groups()
+        problems = symbol_problems([symbol])
+        if problems is not None:
+            return problems
+        repeat, ttl = False, PERIOD_SECONDS["d"]
+        for option in options.split():
+            period = PERIOD.match(option.lower())
+            if option.lower() == "repeat":
+                repeat = True
+            elif period is not None:
+                ttl = int(period.group(1)) * PERIOD_SECONDS[period.group(2)]
+            else:
+                return BAD_ARGS
+        if await alert_count() >= config["alerts_max"]:
+            return f'ERROR: There are already {config["alerts_max"]} alerts.'
+        alert = {
+            "symbol": symbol.upper(),
+            "above": op == ">",
+            "threshold": float(threshold),
+            "repeat": repeat,
+            "expires": time.time() + ttl,
+            "channel": form.get("channel_name"),
+            "user": user,
+        }
+        id = await create_alert(alert)
+        return f'Alert #{id} set: {alert["symbol"]} {op} {threshold}{("", ", repeating")[repeat]}.'
+    except Exception as e:
+        return f'ERROR: {str(e)}'
 
 # Clears positions or orders.  Must contain 1 argument: positions or orders
 
 
-@app.route("/clear", methods=["POST"])
-def clear_handler():
-    args = request.form.get("text").split(" ")
+@command("/clear")
+async def clear_handler(form):
+    args = form.get("text").split(" ")
     if len(args) == 0:
         return WRONG_NUM_ARGS
     if args[0] == "positions":
-        async def sub_clear_positions(api, request):
+        async def sub_clear_positions(api, form):
             try:
-                positions = api.list_positions()
-                positions = map(lambda x: [x.symbol, x.qty, x.side], positions)
-                for position in positions:
-                    api.submit_order(position[0], abs(
-                        int(position[1])), "sell" if position[2] == "long" else "buy", "market", "day")
-                text = "Position clearing orders sent."
-                response = requests.post(
-                    url="https://slack.com/api/chat.postMessage",
-                    data={
-                        "token": config["slack_token"],
-                        "channel": request.form.get("channel_name"),
-                        "text": text})
+                try:
+                    closed = await api.close_all_positions()
+                    results = [(x["symbol"], bulk_error(x)) for x in closed]
+                except BrokerError as e:
+                    if e.status not in (404, 405, 501):
+                        raise
+                    # No bulk endpoint; close each position with a market
+                    # order instead.
+                    positions = await api.list_positions()
+                    positions = list(map(lambda x: [x.symbol, x.qty, x.side], positions))
+                    sent = await fan_out(
+                        lambda position: api.submit_order(position[0], abs(
+                            int(position[1])), "sell" if position[2] == "long" else "buy", "market", "day",
+                            priority=PRIORITY_URGENT),
+                        positions, config["clear_concurrency"])
+                    results = [(position[0], error_or_none(result))
+                               for position, result in zip(positions, sent)]
+                text = clear_summary("Position clearing orders sent", results)
+                slack.post(form.get("channel_name"), text)
             except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
-        asyncio.run(sub_clear_positions(api, request))
-        return ""
+                reply_private(form, f"ERROR: {str(e)}")
+        return submit_job(sub_clear_positions, api, form)
     elif args[0] == "orders":
-        async def sub_clear_orders(api, request):
+        async def sub_clear_orders(api, form):
             try:
-                orders = api.list_orders()
-                orders = map(lambda x: x.id, orders)
-                for order in orders:
-                    api.cancel_order(order)
-                text = "Order cancels sent."
-                response = requests.post(
-                    url="https://slack.com/api/chat.postMessage",
-                    data={
-                        "token": config["slack_token"],
-                        "channel": request.form.get("channel_name"),
-                        "text": text})
+                try:
+                    canceled = await api.cancel_all_orders()
+                    results = [(x["id"], bulk_error(x)) for x in canceled]
+                except BrokerError as e:
+                    if e.status not in (404, 405, 501):
+                        raise
+                    # No bulk endpoint; cancel each order instead.
+                    orders = await api.list_orders()
+                    orders = list(map(lambda x: x.id, orders))
+                    sent = await fan_out(
+                        api.cancel_order, orders, config["clear_concurrency"])
+                    results = [(order, error_or_none(result))
+                               for order, result in zip(orders, sent)]
+                text = clear_summary("Order cancels sent", results)
+                slack.post(form.get("channel_name"), text)
             except Exception as e:
-                reply_private(request, f"ERROR: {str(e)}")
-        asyncio.run(sub_clear_orders(api, request))
-        return ""
+                reply_private(form, f"ERROR: {str(e)}")
+        return submit_job(sub_clear_orders, api, form)
     else:
         return BAD_ARGS
 
+# Helpers for /clear results: each result is a (symbol or order id, error)
+# pair, with None for the error when it went through.
+
+
+def bulk_error(entry):
+    if 200 <= entry.get("status", 200) < 300:
+        return None
+    body = entry.get("body") or {}
+    return body.get("message", f'status {entry["status"]}')
+
+
+def error_or_none(result):
+    if isinstance(result, Exception):
+        return describe_error(result)
+    return None
+
+
+def clear_summary(action, results):
+    failed = [f"{name} ({error})" for name, error in results if error]
+    text = f"{action} for {len(results) - len(failed)} of {len(results)}."
+    if len(failed) > 0:
+        text += "\nFailed: " + ", ".join(failed)
+    return text
+
 # Cancels order by id.  Must take one argument: order_id
 
 
-@app.route("/cancel_order", methods=["POST"])
-def cancel_order_handler():
-    args = request.form.get("text").split(" ")
+@command("/cancel_order")
+async def cancel_order_handler(form):
+    args = form.get("text").split(" ")
     if len(args) != 1:
         return WRONG_NUM_ARGS
     try:
-        api.cancel_order(args[0])
+        await api.cancel_order(args[0])
         text = f'Order canceled.  Order id = {args[0]}'
         return text
     except Exception as e:
@@ -361,16 +3966,19 @@ def cancel_order_handler():
 # Cancels most recent order.  Takes no arguments.
 
 
-@app.route("/cancel_recent_order", methods=["POST"])
-def cancel_recent_order_handler():
-    args = request.form.get("text").split(" ")
+@command("/cancel_recent_order")
+async def cancel_recent_order_handler(form):
+    args = form.get("text").split(" ")
     if len(args) != 0 and not (len(args) == 1 and args[0].strip() == ""):
         return WRONG_NUM_ARGS
     try:
-        orders = api.list_orders(status="open", limit=1)
+        if mirror.ready():
+            orders = mirror.open_orders()[:1]
+        else:
+            orders = await api.list_orders(status="open", limit=1)
         if len(orders) == 0:
             return "No orders to cancel."
-        api.cancel_order(orders[0].id)
+        await api.cancel_order(orders[0].id)
         text = f'Most recent order cancelled.  Order id = {orders[0].id}'
         return text
     except Exception as e:
@@ -379,13 +3987,16 @@ def cancel_recent_order_handler():
 # Gets basic account info.  Takes no arguments.
 
 
-@app.route("/account_info", methods=["POST"])
-def account_info_handler():
-    args = request.form.get("text").split(" ")
+@command("/account_info")
+async def account_info_handler(form):
+    args = form.get("text").split(" ")
     if len(args) != 0 and not (len(args) == 1 and args[0].strip() == ""):
         return WRONG_NUM_ARGS
     try:
-        account = api.get_account()
+        if mirror.ready() and mirror.account is not None:
+            account = mirror.account
+        else:
+            account = await api.get_account()
         text = f'Account info...\nBuying power = {account.buying_power}\nEquity = {account.equity}\nPortfolio value = {account.portfolio_value}\nShorting enabled? = {account.shorting_enabled}'
         return text
     except Exception as e:
@@ -395,75 +4006,207 @@ def account_info_handler():
 # arguments representing stock symbols. Must have live account to access.
 
 
-@app.route("/get_price_polygon", methods=["POST"])
-def get_price_polygon_handler():
-    args = request.form.get("text").split(" ")
+@command("/get_price_polygon")
+async def get_price_polygon_handler(form):
+    args = form.get("text").split(" ")
     if len(args) == 1 and args[0].strip() == "":
         return WRONG_NUM_ARGS
+    problems = symbol_problems(args)
+    if problems is not None:
+        return problems
 
-    async def sub_get_price_polygon(api, request, args):
+    async def sub_get_price_polygon(api, form, args):
         try:
             text = "Listing prices..."
-            args = map(lambda x: x.upper(), args)
-            for symbol in args:
-                quote = api.polygon.last_quote(symbol)
-                text += f'\n{symbol}: Bid price = {quote.bidprice}, Ask price = {quote.askprice}'
-            reply_private(request, text)
+            args = list(map(lambda x: x.upper(), args))
+            quotes = await fan_out(
+                api.polygon.last_quote, args,
+                config["quote_concurrency"], config["quote_timeout"])
+            failed = []
+            for symbol, quote in zip(args, quotes):
+                if isinstance(quote, Exception):
+                    failed.append(f'{symbol} ({describe_error(quote)})')
+                else:
+                    text += f'\n{symbol}: Bid price = {quote.bidprice}, Ask price = {quote.askprice}'
+            if len(failed) > 0:
+                text += "\nFailed: " + ", ".join(failed)
+            reply_private(form, text)
         except Exception as e:
-            reply_private(request, f"ERROR: {str(e)}")
-    asyncio.run(sub_get_price_polygon(api, request, args))
-    return ""
+            reply_private(form, f"ERROR: {str(e)}")
+    return submit_job(sub_get_price_polygon, api, form, args)
 
 # Gets price specified stock symbols.  Must include one or more arguments
 # representing stock symbols.
 
 
-@app.route("/get_price", methods=["POST"])
-def get_price_handler():
-    args = request.form.get("text").split(" ")
+@command("/get_price")
+async def get_price_handler(form):
+    args = form.get("text").split(" ")
     if len(args) == 1 and args[0].strip() == "":
         return WRONG_NUM_ARGS
+    problems = symbol_problems(args)
+    if problems is not None:
+        return problems
 
-    async def sub_get_price(api, request, args):
+    async def sub_get_price(api, form, args):
         try:
             text = "Listing prices..."
             args = map(lambda x: x.upper(), args)
-            bars = api.get_barset(args, "minute", 1)
-            for bar in bars:
-                text += f'\n{bar}: Price = {bars[bar][0].c}, Time = {bars[bar][0].t}'
-            reply_private(request, text)
+            quotes = await prices.fetch(api, list(args))
+            for symbol in quotes:
+                text += f'\n{symbol}: Price = {quotes[symbol][0]}, Time = {quotes[symbol][1]}'
+            reply_private(form, text)
         except Exception as e:
-            reply_private(request, f"ERROR: {str(e)}")
-    asyncio.run(sub_get_price(api, request, args))
-    return ""
+            reply_private(form, f"ERROR: {str(e)}")
+    return submit_job(sub_get_price, api, form, args)
+
+# Values the portfolio: unrealized and realized P&L, exposure by side and the
+# day's top movers.  No arguments.
+
+
+@command("/pnl")
+async def pnl_handler(form):
+    args = form.get("text").split(" ")
+    if len(args) != 0 and not (len(args) == 1 and args[0].strip() == ""):
+        return WRONG_NUM_ARGS
+
+    async def sub_pnl(api, form):
+        try:
+            reply_private(form, await pnl_report(api))
+        except Exception as e:
+            reply_private(form, f"ERROR: {str(e)}")
+    return submit_job(sub_pnl, api, form)
 
 # Provides a verbose description of each tradebot command
 
 
-@app.route("/help_tradebot", methods=["POST"])
-def help_tradebot_handler():
-    args = request.form.get("text").split(" ")
+@command("/help_tradebot")
+async def help_tradebot_handler(form):
+    args = form.get("text").split(" ")
     if len(args) != 0 and not (len(args) == 1 and args[0].strip() == ""):
         return WRONG_NUM_ARGS
     try:
         text = "Commands, arguments, and descriptions: \n\
             */order*: Executes order of specified type, limit/stop price as needed, <type> <side> <qty> <symbol> <time_in_force> <(optional) limit_price> <(optional) stop_price> \n\
-            */list*: Lists things, <'positions'/'orders'/'streams'> \n\
+            */list*: Lists things, <'positions'/'orders'/'streams'> [symbol=, side=, type=, sort=, page=, file] \n\
             */clear*: Clears things, <'positions'/'orders'> \n\
-            */subscribe_streaming*: Subscribe to streaming channels, <[channels]> \n\
+            */subscribe_streaming*: Subscribe to streaming channels (trade_updates, or Q./T./AM. and a symbol for quote/trade/minute bar digests), <[channels]> \n\
             */unsubscribe_streaming*: Unsubscribe from streaming channels, <[channels]> \n\
             */account_info*: Gets basic account info, *no args* \n\
             */get_price*: Gets the price(s) of the given symbol(s), <[symbol(s)]> \n\
             */get_price_polygon*: Polygon pricing data of given symbol(s), live accounts only, <[symbol(s)]> \n\
             */help_tradebot*: Provides a descripion of each command, *no args* \n\
             */cancel_order*: Cancels order by order id, <order_id> \n\
-            */cancel_recent_order*: Cancels most recent order, *no_args*"
+            */cancel_recent_order*: Cancels most recent order, *no_args* \n\
+            */order_basket*: Submits many orders at once, <orders separated by ';', each like /order's arguments> or <URL of a CSV file> \n\
+            */history*: Lists past order events, <(optional) symbol or order id> <(optional) period like 12h/7d/2w, default 1d> \n\
+            */pnl*: Portfolio P&L, exposure by side and top movers, *no args* \n\
+            */route*: Routes trade_updates events to this channel, <'add'> <(optional) symbols=A,B> <(optional) sides=buy/sell> <(optional) events=fill,canceled,...>, or <'list'>, or <'remove'> <route id> \n\
+            */alert*: Price alerts, <symbol> <'>'/'<'> <price> <(optional) 'repeat'> <(optional) lifetime like 12h/7d, default 1d>, or <'list'>, or <'cancel'> <alert id>"
         return text
     except Exception as e:
         return f'ERROR: {str(e)}'
 
+# Metrics for Prometheus to scrape
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metrics_view():
+    return metrics.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+# ASGI entry point.  Serves the same commands as the Flask app, but on the
+# ASGI server's own event loop, so one process can hold hundreds of slash
+# commands in flight at once:
+#
+#     uvicorn tradebot:asgi_app --port 3000
+
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                use_loop(asyncio.get_running_loop())
+                start_background()
+                warm_up()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await api.close()
+                await slack.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    if _loop is not asyncio.get_running_loop():
+        use_loop(asyncio.get_running_loop())
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        return await asgi_respond(send, metrics.render(),
+                                  content_type=METRICS_CONTENT_TYPE)
+    handler = commands.get(scope["path"])
+    if handler is None:
+        return await asgi_respond(send, "Not Found", status=404)
+    if scope["method"] != "POST":
+        return await asgi_respond(send, "Method Not Allowed", status=405)
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    form = dict(urllib.parse.parse_qsl(
+        body.decode("utf-8"), keep_blank_values=True))
+    try:
+        text = await handler(form)
+    except Exception as e:
+        logging.exception(f"{scope['path']} failed")
+        return await asgi_respond(send, f"ERROR: {str(e)}", status=500)
+    await asgi_respond(send, text or "")
+
+
+async def asgi_respond(send, text, status=200,
+                       content_type="text/html; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode("utf-8"))],
+    })
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+
+# Warm-up
+
+# Imports the deferred modules in a background thread, then opens the pooled
+# connections to Alpaca and Slack with one cheap request each, so the first
+# commands find everything ready.  Runs once per process, unless WARM_UP=0.
+
+
+_warm_up_pid = None
+
+
+def warm_up():
+    global _warm_up_pid
+    if not config["warm_up"] or _warm_up_pid == os.getpid():
+        return
+    _warm_up_pid = os.getpid()
+    loop = bot_loop()
+
+    def imports():
+        for module in (aiohttp, entity, polygon, pd):
+            module.load()
+        asyncio.run_coroutine_threadsafe(open_connections(), loop)
+    threading.Thread(target=imports, name="tradebot-warm-up",
+                     daemon=True).start()
+
+
+async def open_connections():
+    results = await asyncio.gather(
+        api.get_clock(), slack.warm_up(), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logging.warning(f"Warm-up request failed: {str(result)}")
+
 # Run on local port 3000
 
 
 if __name__ == "__main__":
-    app.run(port=3000)
\ No newline at end of file
+    bot_loop().call_soon_threadsafe(start_background)
+    flask_app().run(port=3000)
\ No newline at end of file